@@ -2,23 +2,41 @@
 import sys
 import traceback
 import logging
+import copy
+import hashlib
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+from itertools import islice
 import six
 from six.moves import email_mime_base
 
-from email import encoders, charset, message_from_string
+from email import encoders, charset, message_from_bytes, message_from_string
+from email.header import decode_header, make_header
 from email.utils import formatdate
 from email.message import Message
+from email.parser import BytesHeaderParser
+from email.policy import compat32
+from email.generator import BytesGenerator, NLCRE
 from email.mime.text import MIMEText
 from email.mime.message import MIMEMessage
 
 from django.core import mail as django_mail
-from django.template.loader import render_to_string
 from django.conf import settings
 
+from beproud.django.mailer.attachments import FileAttachment, MessageStream, placeholders
+from beproud.django.mailer.cache import LRUCache
 from beproud.django.mailer.signals import mail_pre_send, mail_post_send
+from beproud.django.mailer.rendering import (
+    MergeTemplate,
+    get_mail_template,
+    render_template,
+    split_message,
+)
+from beproud.django.mailer.results import MessageResult, SendReport
 
 # NOTE: CHARSETSや、ALIASESを先に登録しておかないといけない
-from beproud.django.mailer.models import *  # NOQA
+from beproud.django.mailer.charsets import *  # NOQA
 
 __version__ = '0.35'
 
@@ -27,14 +45,19 @@ __all__ = (
     'forbid_multi_line_headers',
     'make_msgid',
     'send_mail',
+    'send_raw_mail',
     'send_template_mail',
+    'send_template_mass_mail',
     'send_mass_mail',
     'mail_managers',
     'mail_managers_template',
     'mail_admins',
     'render_message',
+    'render_messages',
     'EmailMessage',
     'EmailMultiAlternatives',
+    'RawEmailMessage',
+    'FileAttachment',
     'SafeMIMEMessage',
     'SafeMIMEText',
     'SafeMIMEMultipart',
@@ -52,6 +75,42 @@ if not getattr(settings, "EMAIL_USE_BASE64_FOR_UTF8", True):
     # some spam filters.
     utf8_charset.body_encoding = None
 
+# Used instead of utf8_charset when the SMTP server's support for 8BITMIME
+# decides the transfer encoding.
+utf8_8bit_charset = charset.Charset('utf-8')
+utf8_8bit_charset.body_encoding = None
+utf8_7bit_charset = charset.Charset('utf-8')
+utf8_7bit_charset.body_encoding = charset.BASE64
+
+# The longest line allowed in an 8bit body (RFC 5322), without CRLF.
+MAX_8BIT_LINE_LENGTH = 998
+
+_build_state = threading.local()
+
+
+@contextmanager
+def _transfer_encoding(eightbit):
+    """
+    While active, utf-8 text parts are built with an 8bit (True) or base64
+    (False) transfer encoding instead of the configured one (None).
+    """
+    previous = getattr(_build_state, 'eightbit', None)
+    _build_state.eightbit = eightbit
+    try:
+        yield
+    finally:
+        _build_state.eightbit = previous
+
+
+def _body_charset(text):
+    eightbit = getattr(_build_state, 'eightbit', None)
+    if eightbit is False:
+        return utf8_7bit_charset
+    if eightbit and not any(
+            len(line.encode('utf-8')) > MAX_8BIT_LINE_LENGTH for line in text.splitlines()):
+        return utf8_8bit_charset
+    return utf8_charset
+
 
 class SafeMIMEText(django_mail.SafeMIMEText):
     def __init__(self, text, subtype, charset):
@@ -63,7 +122,7 @@ class SafeMIMEText(django_mail.SafeMIMEText):
             # We do it manually and trigger re-encoding of the payload.
             MIMEText.__init__(self, text, subtype, None)
             del self['Content-Transfer-Encoding']
-            self.set_payload(text, utf8_charset)
+            self.set_payload(text, _body_charset(text))
             self.replace_header('Content-Type', 'text/%s; charset="%s"'
                                 % (subtype, utf8_charset.get_output_charset()))
         else:
@@ -94,15 +153,233 @@ class SafeMIMEMessage(MIMEMessage):
 
 logger = logging.getLogger(getattr(settings, "EMAIL_LOGGER", ""))
 
+_header_policy = compat32.clone(linesep='\r\n')
+
+
+def _fold_header(name, value):
+    """
+    Returns the header line as written by BytesGenerator with CRLF line
+    endings. Short printable ASCII values are written as they are, which is
+    what compat32 folding does with them.
+    """
+    if (isinstance(value, str) and len(name) + len(value) + 2 <= _header_policy.max_line_length
+            and value.isascii() and value.isprintable()):
+        return ('%s: %s\r\n' % (name, value)).encode('ascii')
+    return _header_policy.fold_binary(name, value)
+
+
+_attachment_cache = None
+
+
+def get_attachment_cache():
+    """
+    Returns the process-wide cache of base64 encoded attachments, or None
+    if EMAIL_ATTACHMENT_CACHE_SIZE is 0.
+    """
+    global _attachment_cache
+    max_bytes = getattr(settings, "EMAIL_ATTACHMENT_CACHE_SIZE", 32 * 1024 * 1024)
+    if not max_bytes:
+        return None
+    if _attachment_cache is None or _attachment_cache.max_bytes != max_bytes:
+        _attachment_cache = LRUCache(max_bytes=max_bytes)
+    return _attachment_cache
+
+
+def _encode_base64(attachment, content):
+    """
+    Sets the content as the base64 encoded payload of the attachment. The
+    encoded payload is cached by content hash and mimetype, so a file
+    attached to many messages is only encoded once.
+    """
+    cache = get_attachment_cache() if isinstance(content, bytes) else None
+    if cache is None:
+        attachment.set_payload(content)
+        encoders.encode_base64(attachment)
+        return
+    key = (hashlib.sha1(content).hexdigest(), attachment.get_content_type())
+    payload = cache.get(key)
+    if payload is None:
+        attachment.set_payload(content)
+        encoders.encode_base64(attachment)
+        cache.set(key, attachment.get_payload())
+    else:
+        attachment.set_payload(payload)
+        attachment['Content-Transfer-Encoding'] = 'base64'
+
+
+class GeneratedMessageStream(object):
+    """
+    A MIME message written by the email generator straight to the output
+    while it is sent, instead of being serialized to bytes first. Its size
+    is not known in advance.
+    """
+    size = None
+    is_ascii = None
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def write_to(self, fp):
+        BytesGenerator(fp, mangle_from_=False).flatten(self.msg, linesep='\r\n')
+
+    def getvalue(self):
+        fp = BytesIO()
+        self.write_to(fp)
+        return fp.getvalue()
+
 
 class EmailMessage(django_mail.EmailMessage):
-    def message(self):
+    # The SMTP envelope recipients, if they differ from the To/Cc/Bcc
+    # addresses. Used when one message is delivered to many recipients.
+    envelope_recipients = None
+    # The MessageResult of the last time the message was sent.
+    last_result = None
+    # Identifies the message in the idempotency ledger instead of its
+    # Message-ID. See beproud.django.mailer.ledger.
+    idempotency_key = None
+
+    def recipients(self):
+        if self.envelope_recipients is not None:
+            return list(self.envelope_recipients)
+        return super(EmailMessage, self).recipients()
+
+    @property
+    def message_id(self):
+        """
+        The Message-ID of the message. Taken from the extra headers if given,
+        otherwise generated once and reused each time message() is built.
+        """
+        for name, value in self.extra_headers.items():
+            if name.lower() == 'message-id':
+                return value
+        message_id = getattr(self, '_message_id', None)
+        if message_id is None:
+            message_id = self._message_id = make_msgid()
+        return message_id
+
+    def message(self, eightbit=None):
+        """
+        Returns the MIME message. The message is built once and reused until
+        one of the attributes it is built from changes.
+
+        eightbit overrides the transfer encoding of utf-8 text parts: True
+        sends them as 8bit, for servers that support 8BITMIME, and False
+        base64 encodes them. None uses the configured encoding.
+        """
+        eightbit = self._transfer_mode(eightbit)
+        cache = self._get_message_cache(eightbit)
+        if cache[0] is None:
+            with _transfer_encoding(eightbit):
+                cache[0] = self._build_message()
+        return cache[0]
+
+    def message_bytes(self, eightbit=None):
+        """
+        Returns the message as bytes with CRLF line endings, ready to be sent
+        over SMTP. Cached along with message().
+        """
+        eightbit = self._transfer_mode(eightbit)
+        cache = self._get_message_cache(eightbit)
+        if cache[1] is None:
+            if cache[0] is None and self._can_serialize_fast():
+                with _transfer_encoding(eightbit):
+                    cache[1] = self._serialize_fast()
+            else:
+                cache[1] = self.message(eightbit).as_bytes(linesep='\r\n')
+        return cache[1]
+
+    def message_stream(self, eightbit=None):
+        """
+        Returns the message for sending over SMTP. This is the bytes from
+        message_bytes() unless the message has FileAttachment parts, when the
+        files are read and encoded chunk by chunk while the message is sent,
+        or it is larger than EMAIL_STREAM_THRESHOLD, when the message is
+        generated straight to the connection.
+        """
+        eightbit = self._transfer_mode(eightbit)
+        files = [a for a in self.attachments if isinstance(a, FileAttachment)]
+        if files:
+            msg = self.message(eightbit)
+            with placeholders():
+                template = msg.as_bytes(linesep='\r\n')
+            return MessageStream(template, files)
+        threshold = getattr(settings, "EMAIL_STREAM_THRESHOLD", 1024 * 1024)
+        cache = self._get_message_cache(eightbit)
+        if cache[1] is None and threshold is not None and self._estimate_size() >= threshold:
+            return GeneratedMessageStream(self.message(eightbit))
+        return self.message_bytes(eightbit)
+
+    def _transfer_mode(self, eightbit):
+        # Asking for the configured encoding gives the default message.
+        if eightbit is None or bool(eightbit) == (utf8_charset.body_encoding is None):
+            return None
+        return bool(eightbit)
+
+    def _estimate_size(self):
+        """The length of the body and the in-memory attachments and alternatives."""
+        size = len(self.body)
+        for attachment in self.attachments:
+            if not isinstance(attachment, MIMEBase):
+                size += len(attachment[1] or '')
+        for content, mimetype in getattr(self, 'alternatives', ()):
+            size += len(content)
+        return size
+
+    def _get_message_cache(self, eightbit=None):
+        """
+        Returns the [message, bytes] cache for the transfer encoding,
+        emptied if the message has changed since it was filled.
+        """
+        snapshot = self._snapshot()
+        cache = getattr(self, '_message_cache', None)
+        if cache is None or cache[0] != snapshot:
+            cache = self._message_cache = [snapshot, {}]
+        return cache[1].setdefault(eightbit, [None, None])
+
+    def _snapshot(self):
+        """
+        Returns the state the MIME message is built from. The built message
+        is thrown away when this no longer compares equal.
+        """
+        return (
+            self.subject,
+            self.body,
+            self.from_email,
+            tuple(self.to),
+            tuple(self.cc),
+            tuple(self.bcc),
+            tuple(self.reply_to),
+            tuple(self.extra_headers.items()),
+            tuple(self.attachments),
+            tuple(getattr(self, 'alternatives', ())),
+            self.encoding,
+            self.content_subtype,
+            self.mixed_subtype,
+            getattr(settings, "EMAIL_CHARSET", settings.DEFAULT_CHARSET),
+        )
+
+    def __getstate__(self):
+        # Don't pickle or copy the built message, only what it is built from.
+        state = self.__dict__.copy()
+        state.pop('_message_cache', None)
+        state.pop('last_result', None)
+        return state
+
+    def _get_date(self):
+        """The Date header, generated once so it stays the same across rebuilds."""
+        date = getattr(self, '_date', None)
+        if date is None:
+            date = self._date = formatdate(
+                localtime=getattr(settings, "EMAIL_USE_LOCALTIME", False))
+        return date
+
+    def _build_message(self):
         encoding = self.encoding or getattr(settings, "EMAIL_CHARSET", settings.DEFAULT_CHARSET)
         msg = SafeMIMEText(self.body, self.content_subtype, encoding)
         msg = self._create_message(msg)
         msg['Subject'] = self.subject
         msg['From'] = self.extra_headers.get('From', self.from_email)
-        msg['To'] = ', '.join(self.to)
+        msg['To'] = self.extra_headers.get('To', ', '.join(self.to))
         if self.cc:
             msg['Cc'] = ', '.join(self.cc)
 
@@ -110,15 +387,71 @@ class EmailMessage(django_mail.EmailMessage):
         # accommodate that when doing comparisons.
         header_names = [key.lower() for key in self.extra_headers]
         if 'date' not in header_names:
-            msg['Date'] = formatdate(localtime=getattr(settings, "EMAIL_USE_LOCALTIME", False))
+            msg['Date'] = self._get_date()
         if 'message-id' not in header_names:
-            msg['Message-ID'] = make_msgid()
+            msg['Message-ID'] = self.message_id
         for name, value in self.extra_headers.items():
             if name.lower() == 'from':  # From is already handled
                 continue
+            if name == 'To':  # To is already handled
+                continue
             msg[name] = value
         return msg
 
+    def _can_serialize_fast(self):
+        """
+        Whether the message is a single text part that _serialize_fast()
+        can write without building the MIME message.
+        """
+        return (
+            type(self) in (EmailMessage, EmailMultiAlternatives)
+            and not self.attachments
+            and not getattr(self, 'alternatives', None)
+            and getattr(settings, "EMAIL_FAST_SERIALIZER", True)
+        )
+
+    def _serialize_fast(self):
+        """
+        Writes a single part message straight to bytes. The output is the same
+        as message().as_bytes(linesep='\\r\\n'): the headers go through the
+        same forbid_multi_line_headers() and compat32 folding, but short
+        printable ASCII values, which folding leaves as they are, skip it.
+        """
+        encoding = self.encoding or getattr(settings, "EMAIL_CHARSET", settings.DEFAULT_CHARSET)
+        # The body part still encodes the payload so the transfer encoding
+        # and content headers match the generic path exactly.
+        part = SafeMIMEText(self.body, self.content_subtype, encoding)
+        headers = list(part.raw_items())
+
+        headers.append(('Subject', self.subject))
+        headers.append(('From', self.extra_headers.get('From', self.from_email)))
+        headers.append(('To', self.extra_headers.get('To', ', '.join(self.to))))
+        if self.cc:
+            headers.append(('Cc', ', '.join(self.cc)))
+        header_names = [key.lower() for key in self.extra_headers]
+        if 'date' not in header_names:
+            headers.append(('Date', self._get_date()))
+        if 'message-id' not in header_names:
+            headers.append(('Message-ID', self.message_id))
+        for name, value in self.extra_headers.items():
+            if name.lower() == 'from':  # From is already handled
+                continue
+            if name == 'To':  # To is already handled
+                continue
+            headers.append((name, value))
+
+        buf = []
+        for i, (name, value) in enumerate(headers):
+            if i >= len(part):
+                # Headers set on the message go through SafeMIMEText.__setitem__().
+                name, value = forbid_multi_line_headers(name, value, part.encoding)
+            buf.append(_fold_header(name, value))
+        buf.append(b'\r\n')
+        payload = part._payload
+        if payload:
+            buf.append('\r\n'.join(NLCRE.split(payload)).encode('ascii', 'surrogateescape'))
+        return b''.join(buf)
+
     def _create_mime_attachment(self, content, mimetype):
         """
         Converts the content, mimetype pair into a MIME attachment object.
@@ -146,14 +479,14 @@ class EmailMessage(django_mail.EmailMessage):
         else:
             # Encode non-text attachments with base64.
             attachment = MIMEBase(basetype, subtype)
-            attachment.set_payload(content)
-            encoders.encode_base64(attachment)
+            _encode_base64(attachment, content)
         return attachment
 
     def send(self, *args, **kwargs):
         mail_pre_send.send(sender=self, message=self)
-        super(EmailMessage, self).send(*args, **kwargs)
+        return_val = super(EmailMessage, self).send(*args, **kwargs)
         mail_post_send.send(sender=self, message=self)
+        return return_val
 
 
 class EmailMultiAlternatives(EmailMessage):
@@ -200,9 +533,56 @@ class EmailMultiAlternatives(EmailMessage):
         return msg
 
 
+class RawEmailMessage(EmailMessage):
+    """
+    A message that has already been serialized, for example in another
+    process. ``data`` is the whole message as bytes with CRLF line endings
+    and is sent as is; ``recipients`` are the envelope recipients.
+    """
+    def __init__(self, data, from_email, recipients, connection=None):
+        super(RawEmailMessage, self).__init__(from_email=from_email, to=list(recipients),
+                                              connection=connection)
+        self.data = data
+        subject = self._headers['Subject']
+        self.subject = str(make_header(decode_header(subject))) if subject else ''
+
+    @property
+    def _headers(self):
+        # Only the header block is parsed; the body may be large.
+        headers = getattr(self, '_raw_headers', None)
+        if headers is None:
+            end = self.data.find(b'\r\n\r\n')
+            head = self.data if end < 0 else self.data[:end + 2]
+            headers = self._raw_headers = BytesHeaderParser(policy=compat32).parsebytes(head)
+        return headers
+
+    @property
+    def message_id(self):
+        return self._headers['Message-ID']
+
+    def message(self, eightbit=None):
+        msg = getattr(self, '_raw_message', None)
+        if msg is None:
+            msg = self._raw_message = message_from_bytes(self.data, policy=compat32)
+        return msg
+
+    def message_bytes(self, eightbit=None):
+        return self.data
+
+    def message_stream(self, eightbit=None):
+        return self.data
+
+    def __getstate__(self):
+        state = super(RawEmailMessage, self).__getstate__()
+        state.pop('_raw_message', None)
+        state.pop('_raw_headers', None)
+        return state
+
+
 def send_mail(subject, message, from_email, recipient_list,
               fail_silently=False, auth_user=None, auth_password=None, encoding=None,
-              connection=None, html_message=None, cc=None, bcc=None, attachments=None):
+              connection=None, html_message=None, cc=None, bcc=None, attachments=None,
+              idempotency_key=None):
     """
     Sends an email message.
 
@@ -243,14 +623,33 @@ def send_mail(subject, message, from_email, recipient_list,
                                - A str object containing the file content.
                                - The mimetype for the file (optional but recommended.)
                                  If the mimetype is not provided it is guessed.
+
+                           MIMEBase instances such as FileAttachment are attached as is.
+    idempotency_key     -- A key identifying the message in the idempotency ledger. If a
+                           message with the same key was already delivered to the same
+                           recipients, it is not sent again. See EMAIL_IDEMPOTENCY_STORE.
     """
 
+    connection = connection or get_connection(username=auth_user, password=auth_password,
+                                              fail_silently=fail_silently)
+    msg = _build_mail(subject, message, from_email, recipient_list, encoding=encoding,
+                      connection=connection, html_message=html_message, cc=cc, bcc=bcc,
+                      attachments=attachments, idempotency_key=idempotency_key)
+    return_val = msg.send()
+    log_message(msg, return_val)
+    return return_val
+
+
+def _build_mail(subject, message, from_email, recipient_list, encoding=None,
+                connection=None, html_message=None, cc=None, bcc=None, attachments=None,
+                idempotency_key=None):
+    """
+    Builds the message sent by send_mail() without sending it.
+    """
     if settings.DEBUG and hasattr(settings, "EMAIL_ALL_FORWARD"):
         recipient_list = [settings.EMAIL_ALL_FORWARD]
         from_email = settings.EMAIL_ALL_FORWARD
 
-    connection = connection or get_connection(username=auth_user, password=auth_password,
-                                              fail_silently=fail_silently)
     if html_message:
         msg = EmailMultiAlternatives(
             subject=subject,
@@ -275,12 +674,14 @@ def send_mail(subject, message, from_email, recipient_list,
 
     if attachments:
         for attachment in attachments:
-            msg.attach(*attachment)
+            if isinstance(attachment, MIMEBase):
+                msg.attach(attachment)
+            else:
+                msg.attach(*attachment)
 
     msg.encoding = encoding
-    return_val = msg.send()
-    log_message(msg, return_val)
-    return return_val
+    msg.idempotency_key = idempotency_key
+    return msg
 
 
 def _render_mail_template(template_name, extra_context=None):
@@ -290,7 +691,7 @@ def _render_mail_template(template_name, extra_context=None):
     context = {}
     context.update(getattr(settings, "EMAIL_DEFAULT_CONTEXT", {}))
     context.update(extra_context or {})
-    return render_to_string(template_name, context)
+    return render_template(template_name, context)
 
 
 def render_message(template_name, extra_context={}):
@@ -302,15 +703,73 @@ def render_message(template_name, extra_context={}):
     passed to the template when it is rendered but can be
     overridden.
     """
-    mail_text = _render_mail_template(template_name, extra_context)
-    rendered_mail = mail_text.replace(u"\r\n", u"\n").replace(u"\r", u"\n").split(u"\n")
-    return rendered_mail[0], "\n".join(rendered_mail[1:])
+    return split_message(_render_mail_template(template_name, extra_context))
+
+
+def _message_renderer(template_name, html_template_name=None, extra_context=None,
+                      merge_fields=None):
+    """
+    Looks up the templates and merges the default context once, and returns
+    a function rendering a (subject, body, html) tuple from a context.
+
+    If merge_fields is given, the templates are also rendered once into
+    MergeTemplate skeletons, and contexts that only set those fields are
+    filled into the skeletons instead of being rendered in full.
+    """
+    template = get_mail_template(template_name)
+    html_template = get_mail_template(html_template_name) if html_template_name else None
+    base_context = {}
+    base_context.update(getattr(settings, "EMAIL_DEFAULT_CONTEXT", {}))
+    base_context.update(extra_context or {})
+
+    merge_template = merge_html_template = None
+    if merge_fields:
+        merge_template = MergeTemplate(template, base_context, merge_fields)
+        if html_template is not None:
+            merge_html_template = MergeTemplate(html_template, base_context, merge_fields)
+
+    def render(context):
+        context = context or {}
+        if merge_template is not None and merge_template.can_fill(context) and (
+                merge_html_template is None or merge_html_template.can_fill(context)):
+            subject, body = split_message(merge_template.fill(context))
+            html = merge_html_template.fill(context) if merge_html_template is not None else None
+            return subject, body, html
+        full_context = dict(base_context)
+        full_context.update(context)
+        subject, body = split_message(template.render(full_context))
+        html = html_template.render(full_context) if html_template is not None else None
+        return subject, body, html
+    return render
+
+
+def render_messages(template_name, contexts, html_template_name=None, extra_context=None,
+                    merge_fields=None):
+    """
+    Renders an email message for each context in contexts and yields
+    (subject, body, html) tuples. html is None if no html_template_name is
+    given.
+
+    The templates are looked up once, and the EMAIL_DEFAULT_CONTEXT setting
+    and extra_context are merged once and then overridden by each context.
+    contexts may be any iterable; messages are rendered as they are read.
+
+    merge_fields is a list of the context variable names that differ per
+    message. When given, the templates are rendered once with the shared
+    context and the fields are substituted into the result for each
+    message, escaped wherever the template escapes them. Templates that use
+    the fields other than by outputting them, and contexts with values that
+    aren't single-line strings or integers, are rendered in full.
+    """
+    render = _message_renderer(template_name, html_template_name, extra_context, merge_fields)
+    for context in contexts:
+        yield render(context)
 
 
 def send_template_mail(template_name, from_email, recipient_list, extra_context={},
                        fail_silently=False, auth_user=None, auth_password=None, encoding=None,
                        connection=None, html_template_name=None, cc=None, bcc=None,
-                       attachments=None):
+                       attachments=None, idempotency_key=None):
     u"""
     Send an email using a django template. The template should be formatted
     so that the first line of the template is the subject. All subsequent lines
@@ -359,15 +818,14 @@ def send_template_mail(template_name, from_email, recipient_list, extra_context=
                                - A str object containing the file content.
                                - The mimetype for the file (optional but recommended.)
                                  If the mimetype is not provided it is guessed.
-    """
-    if not isinstance(recipient_list, list) and not isinstance(recipient_list, tuple):
-        recipient_list = [recipient_list]
 
-    html_message = None
+                           MIMEBase instances such as FileAttachment are attached as is.
+    idempotency_key     -- A key identifying the message in the idempotency ledger.
+                           See send_mail().
+    """
     try:
-        subject, message = render_message(template_name, extra_context)
-        if html_template_name:
-            html_message = _render_mail_template(html_template_name, extra_context)
+        subject, message, html_message, recipient_list = _render_template_mail(
+            template_name, recipient_list, extra_context, html_template_name)
     except Exception:
         log_exception("Mail Error")
         if fail_silently:
@@ -389,11 +847,127 @@ def send_template_mail(template_name, from_email, recipient_list, extra_context=
         connection=connection,
         html_message=html_message,
         attachments=attachments,
+        idempotency_key=idempotency_key,
     )
 
 
+def _render_template_mail(template_name, recipient_list, extra_context, html_template_name):
+    if not isinstance(recipient_list, list) and not isinstance(recipient_list, tuple):
+        recipient_list = [recipient_list]
+
+    html_message = None
+    subject, message = render_message(template_name, extra_context)
+    if html_template_name:
+        html_message = _render_mail_template(html_template_name, extra_context)
+    return subject, message, html_message, recipient_list
+
+
+def _build_template_mail(template_name, from_email, recipient_list, extra_context={},
+                         encoding=None, html_template_name=None, cc=None, bcc=None,
+                         attachments=None, idempotency_key=None):
+    """
+    Builds the message sent by send_template_mail() without sending it.
+    """
+    subject, message, html_message, recipient_list = _render_template_mail(
+        template_name, recipient_list, extra_context, html_template_name)
+    return _build_mail(subject, message, from_email, recipient_list, encoding=encoding,
+                       html_message=html_message, cc=cc, bcc=bcc, attachments=attachments,
+                       idempotency_key=idempotency_key)
+
+
+def send_raw_mail(from_email, recipient_list, data, fail_silently=False, auth_user=None,
+                  auth_password=None, connection=None):
+    """
+    Sends a message that has already been serialized to bytes, as returned
+    by EmailMessage.message_bytes(), to the envelope recipients.
+    """
+    if settings.DEBUG and hasattr(settings, "EMAIL_ALL_FORWARD"):
+        recipient_list = [settings.EMAIL_ALL_FORWARD]
+        from_email = settings.EMAIL_ALL_FORWARD
+
+    connection = connection or get_connection(username=auth_user, password=auth_password,
+                                              fail_silently=fail_silently)
+    msg = RawEmailMessage(data, from_email, recipient_list, connection=connection)
+    return_val = msg.send()
+    log_message(msg, return_val)
+    return return_val
+
+
+def send_template_mass_mail(template_name, from_email, datatuple, extra_context=None,
+                            html_template_name=None, fail_silently=False, auth_user=None,
+                            auth_password=None, encoding=None, connection=None,
+                            chunk_size=None, report=False, merge_fields=None):
+    """
+    Sends a templated email to each of many recipients, each rendered with
+    its own context, over one connection.
+
+    Arguments
+    --------------
+
+    * template_name     -- The name of the Django template to use to render the email.
+    * from_email        -- The sender. Can be an email address or formatted name and address.
+    * datatuple         -- An iterable of (recipient_list, context) two tuples. Each context
+                           is added to extra_context when rendering that recipient's email.
+
+    Keyword Arguments
+    ----------------------
+    extra_context       -- A dictionary of data added to every context.
+    html_template_name  -- The template for the html body part of the emails.
+    chunk_size          -- Renders and sends chunk_size emails at a time. See send_mass_mail().
+    report              -- Returns a SendReport instead of the number of emails sent.
+    merge_fields        -- The names of the context variables that differ per email, to fill
+                           into templates rendered once. See render_messages().
+
+    The other arguments are the same as send_template_mail(). The templates
+    are looked up once for all the emails and the messages are rendered as
+    the datatuple is read, see render_messages(). If fail_silently is True,
+    emails whose templates fail to render are logged and skipped.
+    """
+    try:
+        render = _message_renderer(template_name, html_template_name, extra_context,
+                                   merge_fields)
+    except Exception:
+        log_exception("Mail Error")
+        if fail_silently:
+            return
+        raise
+
+    connection = connection or get_connection(username=auth_user, password=auth_password,
+                                              fail_silently=fail_silently)
+    forward = settings.DEBUG and hasattr(settings, "EMAIL_ALL_FORWARD")
+    if forward:
+        from_email = settings.EMAIL_ALL_FORWARD
+
+    def _messages():
+        for recipient_list, context in datatuple:
+            try:
+                subject, body, html = render(context)
+            except Exception:
+                log_exception("Mail Error")
+                if fail_silently:
+                    continue
+                raise
+            if forward:
+                recipient_list = [settings.EMAIL_ALL_FORWARD]
+            elif not isinstance(recipient_list, (list, tuple)):
+                recipient_list = [recipient_list]
+            if html is not None:
+                msg = EmailMultiAlternatives(subject, body, from_email, recipient_list,
+                                             connection=connection)
+                msg.attach_alternative(html, "text/html")
+            else:
+                msg = EmailMessage(subject, body, from_email, recipient_list,
+                                   connection=connection)
+            msg.encoding = encoding
+            yield msg
+
+    return send_mass_mail(_messages(), fail_silently=fail_silently, connection=connection,
+                          chunk_size=chunk_size, report=report)
+
+
 def send_mass_mail(datatuple, fail_silently=False, auth_user=None,
-                   auth_password=None, encoding=None, connection=None):
+                   auth_password=None, encoding=None, connection=None, chunk_size=None,
+                   report=False, coalesce=False):
     """
     Given a datatuple of (subject, message, from_email, recipient_list), sends
     each message to each recipient list. Returns the number of e-mails sent.
@@ -407,11 +981,31 @@ def send_mass_mail(datatuple, fail_silently=False, auth_user=None,
     If auth_user is None, the EMAIL_HOST_USER setting is used.
     If auth_password is None, the EMAIL_HOST_PASSWORD setting is used.
 
+    If chunk_size (or the EMAIL_MASS_MAIL_CHUNK_SIZE setting) is given, the
+    datatuple may be any iterable, including a generator. It is consumed
+    chunk_size items at a time and each chunk is built, signalled and sent
+    over the same connection before the next one is read, so only one
+    chunk of messages is held in memory at once.
+
+    If report is True, a SendReport with the result of each message is
+    returned instead of the number of e-mails sent, and a failing message
+    does not stop the rest from being sent.
+
+    If coalesce is True, messages with a single recipient that are the same
+    apart from that recipient are merged and sent as one message with many
+    envelope recipients, up to EMAIL_COALESCE_MAX_RECIPIENTS at a time. The
+    To header of a merged message is the message's own "To" extra header if
+    it has one, otherwise EMAIL_COALESCE_TO_HEADER. If that setting is None,
+    only messages with a "To" extra header are merged. Signals are sent and
+    results are counted for each original message.
+
     Note: The API for this method is frozen. New code wanting to extend the
     functionality should use the EmailMessage class directly.
     """
     connection = connection or get_connection(username=auth_user, password=auth_password,
                                               fail_silently=fail_silently)
+    if chunk_size is None:
+        chunk_size = getattr(settings, "EMAIL_MASS_MAIL_CHUNK_SIZE", None)
 
     def _message(args):
         if isinstance(args, EmailMessage):
@@ -432,30 +1026,165 @@ def send_mass_mail(datatuple, fail_silently=False, auth_user=None,
             message.encoding = charset
         return message
 
-    messages = [_message(d) for d in datatuple]
+    if not chunk_size:
+        return _send_mass_mail_chunk(connection, [_message(d) for d in datatuple],
+                                     report, coalesce)
 
+    datatuple = iter(datatuple)
+    new_conn_created = connection.open()
+    try:
+        result = SendReport() if report else 0
+        while True:
+            messages = [_message(d) for d in islice(datatuple, chunk_size)]
+            if not messages:
+                break
+            if report:
+                result.extend(_send_mass_mail_chunk(connection, messages, report, coalesce))
+            else:
+                result += _send_mass_mail_chunk(connection, messages, coalesce=coalesce) or 0
+    finally:
+        if new_conn_created:
+            connection.close()
+    return result
+
+
+def _send_mass_mail_chunk(connection, messages, report=False, coalesce=False):
     for message in messages:
         mail_pre_send.send(sender=message, message=message)
-    return_val = connection.send_messages(messages)
+    if coalesce:
+        return_val = _send_coalesced(connection, messages, report)
+    elif report:
+        return_val = connection.send_messages_report(messages)
+    else:
+        return_val = connection.send_messages(messages)
     for message in messages:
         mail_post_send.send(sender=message, message=message)
     return return_val
 
 
-def mail_managers(subject, message, fail_silently=False, encoding=None):
+def _coalesce_key(message, to_header):
+    """
+    Returns a key that is the same for messages that differ only in their
+    single To address, or None if the message cannot be merged.
+    """
+    if type(message) not in (EmailMessage, EmailMultiAlternatives):
+        return None
+    if len(message.to) != 1 or message.cc or message.bcc:
+        return None
+    if message.envelope_recipients is not None:
+        return None
+    if to_header is None and 'To' not in message.extra_headers:
+        return None
+    key = (
+        type(message),
+        message.subject,
+        message.body,
+        message.from_email,
+        message.encoding,
+        message.content_subtype,
+        message.mixed_subtype,
+        tuple(message.reply_to),
+        tuple(sorted(message.extra_headers.items())),
+        tuple(message.attachments),
+        tuple(getattr(message, 'alternatives', ())),
+    )
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _coalesce_messages(messages):
+    """
+    Groups the messages that can be merged and returns a list of
+    (message, originals) two tuples, where message is the message to send
+    for the originals.
+    """
+    max_recipients = getattr(settings, "EMAIL_COALESCE_MAX_RECIPIENTS", 100)
+    to_header = getattr(settings, "EMAIL_COALESCE_TO_HEADER", 'undisclosed-recipients:;')
+
+    groups = []
+    open_groups = {}
+    for message in messages:
+        key = _coalesce_key(message, to_header)
+        if key is None:
+            groups.append([message])
+            continue
+        group = open_groups.get(key)
+        if group is None or len(group) >= max_recipients:
+            group = open_groups[key] = []
+            groups.append(group)
+        group.append(message)
+
+    coalesced = []
+    for group in groups:
+        if len(group) == 1:
+            coalesced.append((group[0], group))
+            continue
+        merged = copy.copy(group[0])
+        merged.__dict__.pop('_message_id', None)
+        merged.extra_headers = dict(merged.extra_headers)
+        merged.extra_headers.setdefault('To', to_header)
+        merged.envelope_recipients = [m.to[0] for m in group]
+        coalesced.append((merged, group))
+    return coalesced
+
+
+def _send_coalesced(connection, messages, report=False):
+    """
+    Sends the messages with identical content as merged messages and
+    returns the number of original messages sent, or a SendReport with a
+    result for each original message if report is True.
+    """
+    coalesced = _coalesce_messages(messages)
+    sent = connection.send_messages_report([merged for merged, originals in coalesced])
+
+    results = {}
+    for result, (merged, originals) in zip(sent, coalesced):
+        if merged is originals[0]:
+            results[id(merged)] = result
+            continue
+        for message in originals:
+            recipient = message.to[0]
+            message_result = MessageResult(
+                message,
+                accepted=[r for r in result.accepted if r == recipient],
+                code=result.code,
+                elapsed=result.elapsed,
+                exception=result.exception,
+            )
+            message_result.message_id = result.message_id
+            message_result.refused = dict(
+                (r, v) for r, v in result.refused.items() if r == recipient)
+            results[id(message)] = message_result
+    send_report = SendReport(results[id(message)] for message in messages)
+
+    if report:
+        return send_report
+    if not getattr(connection, 'fail_silently', False):
+        for result in send_report:
+            if result.exception is not None:
+                raise result.exception
+    return send_report.num_sent
+
+
+def mail_managers(subject, message, fail_silently=False, encoding=None, connection=None):
     if not settings.MANAGERS:
         return
-    send_mail(
+    return send_mail(
         subject=settings.EMAIL_SUBJECT_PREFIX + subject,
         message=message,
         from_email=settings.SERVER_EMAIL,
         recipient_list=[a[1] for a in settings.MANAGERS],
         fail_silently=fail_silently,
         encoding=encoding,
+        connection=connection,
     )
 
 
-def mail_managers_template(template_name, extra_context={}, fail_silently=False, encoding=None):
+def mail_managers_template(template_name, extra_context={}, fail_silently=False, encoding=None,
+                           connection=None):
     if not settings.MANAGERS:
         return
     return send_template_mail(
@@ -465,19 +1194,21 @@ def mail_managers_template(template_name, extra_context={}, fail_silently=False,
         from_email=settings.SERVER_EMAIL,
         fail_silently=fail_silently,
         encoding=encoding,
+        connection=connection,
     )
 
 
-def mail_admins(subject, message, fail_silently=False, encoding=None):
+def mail_admins(subject, message, fail_silently=False, encoding=None, connection=None):
     if not settings.ADMINS:
         return
-    send_mail(
+    return send_mail(
         subject=settings.EMAIL_SUBJECT_PREFIX + subject,
         message=message,
         from_email=settings.SERVER_EMAIL,
         recipient_list=[a[1] for a in settings.ADMINS],
         fail_silently=fail_silently,
         encoding=encoding,
+        connection=connection,
     )
 
 
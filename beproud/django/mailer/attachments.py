@@ -0,0 +1,213 @@
+#:coding=utf-8:
+"""
+Attachments that are read from a file while the message is being sent
+rather than held in memory.
+"""
+import base64
+import mimetypes
+import mmap
+import os
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+from email.mime.base import MIMEBase
+
+__all__ = (
+    'FileAttachment',
+    'MessageStream',
+)
+
+DEFAULT_ATTACHMENT_MIME_TYPE = 'application/octet-stream'
+
+# Bytes encoded per chunk. A multiple of 57, the number of bytes that make
+# up one 76 character line of base64, so chunks encode to whole lines.
+CHUNK_SIZE = 57 * 1024
+
+_state = threading.local()
+
+
+@contextmanager
+def placeholders():
+    """
+    While active, FileAttachment payloads are a short placeholder instead of
+    the encoded file, so that the rest of the message can be serialized
+    without reading the files. MessageStream puts the files back in.
+    """
+    previous = getattr(_state, 'placeholders', False)
+    _state.placeholders = True
+    try:
+        yield
+    finally:
+        _state.placeholders = previous
+
+
+class FileAttachment(MIMEBase):
+    """
+    A base64 encoded attachment whose content is read from a file path or a
+    Django File each time the message is serialized.
+
+    When the message is sent by the SMTP backend the file is memory-mapped
+    and encoded chunk by chunk straight into the DATA stream, so the whole
+    file is never held in memory. Serializing the message any other way,
+    for example with message().as_string(), encodes the whole file at once.
+    """
+    def __init__(self, file, filename=None, mimetype=None):
+        if isinstance(file, str):
+            self.path = file
+            self.file = None
+        else:
+            try:
+                # FieldFile.path raises NotImplementedError for storages
+                # without local files.
+                self.path = file.path
+            except (AttributeError, NotImplementedError, ValueError):
+                self.path = None
+            self.file = file
+        if filename is None:
+            filename = os.path.basename(self.path or getattr(file, 'name', None) or '') or None
+        if mimetype is None:
+            mimetype = mimetypes.guess_type(filename or '')[0] or DEFAULT_ATTACHMENT_MIME_TYPE
+        basetype, subtype = mimetype.split('/', 1)
+        MIMEBase.__init__(self, basetype, subtype)
+        self['Content-Transfer-Encoding'] = 'base64'
+        if filename:
+            try:
+                filename.encode('ascii')
+            except UnicodeEncodeError:
+                filename = ('utf-8', '', filename)
+            self.add_header('Content-Disposition', 'attachment', filename=filename)
+        self.filename = filename
+        self.placeholder = '<bpmailer-file-%s>' % uuid.uuid4().hex
+
+    @property
+    def _payload(self):
+        if getattr(_state, 'placeholders', False):
+            return self.placeholder
+        return b''.join(self.iter_encoded(b'\n')).decode('ascii')
+
+    @_payload.setter
+    def _payload(self, value):
+        # Message.__init__() sets the payload to None. The payload of a
+        # FileAttachment always comes from the file.
+        if value is not None:
+            raise TypeError('The payload of a FileAttachment is read from its file.')
+
+    @contextmanager
+    def _open(self):
+        """
+        Yields a bytes-like view of the file content, memory-mapped when the
+        file is on disk, or None if the file can only be read sequentially.
+        """
+        if self.path is not None:
+            f = open(self.path, 'rb')
+        else:
+            f = self.file
+            f.open('rb')
+        try:
+            try:
+                fileno = f.fileno()
+            except (AttributeError, OSError, ValueError):
+                fileno = None
+            if fileno is None:
+                yield None
+            elif os.fstat(fileno).st_size == 0:
+                # mmap can't map an empty file.
+                yield b''
+            else:
+                mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+                try:
+                    yield mapped
+                finally:
+                    mapped.close()
+        finally:
+            if self.path is not None:
+                f.close()
+
+    def _iter_chunks(self):
+        """Yields the file content in CHUNK_SIZE pieces."""
+        with self._open() as data:
+            if data is not None:
+                for start in range(0, len(data), CHUNK_SIZE):
+                    yield data[start:start + CHUNK_SIZE]
+                return
+            self.file.seek(0)
+            buf = b''
+            for chunk in self.file.chunks():
+                buf += chunk
+                while len(buf) >= CHUNK_SIZE:
+                    yield buf[:CHUNK_SIZE]
+                    buf = buf[CHUNK_SIZE:]
+            if buf:
+                yield buf
+
+    def iter_encoded(self, linesep=b'\r\n'):
+        """
+        Yields the base64 encoded file in chunks. The output is the same as
+        email.encoders.encode_base64() with lines ending in linesep.
+        """
+        for chunk in self._iter_chunks():
+            encoded = base64.encodebytes(chunk)
+            if linesep != b'\n':
+                encoded = encoded.replace(b'\n', linesep)
+            yield encoded
+
+    def encoded_size(self, linesep=b'\r\n'):
+        """
+        Returns the length of the encoded file, or None if the file can't be
+        inspected without reading it.
+        """
+        with self._open() as data:
+            if data is None:
+                return None
+            size = len(data)
+        lines = (size + 56) // 57
+        return 4 * ((size + 2) // 3) + lines * len(linesep)
+
+
+class MessageStream(object):
+    """
+    The bytes of a message with FileAttachment parts, produced chunk by
+    chunk when iterated. ``template`` is the message serialized with
+    placeholders in place of the attachments.
+    """
+    def __init__(self, template, attachments, linesep=b'\r\n'):
+        self.template = template
+        self.linesep = linesep
+        self.attachments = dict(
+            (a.placeholder.encode('ascii'), a) for a in attachments)
+        self._re = re.compile(b'(' + b'|'.join(re.escape(p) for p in self.attachments) + b')')
+
+    def __iter__(self):
+        for i, piece in enumerate(self._re.split(self.template)):
+            if i % 2:
+                for chunk in self.attachments[piece].iter_encoded(self.linesep):
+                    yield chunk
+            elif piece:
+                yield piece
+
+    @property
+    def is_ascii(self):
+        # The files are base64 encoded.
+        return self.template.isascii()
+
+    @property
+    def size(self):
+        """The length of the message in bytes, or None if it is not known."""
+        size = 0
+        for i, piece in enumerate(self._re.split(self.template)):
+            if i % 2:
+                encoded_size = self.attachments[piece].encoded_size(self.linesep)
+                if encoded_size is None:
+                    return None
+                size += encoded_size
+            else:
+                size += len(piece)
+        return size
+
+    def write_to(self, fp):
+        for chunk in self:
+            fp.write(chunk)
+
+    def getvalue(self):
+        return b''.join(self)
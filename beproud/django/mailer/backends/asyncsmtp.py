@@ -0,0 +1,415 @@
+"""
+SMTP email backend built on asyncio streams that keeps several SMTP
+sessions open and drives mail transactions on them concurrently.
+"""
+
+import asyncio
+import base64
+import logging
+import smtplib
+import ssl
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail import DNS_NAME
+
+from beproud.django.mailer.backends.base import BaseEmailBackend
+from beproud.django.mailer.backends.smtp import message_bytes, quote_data
+from beproud.django.mailer.ratelimit import RateLimitExceeded
+from beproud.django.mailer.results import MessageResult, SendReport
+
+logger = logging.getLogger(getattr(settings, "EMAIL_LOGGER", ""))
+
+
+def _is_connection_error(e):
+    """
+    Returns whether the exception means the SMTP session can no longer
+    be used, as opposed to the server refusing a single message.
+    """
+    if isinstance(e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)):
+        return False
+    return isinstance(e, (OSError, asyncio.TimeoutError))
+
+
+class SMTPSession(object):
+    """
+    A minimal asyncio SMTP client supporting STARTTLS, AUTH PLAIN/LOGIN
+    and PIPELINING.
+    """
+    def __init__(self, host, port, local_hostname=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.local_hostname = local_hostname or 'localhost'
+        self.timeout = timeout
+        self.extensions = {}
+        self.reader = None
+        self.writer = None
+
+    def has_extn(self, name):
+        return name.lower() in self.extensions
+
+    async def connect(self, use_tls=False, username=None, password=None):
+        self.reader, self.writer = await self._wait(
+            asyncio.open_connection(self.host, self.port))
+        code, resp = await self.read_reply()
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, resp)
+        await self.ehlo()
+        if use_tls:
+            await self.starttls()
+            await self.ehlo()
+        if username and password:
+            await self.login(username, password)
+
+    async def ehlo(self):
+        code, resp = await self.command('ehlo %s' % self.local_hostname)
+        if code != 250:
+            code, resp = await self.command('helo %s' % self.local_hostname)
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, resp)
+            self.extensions = {}
+            return
+        self.extensions = {}
+        for line in resp.decode('latin-1').split('\n')[1:]:
+            keyword, _, params = line.partition(' ')
+            self.extensions[keyword.lower()] = params.strip()
+
+    async def starttls(self):
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        code, resp = await self.command('starttls')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, resp)
+        context = ssl.create_default_context()
+        if hasattr(self.writer, 'start_tls'):
+            await self._wait(self.writer.start_tls(context, server_hostname=self.host))
+        else:
+            # StreamWriter.start_tls() was added in Python 3.11.
+            loop = asyncio.get_running_loop()
+            transport = self.writer.transport
+            protocol = transport.get_protocol()
+            transport = await self._wait(loop.start_tls(
+                transport, protocol, context, server_hostname=self.host))
+            self.writer._transport = transport
+            protocol._transport = transport
+
+    async def login(self, username, password):
+        mechanisms = self.extensions.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms:
+            token = base64.b64encode(
+                ('\0%s\0%s' % (username, password)).encode('utf-8')).decode('ascii')
+            code, resp = await self.command('AUTH PLAIN %s' % token)
+        elif 'LOGIN' in mechanisms:
+            code, resp = await self.command('AUTH LOGIN')
+            if code == 334:
+                code, resp = await self.command(
+                    base64.b64encode(username.encode('utf-8')).decode('ascii'))
+            if code == 334:
+                code, resp = await self.command(
+                    base64.b64encode(password.encode('utf-8')).decode('ascii'))
+        else:
+            raise smtplib.SMTPNotSupportedError("No suitable authentication method found.")
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, resp)
+
+    async def command(self, line):
+        self.writer.write(line.encode('ascii') + b'\r\n')
+        return await self.read_reply()
+
+    async def read_reply(self):
+        lines = []
+        while True:
+            line = await self._wait(self.reader.readline())
+            if not line:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+            lines.append(line[4:].strip(b' \t\r\n'))
+            if line[3:4] != b'-' or code == -1:
+                return code, b'\n'.join(lines)
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Performs a mail transaction and returns a dictionary of refused
+        recipients, raising the same exceptions as smtplib.SMTP.sendmail().
+        """
+        options = ''
+        if self.has_extn('size'):
+            options = ' size=%d' % len(msg)
+        commands = ['mail FROM:%s%s' % (smtplib.quoteaddr(from_addr), options)]
+        commands.extend('rcpt TO:%s' % smtplib.quoteaddr(addr) for addr in to_addrs)
+        if self.has_extn('pipelining'):
+            self.writer.write(''.join('%s\r\n' % c for c in commands).encode('ascii'))
+            replies = [await self.read_reply() for c in commands]
+        else:
+            replies = []
+            for command in commands:
+                replies.append(await self.command(command))
+                if replies[0][0] != 250:
+                    break
+
+        mail_reply = replies[0]
+        if mail_reply[0] != 250:
+            await self.rset()
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        refused = {}
+        for addr, (code, resp) in zip(to_addrs, replies[1:]):
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            await self.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = await self.command('data')
+        if code != 354:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        self.writer.write(quote_data(msg))
+        code, resp = await self.read_reply()
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    async def rset(self):
+        try:
+            await self.command('rset')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def quit(self):
+        try:
+            await self.command('quit')
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = self.reader = None
+
+    def _wait(self, awaitable):
+        return asyncio.wait_for(awaitable, self.timeout)
+
+
+class EmailBackend(BaseEmailBackend):
+    """
+    An SMTP backend that sends messages over up to ``concurrency`` SMTP
+    sessions at once. ``send_messages()`` runs ``asend_messages()`` on
+    an event loop; async code can await ``asend_messages()`` directly.
+    """
+    success_code = 250
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 use_tls=None, concurrency=None, timeout=None,
+                 fail_silently=False, **kwargs):
+        super(EmailBackend, self).__init__(fail_silently=fail_silently)
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.username = username or settings.EMAIL_HOST_USER
+        self.password = password or settings.EMAIL_HOST_PASSWORD
+        if use_tls is None:
+            self.use_tls = settings.EMAIL_USE_TLS
+        else:
+            self.use_tls = use_tls
+        self.concurrency = concurrency or getattr(settings, "EMAIL_ASYNC_SMTP_CONCURRENCY", 4)
+        self.timeout = timeout or getattr(settings, "EMAIL_TIMEOUT", None)
+
+    def send_messages(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns the number of email
+        messages sent.
+        """
+        if not email_messages:
+            return
+        # The idempotency ledger may be a database, which can't be used
+        # from inside the event loop, so it is read before and written
+        # after the messages are sent.
+        state = self._state(self._ledger_keys(email_messages))
+        self._run(self._send_all(email_messages, state))
+        self._record_delivered(state)
+        if state['error'] is not None:
+            raise state['error']
+        return state['num_sent']
+
+    def send_messages_report(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns a SendReport with a
+        MessageResult for each message.
+        """
+        state = self._state(self._ledger_keys(email_messages), report=True)
+        self._run(self._send_all(email_messages, state))
+        self._record_delivered(state)
+        return SendReport(state['results'][i] for i in sorted(state['results']))
+
+    def _run(self, coro):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coro)
+
+        # Called from inside an event loop: run on a loop of our own in
+        # another thread rather than blocking the caller's loop re-entrantly.
+        result = {}
+
+        def run():
+            try:
+                result['value'] = asyncio.run(coro)
+            except BaseException as e:
+                result['error'] = e
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    async def asend_messages(self, email_messages):
+        """
+        Sends the messages concurrently and returns the number of email
+        messages sent.
+        """
+        state = self._state(await self._aledger_keys(email_messages))
+        await self._send_all(email_messages, state)
+        if state['delivered']:
+            await sync_to_async(self._record_delivered)(state)
+        if state['error'] is not None:
+            raise state['error']
+        return state['num_sent']
+
+    async def asend_messages_report(self, email_messages):
+        """
+        Sends the messages concurrently and returns a SendReport with a
+        MessageResult for each message, in the order they were given.
+        Failures never stop the remaining messages from being sent.
+        """
+        state = self._state(await self._aledger_keys(email_messages), report=True)
+        await self._send_all(email_messages, state)
+        if state['delivered']:
+            await sync_to_async(self._record_delivered)(state)
+        return SendReport(state['results'][i] for i in sorted(state['results']))
+
+    def _state(self, keys, report=False):
+        # keys maps the index of each message to its ledger key, or to
+        # False if it was already delivered. Keys of the messages that are
+        # delivered now are collected in 'delivered'.
+        return {'num_sent': 0, 'error': None, 'results': {} if report else None,
+                'keys': keys, 'delivered': []}
+
+    def _ledger_keys(self, email_messages):
+        if self.ledger is None:
+            return {}
+        return dict((i, self._check_ledger(m)) for i, m in enumerate(email_messages)
+                    if m.recipients())
+
+    async def _aledger_keys(self, email_messages):
+        if self.ledger is None:
+            return {}
+        return await sync_to_async(self._ledger_keys)(email_messages)
+
+    def _record_delivered(self, state):
+        for key in state['delivered']:
+            self._record_ledger(key)
+
+    async def _send_all(self, email_messages, state):
+        queue = asyncio.Queue()
+        for item in enumerate(email_messages):
+            queue.put_nowait(item)
+        if queue.empty():
+            return
+        workers = [self._worker(queue, state)
+                   for i in range(min(self.concurrency, queue.qsize()))]
+        await asyncio.gather(*workers)
+
+    async def _worker(self, queue, state):
+        results = state['results']
+        session = None
+        try:
+            while not queue.empty() and state['error'] is None:
+                index, email_message = queue.get_nowait()
+                recipients = email_message.recipients()
+                if not recipients:
+                    if results is not None:
+                        results[index] = MessageResult(email_message)
+                    continue
+                key = state['keys'].get(index)
+                if key is False:
+                    state['num_sent'] += 1
+                    if results is not None:
+                        results[index] = MessageResult(email_message, accepted=recipients,
+                                                       duplicate=True)
+                    continue
+                start = time.monotonic()
+                try:
+                    if session is None:
+                        session = SMTPSession(self.host, self.port,
+                                              local_hostname=DNS_NAME.get_fqdn(),
+                                              timeout=self.timeout)
+                        await session.connect(self.use_tls, self.username, self.password)
+                    await self._acquire_rate_limit_async(email_message)
+                    start = time.monotonic()
+                    refused = await self._send_message_async(session, email_message)
+                except Exception as e:
+                    from beproud.django.mailer.api import log_exception
+                    log_exception("%s: Mail Error" % self)
+                    if _is_connection_error(e) and session is not None:
+                        # The session is unusable; open a new one for the next message.
+                        session.close()
+                        session = None
+                    if results is not None:
+                        results[index] = MessageResult(
+                            email_message, elapsed=time.monotonic() - start, exception=e)
+                    elif not self.fail_silently:
+                        state['error'] = e
+                else:
+                    state['num_sent'] += 1
+                    accepted = [r for r in recipients if r not in refused]
+                    if key is not None and accepted:
+                        state['delivered'].append(key)
+                    if results is not None:
+                        results[index] = MessageResult(
+                            email_message,
+                            accepted=accepted,
+                            refused=refused,
+                            code=self.success_code,
+                            elapsed=time.monotonic() - start,
+                        )
+        finally:
+            if session is not None:
+                await session.quit()
+
+    async def _acquire_rate_limit_async(self, email_message):
+        """
+        Waits without blocking the event loop until the rate limits allow the
+        message to be sent, or raises RateLimitExceeded.
+        """
+        limiter = self.rate_limiter
+        if limiter is None:
+            return
+        recipients = len(email_message.recipients())
+        waited = 0
+        while True:
+            wait = limiter.try_acquire(self.host, recipients)
+            if not wait:
+                return
+            if not limiter.block or (limiter.max_wait is not None
+                                     and waited + wait > limiter.max_wait):
+                raise RateLimitExceeded(wait)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    async def _send_message_async(self, session, email_message):
+        refused = await session.sendmail(
+            email_message.from_email,
+            email_message.recipients(),
+            message_bytes(email_message),
+        )
+        if refused:
+            logger.warning("%s: Recipients refused: %r" % (self, refused))
+        return refused
@@ -1,5 +1,11 @@
 """Base email backend class."""
 
+import time
+
+from beproud.django.mailer.ledger import get_ledger, ledger_key
+from beproud.django.mailer.ratelimit import get_rate_limiter
+from beproud.django.mailer.results import MessageResult, SendReport
+
 
 class BaseEmailBackend(object):
     """
@@ -7,8 +13,13 @@ class BaseEmailBackend(object):
 
     Subclasses must at least overwrite send_messages().
     """
+    # The SMTP reply code reported for messages sent without error.
+    success_code = None
+
     def __init__(self, fail_silently=False, **kwargs):
         self.fail_silently = fail_silently
+        self.rate_limiter = get_rate_limiter()
+        self.ledger = get_ledger()
 
     def open(self):
         """Open a network connection.
@@ -43,21 +54,112 @@ class BaseEmailBackend(object):
                 num_sent += 1
         return num_sent
 
+    def send_messages_report(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns a SendReport with a
+        MessageResult for each message. Unlike send_messages(), a failing
+        message does not stop the rest of the batch, regardless of
+        fail_silently.
+        """
+        report = SendReport()
+        if not email_messages:
+            return report
+        try:
+            new_conn_created = self.open()
+        except Exception as e:
+            from beproud.django.mailer.api import log_exception
+            log_exception("%s: Mail Error" % self)
+            report.extend(MessageResult(m, exception=e) for m in email_messages)
+            return report
+        try:
+            for email_message in email_messages:
+                report.append(self._send_message_result(email_message))
+        finally:
+            if new_conn_created:
+                self.close()
+        return report
+
     def _send_message_wrapper(self, email_message):
         """A helper method that does the actual sending."""
+        result = self._send_message_result(email_message)
+        if result.exception is not None and not self.fail_silently:
+            raise result.exception
+        return result.sent
 
-        if not email_message.recipients():
-            return False
+    def _send_message_result(self, email_message):
+        """
+        Sends the message and returns a MessageResult, catching and logging
+        any exception.
+        """
+        recipients = email_message.recipients()
+        if not recipients:
+            return MessageResult(email_message)
+        key = self._check_ledger(email_message)
+        if key is False:
+            return MessageResult(email_message, accepted=recipients, duplicate=True)
 
+        start = time.monotonic()
         try:
-            self._send_message(email_message)
-        except:
+            self._acquire_rate_limit(email_message)
+            start = time.monotonic()
+            refused = self._send_message(email_message) or {}
+        except Exception as e:
             from beproud.django.mailer.api import log_exception
             log_exception("%s: Mail Error" % self)
-            if not self.fail_silently:
-                raise
+            return MessageResult(email_message, elapsed=time.monotonic() - start, exception=e)
+        result = MessageResult(
+            email_message,
+            accepted=[r for r in recipients if r not in refused],
+            refused=refused,
+            code=self.success_code,
+            elapsed=time.monotonic() - start,
+        )
+        if result.accepted:
+            self._record_ledger(key)
+        return result
+
+    def _check_ledger(self, email_message):
+        """
+        Returns the ledger key to record the message under once it is sent,
+        None if there is no ledger, or False if the message was already
+        delivered and must be skipped.
+        """
+        if getattr(self, 'ledger', None) is None:
+            return None
+        key = ledger_key(email_message)
+        if key is None:
+            return None
+        try:
+            delivered = self.ledger.contains(key)
+        except Exception:
+            # Sending twice is better than not sending at all.
+            from beproud.django.mailer.api import log_exception
+            log_exception("%s: Idempotency ledger error" % self)
+            return None
+        if delivered:
+            from beproud.django.mailer.api import logger
+            logger.info("%s: Skipped %s, already delivered" % (self, email_message.message_id))
             return False
-        return True
+        return key
+
+    def _record_ledger(self, key):
+        """Records a delivered message under the key from _check_ledger()."""
+        if key is None:
+            return
+        try:
+            self.ledger.add(key)
+        except Exception:
+            from beproud.django.mailer.api import log_exception
+            log_exception("%s: Idempotency ledger error" % self)
+
+    def _acquire_rate_limit(self, email_message):
+        """
+        Waits until the rate limits allow the message to be sent, or raises
+        RateLimitExceeded.
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(getattr(self, 'host', None),
+                                      len(email_message.recipients()))
 
     def _send_message(self, email_message):
         raise NotImplementedError
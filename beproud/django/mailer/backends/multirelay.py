@@ -0,0 +1,240 @@
+"""
+SMTP email backend that spreads messages over several relays.
+
+Relays are configured with the EMAIL_RELAYS setting::
+
+    EMAIL_RELAYS = [
+        {'host': 'relay1.example.com', 'port': 25, 'weight': 2},
+        {'host': 'relay2.example.com', 'port': 25, 'weight': 1,
+         'username': 'user', 'password': 'secret', 'use_tls': True},
+    ]
+
+Each message goes to a relay picked at random in proportion to its weight,
+adjusted for the relay's observed latency and the number of messages in
+flight on it. A relay that fails to connect or answers with a 4xx error
+EMAIL_RELAY_MAX_FAILURES times in a row is marked down for
+EMAIL_RELAY_COOLOFF seconds, and the message is retried on another relay.
+"""
+
+import logging
+import random
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from beproud.django.mailer.backends.base import BaseEmailBackend
+from beproud.django.mailer.backends.smtp import EmailBackend as SMTPEmailBackend
+
+logger = logging.getLogger(getattr(settings, "EMAIL_LOGGER", ""))
+
+# Weight given to the newest sample in the latency moving average.
+LATENCY_DECAY = 0.3
+
+
+class RelayState(object):
+    """
+    Process-wide health and load statistics for a single relay.
+    """
+    def __init__(self):
+        self.failures = 0
+        self.down_until = 0
+        self.latency = None
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def is_up(self, now=None):
+        return (now or time.monotonic()) >= self.down_until
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def success(self, elapsed):
+        with self._lock:
+            self.in_flight -= 1
+            self.failures = 0
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += LATENCY_DECAY * (elapsed - self.latency)
+
+    def failure(self, max_failures, cooloff):
+        with self._lock:
+            self.in_flight -= 1
+            self.failures += 1
+            if self.failures >= max_failures:
+                self.down_until = time.monotonic() + cooloff
+                self.failures = 0
+                return True
+        return False
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+_relay_states = {}
+_relay_states_lock = threading.Lock()
+
+
+def get_relay_state(key):
+    with _relay_states_lock:
+        state = _relay_states.get(key)
+        if state is None:
+            state = _relay_states[key] = RelayState()
+    return state
+
+
+def reset_relay_states():
+    with _relay_states_lock:
+        _relay_states.clear()
+
+
+def _is_relay_failure(e):
+    """
+    Returns whether the error is the relay's fault and the message should
+    be retried on another relay: connection failures and 4xx replies.
+    """
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, resp in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return isinstance(e, OSError)
+
+
+class Relay(object):
+    def __init__(self, options):
+        options = dict(options)
+        self.weight = options.pop('weight', 1)
+        if 'host' not in options:
+            raise ImproperlyConfigured('EMAIL_RELAYS entries require a host: %r' % options)
+        self.options = options
+        self.key = (options['host'], options.get('port'), options.get('username'))
+        self.state = get_relay_state(self.key)
+
+    def score(self, mean_latency):
+        latency = self.state.latency or mean_latency or 1
+        return self.weight / (latency * (1 + self.state.in_flight))
+
+    def __repr__(self):
+        return '<Relay %s:%s>' % self.key[:2]
+
+
+class EmailBackend(BaseEmailBackend):
+    """
+    Sends each message through one of several SMTP relays, failing over to
+    the remaining relays inside the same ``send_messages()`` call.
+    """
+    success_code = 250
+
+    def __init__(self, relays=None, fail_silently=False, **kwargs):
+        super(EmailBackend, self).__init__(fail_silently=fail_silently)
+        relays = relays if relays is not None else getattr(settings, "EMAIL_RELAYS", None)
+        if not relays:
+            raise ImproperlyConfigured('The EMAIL_RELAYS setting must list at least one relay.')
+        self.relays = [Relay(relay) for relay in relays]
+        self.max_failures = getattr(settings, "EMAIL_RELAY_MAX_FAILURES", 3)
+        self.cooloff = getattr(settings, "EMAIL_RELAY_COOLOFF", 60)
+        self._backends = {}
+        self._lock = threading.RLock()
+        # Rate limits are applied by the relay backends, per relay host.
+        self.rate_limiter = None
+
+    def open(self):
+        # Connections are opened lazily per relay.
+        return False
+
+    def close(self):
+        """Closes the connections to every relay used."""
+        backends, self._backends = self._backends, {}
+        for backend in backends.values():
+            if backend.connection is not None:
+                try:
+                    backend.close()
+                except Exception:
+                    logger.debug("%s: Error closing relay connection" % self, exc_info=True)
+
+    def send_messages(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns the number of email
+        messages sent.
+        """
+        if not email_messages:
+            return
+        with self._lock:
+            try:
+                return super(EmailBackend, self).send_messages(email_messages)
+            finally:
+                self.close()
+
+    def send_messages_report(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns a SendReport with a
+        MessageResult for each message.
+        """
+        with self._lock:
+            try:
+                return super(EmailBackend, self).send_messages_report(email_messages)
+            finally:
+                self.close()
+
+    def _choose(self, tried):
+        now = time.monotonic()
+        candidates = [r for r in self.relays if r not in tried and r.state.is_up(now)]
+        if not candidates:
+            # Every relay left is cooling off. Trying one is better than
+            # giving up on the message.
+            candidates = [r for r in self.relays if r not in tried]
+        if not candidates:
+            return None
+        latencies = [r.state.latency for r in candidates if r.state.latency is not None]
+        mean_latency = sum(latencies) / len(latencies) if latencies else None
+        scores = [r.score(mean_latency) for r in candidates]
+        if not any(scores):
+            return random.choice(candidates)
+        return random.choices(candidates, scores)[0]
+
+    def _get_backend(self, relay):
+        backend = self._backends.get(relay)
+        if backend is None:
+            backend = self._backends[relay] = SMTPEmailBackend(fail_silently=False,
+                                                              **relay.options)
+        if backend.connection is None:
+            backend.open()
+        return backend
+
+    def _send_message(self, email_message):
+        tried = []
+        last_error = None
+        while True:
+            relay = self._choose(tried)
+            if relay is None:
+                raise last_error
+            tried.append(relay)
+            relay.state.begin()
+            start = time.monotonic()
+            try:
+                backend = self._get_backend(relay)
+                backend._acquire_rate_limit(email_message)
+                refused = backend._send_message(email_message)
+            except Exception as e:
+                if not _is_relay_failure(e):
+                    relay.state.release()
+                    raise
+                last_error = e
+                if relay.state.failure(self.max_failures, self.cooloff):
+                    logger.warning("%s: Marking %r down for %s seconds after: %s"
+                                   % (self, relay, self.cooloff, e))
+                backend = self._backends.pop(relay, None)
+                if backend is not None and backend.connection is not None:
+                    backend._mark_broken()
+                    try:
+                        backend.close()
+                    except Exception:
+                        pass
+                continue
+            relay.state.success(time.monotonic() - start)
+            return refused
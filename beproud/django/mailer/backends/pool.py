@@ -0,0 +1,194 @@
+"""Process-wide pool of authenticated SMTP connections."""
+
+import logging
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(getattr(settings, "EMAIL_LOGGER", ""))
+
+__all__ = (
+    'PoolTimeout',
+    'PooledConnection',
+    'SMTPConnectionPool',
+    'get_pool',
+    'close_pools',
+)
+
+
+class PoolTimeout(smtplib.SMTPException):
+    """Raised when no pooled connection became available in time."""
+
+
+class PooledConnection(object):
+    """
+    An SMTP connection owned by a pool along with its bookkeeping.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = self.last_used = time.monotonic()
+        self.num_sent = 0
+        # Set by the borrower when the connection failed in a way that
+        # makes it unusable (e.g. the server hung up).
+        self.broken = False
+
+
+class SMTPConnectionPool(object):
+    """
+    A thread-safe pool of SMTP connections.
+
+    ``connect`` is a callable returning a new, authenticated
+    ``smtplib.SMTP`` instance. At most ``size`` connections are open at
+    once. Connections are health checked with NOOP when they are checked
+    out and are recycled once they are older than ``max_age`` seconds or
+    have sent ``max_messages`` messages. Connections left idle for longer
+    than ``idle_timeout`` seconds are closed.
+    """
+    def __init__(self, connect, size=10, max_age=None, max_messages=None,
+                 idle_timeout=None, timeout=None):
+        self._connect = connect
+        self.size = size
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = []
+        self._num_open = 0
+        self._cond = threading.Condition()
+
+    def checkout(self):
+        """
+        Returns a healthy ``PooledConnection``, opening a new connection
+        if none are idle, or blocking until one is checked in if the pool
+        is full.
+        """
+        self.reap()
+        while True:
+            pooled = self._acquire()
+            if pooled is None:
+                try:
+                    return PooledConnection(self._connect())
+                except Exception:
+                    self._release_slot()
+                    raise
+            if self._is_usable(pooled):
+                return pooled
+            self._discard(pooled)
+
+    def checkin(self, pooled):
+        """
+        Returns a connection to the pool. Broken or expired connections
+        are closed instead.
+        """
+        pooled.last_used = time.monotonic()
+        if pooled.broken or self._is_expired(pooled, pooled.last_used):
+            self._discard(pooled)
+        else:
+            with self._cond:
+                self._idle.append(pooled)
+                self._cond.notify()
+        self.reap()
+
+    def reap(self):
+        """Closes connections that have been idle for too long."""
+        if self.idle_timeout is None:
+            return
+        now = time.monotonic()
+        with self._cond:
+            stale = [p for p in self._idle if now - p.last_used > self.idle_timeout]
+            if not stale:
+                return
+            self._idle = [p for p in self._idle if p not in stale]
+        for pooled in stale:
+            self._discard(pooled)
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self._discard(pooled)
+
+    def _acquire(self):
+        """
+        Pops an idle connection, or reserves a slot for a new connection
+        and returns None.
+        """
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    # LIFO so that surplus connections go idle and get reaped.
+                    return self._idle.pop()
+                if self._num_open < self.size:
+                    self._num_open += 1
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout("Timed out waiting for an SMTP connection")
+                self._cond.wait(remaining)
+
+    def _release_slot(self):
+        with self._cond:
+            self._num_open -= 1
+            self._cond.notify()
+
+    def _is_expired(self, pooled, now):
+        if self.max_age is not None and now - pooled.created > self.max_age:
+            return True
+        if self.max_messages is not None and pooled.num_sent >= self.max_messages:
+            return True
+        return False
+
+    def _is_usable(self, pooled):
+        if self._is_expired(pooled, time.monotonic()):
+            return False
+        try:
+            return pooled.connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _discard(self, pooled):
+        try:
+            pooled.connection.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                pooled.connection.close()
+            except Exception:
+                logger.debug("Error closing pooled SMTP connection", exc_info=True)
+        finally:
+            self._release_slot()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, connect):
+    """
+    Returns the process-wide pool for ``key``, creating it with the
+    EMAIL_SMTP_POOL_* settings if needed.
+    """
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SMTPConnectionPool(
+                connect,
+                size=getattr(settings, "EMAIL_SMTP_POOL_SIZE", 0),
+                max_age=getattr(settings, "EMAIL_SMTP_POOL_MAX_AGE", 300),
+                max_messages=getattr(settings, "EMAIL_SMTP_POOL_MAX_MESSAGES", 100),
+                idle_timeout=getattr(settings, "EMAIL_SMTP_POOL_IDLE_TIMEOUT", 60),
+                timeout=getattr(settings, "EMAIL_SMTP_POOL_TIMEOUT", 30),
+            )
+    return pool
+
+
+def close_pools():
+    """Closes the idle connections of every pool and forgets the pools."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
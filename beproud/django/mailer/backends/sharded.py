@@ -0,0 +1,230 @@
+"""
+Email backend that groups messages by recipient domain and delivers the
+domains in parallel, each with its own concurrency and rate limits.
+
+Limits are configured with the EMAIL_DOMAIN_LIMITS setting::
+
+    EMAIL_DOMAIN_LIMITS = {
+        'docomo.ne.jp': {'concurrency': 1, 'rate': 2},
+        'ezweb.ne.jp': {'concurrency': 2, 'rate': 5},
+    }
+    EMAIL_DOMAIN_DEFAULT_LIMITS = {'concurrency': 4, 'rate': None}
+
+``concurrency`` is the number of connections opened for the domain and
+``rate`` the maximum number of messages per second sent to it, or a rate
+such as '100/m' (None for no limit). A domain also matches the limits of its parent domains, so
+'ezweb.ne.jp' applies to 'sub.ezweb.ne.jp' as well.
+
+Messages are delivered through the backend named by EMAIL_SHARDED_BACKEND,
+the SMTP backend by default. A message with recipients in several domains
+is sent once per domain.
+"""
+
+import copy
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+from beproud.django.mailer.backends.base import BaseEmailBackend
+from beproud.django.mailer.ratelimit import TokenBucket, get_store
+from beproud.django.mailer.results import MessageResult, SendReport
+
+logger = logging.getLogger(getattr(settings, "EMAIL_LOGGER", ""))
+
+DEFAULT_LIMITS = {'concurrency': 4, 'rate': None}
+
+
+def get_domain(address):
+    """Returns the lower-cased domain of an email address."""
+    return parseaddr(address)[1].rpartition('@')[2].lower()
+
+
+def get_domain_limits(domain):
+    """
+    Returns the limits for the domain, taken from the closest matching
+    entry in EMAIL_DOMAIN_LIMITS or from EMAIL_DOMAIN_DEFAULT_LIMITS.
+    """
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(getattr(settings, "EMAIL_DOMAIN_DEFAULT_LIMITS", {}))
+    domain_limits = getattr(settings, "EMAIL_DOMAIN_LIMITS", {})
+    parts = domain.split('.')
+    for i in range(len(parts)):
+        name = '.'.join(parts[i:])
+        if name in domain_limits:
+            limits.update(domain_limits[name])
+            break
+    return limits
+
+
+class DomainShard(object):
+    """The messages queued for a single recipient domain."""
+    def __init__(self, domain):
+        self.domain = domain
+        self.limits = get_domain_limits(domain)
+        self.queue = deque()
+        # Paces the domain's messages evenly, shared by every worker and,
+        # depending on EMAIL_RATE_LIMIT_STORE, every process.
+        rate = self.limits.get('rate')
+        self.bucket = None
+        if rate:
+            self.bucket = TokenBucket('domain:%s' % domain, rate, capacity=1, store=get_store())
+
+    @property
+    def concurrency(self):
+        return max(1, min(self.limits.get('concurrency') or 1, len(self.queue)))
+
+    def __repr__(self):
+        return '<DomainShard %s>' % self.domain
+
+
+class EmailBackend(BaseEmailBackend):
+    """
+    Splits messages by recipient domain and delivers the domains in
+    parallel so that a slow or throttled domain does not hold up the rest
+    of the batch.
+    """
+    def __init__(self, fail_silently=False, backend=None, max_workers=None, **kwargs):
+        super(EmailBackend, self).__init__(fail_silently=fail_silently)
+        self.backend = backend or getattr(settings, "EMAIL_SHARDED_BACKEND",
+                                          'beproud.django.mailer.backends.smtp.EmailBackend')
+        self.max_workers = max_workers or getattr(settings, "EMAIL_SHARDED_MAX_WORKERS", 16)
+        self.backend_kwargs = kwargs
+        self._lock = threading.RLock()
+        # Rate limits are applied by the backends used for each domain.
+        self.rate_limiter = None
+
+    def send_messages(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns the number of email
+        messages sent.
+        """
+        if not email_messages:
+            return
+        errors = []
+        report = self._send_sharded(email_messages, errors=errors)
+        if errors and not self.fail_silently:
+            raise errors[0]
+        return report.num_sent
+
+    def send_messages_report(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns a SendReport with a
+        MessageResult for each message.
+        """
+        return self._send_sharded(email_messages)
+
+    def _split(self, email_messages):
+        """
+        Returns the domain shards for the messages, in the order the domains
+        were first seen, and a list of the parts each message was split into.
+        """
+        shards = OrderedDict()
+        parts = []
+        for index, email_message in enumerate(email_messages):
+            by_domain = OrderedDict()
+            for recipient in email_message.recipients():
+                by_domain.setdefault(get_domain(recipient), []).append(recipient)
+            parts.append([])
+            for domain, recipients in by_domain.items():
+                if len(by_domain) == 1:
+                    part = email_message
+                else:
+                    part = copy.copy(email_message)
+                    part.envelope_recipients = recipients
+                shard = shards.get(domain)
+                if shard is None:
+                    shard = shards[domain] = DomainShard(domain)
+                shard.queue.append((index, part))
+                parts[index].append(part)
+        return list(shards.values()), parts
+
+    def _send_sharded(self, email_messages, errors=None):
+        report = SendReport()
+        if not email_messages:
+            return report
+        with self._lock:
+            shards, parts = self._split(email_messages)
+            results = {}
+            # When failing loudly, stop taking new messages after the first
+            # error. Messages already being sent to other domains complete.
+            stop = threading.Event() if errors is not None and not self.fail_silently else None
+
+            # Start the first worker of every domain before the second
+            # worker of any, so each domain gets a thread even when
+            # max_workers is smaller than the total concurrency.
+            workers = []
+            for i in range(max([s.concurrency for s in shards] or [0])):
+                workers.extend(s for s in shards if s.concurrency > i)
+            if workers:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(workers))) as executor:
+                    for future in [executor.submit(self._worker, shard, results, errors, stop)
+                                   for shard in workers]:
+                        future.result()
+
+        for email_message, message_parts in zip(email_messages, parts):
+            report.append(self._merge_results(
+                email_message, [results.get(id(part)) for part in message_parts]))
+        return report
+
+    def _worker(self, shard, results, errors, stop):
+        backend = None
+        opened = False
+        try:
+            while stop is None or not stop.is_set():
+                try:
+                    index, part = shard.queue.popleft()
+                except IndexError:
+                    break
+                if backend is None:
+                    backend = get_connection(self.backend, fail_silently=False,
+                                             **self.backend_kwargs)
+                    try:
+                        opened = backend.open()
+                    except Exception:
+                        # Each message then reports the connection error.
+                        logger.debug("%s: Error connecting for %r" % (self, shard),
+                                     exc_info=True)
+                if shard.bucket is not None:
+                    shard.bucket.consume()
+                result = backend.send_messages_report([part])[0]
+                results[id(part)] = result
+                if result.exception is not None and errors is not None:
+                    errors.append(result.exception)
+                    if stop is not None:
+                        stop.set()
+        finally:
+            if opened:
+                try:
+                    backend.close()
+                except Exception:
+                    logger.debug("%s: Error closing connection for %r" % (self, shard),
+                                 exc_info=True)
+
+    def _merge_results(self, email_message, results):
+        """Combines the results of the parts of a message into one result."""
+        if not results:
+            # The message had no recipients.
+            return MessageResult(email_message)
+        if len(results) == 1 and results[0] is not None:
+            return results[0]
+        sent = [r for r in results if r is not None]
+        accepted = []
+        refused = {}
+        for result in sent:
+            accepted.extend(result.accepted)
+            refused.update(result.refused)
+        exceptions = [r.exception for r in sent if r.exception is not None]
+        merged = MessageResult(
+            email_message,
+            accepted=accepted,
+            code=next((r.code for r in sent if r.code is not None), None),
+            elapsed=max([r.elapsed or 0 for r in sent] or [0]),
+            exception=exceptions[0] if exceptions and not accepted else None,
+        )
+        merged.refused = refused
+        return merged
@@ -1,6 +1,7 @@
 """SMTP email backend class."""
 
 import logging
+import re
 import smtplib
 import socket
 import threading
@@ -9,16 +10,155 @@ from django.conf import settings
 from django.core.mail import DNS_NAME
 
 from beproud.django.mailer.backends.base import BaseEmailBackend
+from beproud.django.mailer.results import MessageResult, SendReport
+from beproud.django.mailer.backends.pool import get_pool
 
 logger = logging.getLogger(getattr(settings, "EMAIL_LOGGER", ""))
 
+CRLF = b'\r\n'
+_leading_period_re = re.compile(br'(?m)^\.')
+
+
+def quote_data(data):
+    """
+    Dot-stuffs the message data and appends the end of data marker.
+    """
+    data = _leading_period_re.sub(b'..', data)
+    if data[-2:] != CRLF:
+        data += CRLF
+    return data + b'.' + CRLF
+
+
+def message_bytes(email_message):
+    """
+    Returns the wire bytes of the message, using the cached bytes of
+    bpmailer's EmailMessage when available.
+    """
+    if hasattr(email_message, 'message_bytes'):
+        return email_message.message_bytes()
+    return email_message.message().as_bytes(linesep='\r\n')
+
+
+def message_data(email_message, eightbit=None):
+    """
+    Returns the wire bytes of the message, or a stream object with a
+    write_to() method when the message is written out while it is sent.
+    eightbit chooses the transfer encoding of utf-8 text, see
+    EmailMessage.message().
+    """
+    if hasattr(email_message, 'message_stream'):
+        return email_message.message_stream(eightbit=eightbit)
+    return message_bytes(email_message)
+
+
+class DataWriter(object):
+    """
+    A file-like object that dot-stuffs message data on the fly and sends it
+    to the connection in buffer_size writes, ending it with the end of data
+    marker on close(). Lines that span writes are stuffed correctly.
+    """
+    buffer_size = 64 * 1024
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.at_line_start = True
+        self.tail = b''
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        for start in range(0, len(data), self.buffer_size):
+            chunk = data[start:start + self.buffer_size]
+            if self.at_line_start and chunk[:1] == b'.':
+                chunk = b'.' + chunk
+            chunk = chunk.replace(b'\n.', b'\n..')
+            self.at_line_start = chunk[-1:] == b'\n'
+            self.tail = (self.tail + chunk[-2:])[-2:]
+            self._buffer.append(chunk)
+            self._buffered += len(chunk)
+            if self._buffered >= self.buffer_size:
+                self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.connection.send(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        """Ends the data and returns the server's reply."""
+        if self.tail != CRLF:
+            self._buffer.append(CRLF)
+        self._buffer.append(b'.' + CRLF)
+        self.flush()
+        return self.connection.getreply()
+
+
+class ChunkWriter(object):
+    """
+    A file-like object that sends message data with BDAT (RFC 3030) in
+    chunks of about buffer_size, without dot-stuffing. With PIPELINING the
+    replies to the chunks are read after the last chunk is sent. Once the
+    server rejects a chunk the rest of the data is discarded.
+    """
+    buffer_size = 64 * 1024
+
+    def __init__(self, connection, pipelining=False):
+        self.connection = connection
+        self.pipelining = pipelining
+        self.error = None
+        self._buffer = []
+        self._buffered = 0
+        self._pending = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self, last=False):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self.error is not None or not (data or last):
+            return
+        self.connection.send(b'BDAT %d%s\r\n' % (len(data), b' LAST' if last else b''))
+        self.connection.send(data)
+        self._pending += 1
+        if not (self.pipelining and not last):
+            self._read_replies()
+
+    def _read_replies(self):
+        while self._pending:
+            self._pending -= 1
+            reply = self.connection.getreply()
+            if reply[0] != 250 and self.error is None:
+                self.error = reply
+            self.reply = reply
+
+    def close(self):
+        """Sends the last chunk and returns the server's reply."""
+        self.flush(last=True)
+        return self.error or self.reply
+
+
+def _reset(connection):
+    """Aborts the current mail transaction, ignoring a dropped connection."""
+    try:
+        connection.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
 
 class EmailBackend(BaseEmailBackend):
     """
     A wrapper that manages the SMTP network connection.
     """
+    success_code = 250
+
     def __init__(self, host=None, port=None, username=None, password=None,
-                 use_tls=None, fail_silently=False, **kwargs):
+                 use_tls=None, use_pipelining=None, fail_silently=False, **kwargs):
         super(EmailBackend, self).__init__(fail_silently=fail_silently)
         self.host = host or settings.EMAIL_HOST
         self.port = port or settings.EMAIL_PORT
@@ -28,9 +168,38 @@ class EmailBackend(BaseEmailBackend):
             self.use_tls = settings.EMAIL_USE_TLS
         else:
             self.use_tls = use_tls
+        if use_pipelining is None:
+            self.use_pipelining = getattr(settings, "EMAIL_USE_PIPELINING", True)
+        else:
+            self.use_pipelining = use_pipelining
+        self.use_8bitmime = getattr(settings, "EMAIL_USE_8BITMIME", False)
+        self.use_chunking = getattr(settings, "EMAIL_USE_CHUNKING", True)
         self.connection = None
+        # When EMAIL_SMTP_POOL_SIZE is set, connections are borrowed from a
+        # process-wide pool instead of being opened and closed per batch.
+        self.use_pool = bool(getattr(settings, "EMAIL_SMTP_POOL_SIZE", 0))
+        self._pooled = None
         self._lock = threading.RLock()
 
+    def _connect(self):
+        """
+        Opens and returns a new authenticated connection to the email server.
+        """
+        # If local_hostname is not specified, socket.getfqdn() gets used.
+        # For performance, we use the cached FQDN for local_hostname.
+        connection = smtplib.SMTP(self.host, self.port,
+                                  local_hostname=DNS_NAME.get_fqdn())
+        if self.use_tls:
+            connection.ehlo()
+            connection.starttls()
+            connection.ehlo()
+        if self.username and self.password:
+            connection.login(self.username, self.password)
+        return connection
+
+    def _get_pool(self):
+        return get_pool((self.host, self.port, self.username, self.use_tls), self._connect)
+
     def open(self):
         """
         Ensures we have a connection to the email server. Returns whether or
@@ -40,23 +209,27 @@ class EmailBackend(BaseEmailBackend):
             # Nothing to do if the connection is already open.
             return False
         try:
-            # If local_hostname is not specified, socket.getfqdn() gets used.
-            # For performance, we use the cached FQDN for local_hostname.
-            self.connection = smtplib.SMTP(self.host, self.port,
-                                           local_hostname=DNS_NAME.get_fqdn())
-            if self.use_tls:
-                self.connection.ehlo()
-                self.connection.starttls()
-                self.connection.ehlo()
-            if self.username and self.password:
-                self.connection.login(self.username, self.password)
+            self._open_connection()
             return True
         except:
             if not self.fail_silently:
                 raise
 
+    def _open_connection(self):
+        if self.use_pool:
+            self._pooled = self._get_pool().checkout()
+            self.connection = self._pooled.connection
+        else:
+            self.connection = self._connect()
+
     def close(self):
         """Closes the connection to the email server."""
+        if self._pooled is not None:
+            # Hand the connection back to the pool rather than closing it.
+            pooled, self._pooled = self._pooled, None
+            self.connection = None
+            self._get_pool().checkin(pooled)
+            return
         try:
             try:
                 self.connection.quit()
@@ -85,21 +258,183 @@ class EmailBackend(BaseEmailBackend):
                 # We failed silently on open().
                 # Trying to send would be pointless.
                 return
-            num_sent = 0
-            for message in email_messages:
-                sent = self._send_message_wrapper(message)
-                if sent:
-                    num_sent += 1
-            if new_conn_created:
-                self.close()
+            try:
+                num_sent = 0
+                for message in email_messages:
+                    sent = self._send_message_wrapper(message)
+                    if sent:
+                        num_sent += 1
+            finally:
+                # Also on errors, so that a pooled connection is always
+                # checked back in.
+                if new_conn_created:
+                    self.close()
         finally:
             self._lock.release()
         return num_sent
 
+    def send_messages_report(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns a SendReport with a
+        MessageResult for each message.
+        """
+        with self._lock:
+            if self.connection is None and email_messages:
+                # Open the connection here so that a failure to connect is
+                # reported against every message even when failing silently.
+                try:
+                    self._open_connection()
+                except Exception as e:
+                    from beproud.django.mailer.api import log_exception
+                    log_exception("%s: Mail Error" % self)
+                    return SendReport(MessageResult(m, exception=e) for m in email_messages)
+                try:
+                    return super(EmailBackend, self).send_messages_report(email_messages)
+                finally:
+                    self.close()
+            return super(EmailBackend, self).send_messages_report(email_messages)
+
     def _send_message(self, email_message):
-        """A helper method that does the actual sending."""
-        self.connection.sendmail(
-            email_message.from_email,
-            email_message.recipients(),
-            email_message.message().as_string(),
-        )
+        """
+        A helper method that does the actual sending. Returns a dictionary
+        of the recipients refused by the server.
+        """
+        try:
+            self.connection.ehlo_or_helo_if_needed()
+            eightbit = self._transfer_mode()
+            refused = self._sendmail(
+                email_message.from_email,
+                email_message.recipients(),
+                message_data(email_message, eightbit=eightbit),
+            )
+        except smtplib.SMTPServerDisconnected:
+            self._mark_broken()
+            raise
+        except smtplib.SMTPException:
+            # The server refused the message; the connection itself is fine.
+            raise
+        except socket.error:
+            self._mark_broken()
+            raise
+        if self._pooled is not None:
+            self._pooled.num_sent += 1
+        if refused:
+            logger.warning("%s: Recipients refused: %r" % (self, refused))
+        return refused
+
+    def _transfer_mode(self):
+        """
+        Chooses the transfer encoding of utf-8 text from what the server of
+        this connection supports: 8bit if it has 8BITMIME and
+        EMAIL_USE_8BITMIME is set, base64 if it lacks 8BITMIME, otherwise the
+        configured encoding.
+        """
+        if not self.connection.has_extn('8bitmime'):
+            return False
+        return True if self.use_8bitmime else None
+
+    def _sendmail(self, from_addr, to_addrs, msg):
+        """
+        Performs a mail transaction like smtplib.SMTP.sendmail(). When the
+        server supports PIPELINING (RFC 2920), MAIL FROM, every RCPT TO and
+        DATA are sent in a single write and the replies are read in bulk.
+        When it supports CHUNKING (RFC 3030) the message is sent with BDAT
+        instead of DATA. ``msg`` is either bytes or a stream object whose
+        write_to() writes the message to the connection as it is produced.
+        """
+        connection = self.connection
+        connection.ehlo_or_helo_if_needed()
+        pipelining = self.use_pipelining and connection.has_extn('pipelining')
+        chunking = self.use_chunking and connection.has_extn('chunking')
+        streaming = hasattr(msg, 'write_to')
+
+        mail_options = []
+        # Streams whose content isn't known up front are declared 8bit.
+        is_ascii = getattr(msg, 'is_ascii', None) if streaming else msg.isascii()
+        if connection.has_extn('8bitmime') and not is_ascii:
+            mail_options.append('BODY=8BITMIME')
+        if connection.has_extn('smtputf8') and not all(
+                addr.isascii() for addr in [from_addr] + list(to_addrs)):
+            mail_options.append('SMTPUTF8')
+        if not (pipelining or streaming or chunking):
+            return connection.sendmail(from_addr, to_addrs, msg, mail_options)
+
+        if connection.has_extn('size'):
+            size = msg.size if streaming else len(msg)
+            if size is not None:
+                mail_options.insert(0, 'size=%d' % size)
+        if 'SMTPUTF8' in mail_options:
+            # Like smtplib, send the rest of the session's commands as utf-8.
+            connection.command_encoding = 'utf-8'
+        mail_command = 'mail FROM:%s%s' % (
+            smtplib.quoteaddr(from_addr), ''.join(' ' + option for option in mail_options))
+        rcpt_commands = ['rcpt TO:%s' % smtplib.quoteaddr(addr) for addr in to_addrs]
+
+        refused = {}
+        data_reply = None
+        if pipelining:
+            commands = [mail_command] + rcpt_commands
+            if not chunking:
+                commands.append('data')
+            connection.send(''.join('%s\r\n' % command for command in commands))
+            mail_reply = connection.getreply()
+            for addr in to_addrs:
+                code, resp = connection.getreply()
+                if code not in (250, 251):
+                    refused[addr] = (code, resp)
+            if not chunking:
+                data_reply = connection.getreply()
+        else:
+            # Without PIPELINING each command waits for its reply, and the
+            # transaction stops at the first command that fails.
+            connection.putcmd(mail_command)
+            mail_reply = connection.getreply()
+            if mail_reply[0] == 250:
+                for addr, command in zip(to_addrs, rcpt_commands):
+                    connection.putcmd(command)
+                    code, resp = connection.getreply()
+                    if code not in (250, 251):
+                        refused[addr] = (code, resp)
+                if len(refused) < len(to_addrs) and not chunking:
+                    connection.putcmd('data')
+                    data_reply = connection.getreply()
+
+        accepted = mail_reply[0] == 250 and len(refused) < len(to_addrs)
+        if data_reply is not None and data_reply[0] == 354 and not accepted:
+            # The server should not accept DATA without a sender and a
+            # recipient, but if it does end the transaction with no content.
+            connection.send(b'.\r\n')
+            connection.getreply()
+            data_reply = (503, b'No valid recipients')
+        if not accepted or (data_reply is not None and data_reply[0] != 354):
+            replies = [mail_reply, data_reply or (0, b'')] + list(refused.values())
+            if any(code == 421 for code, resp in replies):
+                connection.close()
+            else:
+                _reset(connection)
+            if mail_reply[0] != 250:
+                raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+            if len(refused) == len(to_addrs):
+                raise smtplib.SMTPRecipientsRefused(refused)
+            raise smtplib.SMTPDataError(*data_reply)
+
+        if chunking:
+            writer = ChunkWriter(connection, pipelining=pipelining)
+        else:
+            writer = DataWriter(connection)
+        if streaming:
+            msg.write_to(writer)
+        else:
+            writer.write(msg)
+        code, resp = writer.close()
+        if code != 250:
+            if code == 421:
+                connection.close()
+            else:
+                _reset(connection)
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def _mark_broken(self):
+        if self._pooled is not None:
+            self._pooled.broken = True
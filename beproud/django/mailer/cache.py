@@ -0,0 +1,92 @@
+#:coding=utf-8:
+"""
+A small thread-safe in-process LRU cache.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = (
+    'LRUCache',
+)
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    A least recently used cache bounded by the number of entries and/or the
+    total size of the values.
+
+    * max_entries   -- The maximum number of entries, or None for no limit.
+    * max_bytes     -- The maximum total size of the values, as measured by
+                       sizeof, or None for no limit. Values larger than this
+                       are not stored at all.
+    * ttl           -- The number of seconds an entry is kept, or None to
+                       keep entries until they are evicted.
+    * sizeof        -- A function returning the size of a value. Defaults
+                       to len().
+    """
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, sizeof=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _missing)
+            if entry is not _missing and entry[2] is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = _missing
+            if entry is _missing:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while ((self.max_entries is not None and len(self._entries) > self.max_entries)
+                   or (self.max_bytes is not None and self.size > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _remove(self, key):
+        value, size, expires = self._entries.pop(key)
+        self.size -= size
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<LRUCache entries=%s size=%s hits=%s misses=%s>' % (
+            len(self), self.size, self.hits, self.misses)
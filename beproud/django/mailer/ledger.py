@@ -0,0 +1,215 @@
+#:coding=utf-8:
+"""
+An idempotency ledger of delivered messages.
+
+When EMAIL_IDEMPOTENCY_STORE is set, the backends record each message they
+deliver and skip a message that was already delivered to the same
+recipients, for example by a task that is retried after the relay accepted
+the message but before the task finished. A message is identified by its
+``idempotency_key`` attribute if it has one, otherwise by its Message-ID.
+
+Entries expire after EMAIL_IDEMPOTENCY_TTL seconds. They are kept in an
+SQLite file shared by the processes of one host ('sqlite'), in a Django
+cache ('cache') or in the DeliveryRecord model ('db').
+"""
+import datetime
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from beproud.django.mailer.signals import mail_pre_send
+
+__all__ = (
+    'SQLiteLedger',
+    'CacheLedger',
+    'DatabaseLedger',
+    'get_ledger',
+    'ledger_key',
+    'idempotency_scope',
+)
+
+
+def ledger_key(message):
+    """
+    Returns the ledger key of the message: its idempotency key or
+    Message-ID combined with its envelope recipients, so that sending the
+    message again to other recipients is not taken for a duplicate.
+    """
+    key = getattr(message, 'idempotency_key', None) or getattr(message, 'message_id', None)
+    if key is None:
+        return None
+    data = '%s\n%s' % (key, '\n'.join(sorted(message.recipients())))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+_scope = threading.local()
+
+
+@contextmanager
+def idempotency_scope(prefix):
+    """
+    While active, messages sent by this thread without an idempotency key
+    are given one made of the prefix and their position, in the order they
+    are sent. Running the same code again in a scope with the same prefix,
+    as a retried task does, gives the messages the same keys.
+    """
+    previous = getattr(_scope, 'state', None)
+    _scope.state = [prefix, 0]
+    try:
+        yield
+    finally:
+        _scope.state = previous
+
+
+def _assign_key(sender, message, **kwargs):
+    state = getattr(_scope, 'state', None)
+    if state is None or getattr(message, 'idempotency_key', None):
+        return
+    message.idempotency_key = '%s:%d' % (state[0], state[1])
+    state[1] += 1
+
+
+mail_pre_send.connect(_assign_key, weak=False)
+
+
+class BaseLedger(object):
+    # Expired entries are deleted every purge_interval additions.
+    purge_interval = 1000
+
+    def __init__(self, ttl=86400):
+        self.ttl = ttl
+        self._added = 0
+
+    def contains(self, key):
+        """Whether the key was added and has not expired."""
+        raise NotImplementedError
+
+    def add(self, key):
+        """Records the key until it expires."""
+        self._add(key)
+        self._added += 1
+        if self._added % self.purge_interval == 0:
+            self.purge()
+
+    def _add(self, key):
+        raise NotImplementedError
+
+    def purge(self):
+        """Deletes the expired entries."""
+        pass
+
+
+class SQLiteLedger(BaseLedger):
+    """Keys in an SQLite file shared by the processes of one host."""
+    def __init__(self, path, ttl=86400):
+        super(SQLiteLedger, self).__init__(ttl)
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # SQLite connections can't be shared between threads.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS ledger '
+                               '(key TEXT PRIMARY KEY, expires REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ledger_expires ON ledger (expires)')
+            self._local.connection = connection
+        return connection
+
+    def contains(self, key):
+        row = self.connection.execute('SELECT 1 FROM ledger WHERE key = ? AND expires > ?',
+                                      (key, time.time())).fetchone()
+        return row is not None
+
+    def _add(self, key):
+        self.connection.execute('INSERT OR REPLACE INTO ledger (key, expires) VALUES (?, ?)',
+                                (key, time.time() + self.ttl))
+
+    def purge(self):
+        self.connection.execute('DELETE FROM ledger WHERE expires <= ?', (time.time(),))
+
+
+class CacheLedger(BaseLedger):
+    """Keys in a Django cache, which expires them by itself."""
+    def __init__(self, alias='default', ttl=86400, prefix='bpmailer:ledger:'):
+        super(CacheLedger, self).__init__(ttl)
+        self.alias = alias
+        self.prefix = prefix
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def contains(self, key):
+        return self.cache.get(self.prefix + key) is not None
+
+    def _add(self, key):
+        self.cache.set(self.prefix + key, 1, self.ttl)
+
+
+class DatabaseLedger(BaseLedger):
+    """Keys in the DeliveryRecord model."""
+    def __init__(self, using='default', ttl=86400):
+        super(DatabaseLedger, self).__init__(ttl)
+        self.using = using
+
+    @property
+    def records(self):
+        from beproud.django.mailer.models import DeliveryRecord
+        return DeliveryRecord.objects.using(self.using)
+
+    def contains(self, key):
+        from django.utils import timezone
+        return self.records.filter(key=key, expires__gt=timezone.now()).exists()
+
+    def _add(self, key):
+        from django.utils import timezone
+        expires = timezone.now() + datetime.timedelta(seconds=self.ttl)
+        self.records.update_or_create(key=key, defaults={'expires': expires})
+
+    def purge(self):
+        from django.utils import timezone
+        self.records.filter(expires__lte=timezone.now()).delete()
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_ledger():
+    """
+    Returns the ledger named by the EMAIL_IDEMPOTENCY_STORE setting, or None
+    if delivered messages are not recorded.
+    """
+    name = getattr(settings, "EMAIL_IDEMPOTENCY_STORE", None)
+    if not name:
+        return None
+    ttl = getattr(settings, "EMAIL_IDEMPOTENCY_TTL", 86400)
+    if name == 'sqlite':
+        key = (name, getattr(settings, "EMAIL_IDEMPOTENCY_FILE",
+                             os.path.join(tempfile.gettempdir(), 'bpmailer-ledger.sqlite3')), ttl)
+        factory = SQLiteLedger
+    elif name == 'cache':
+        key = (name, getattr(settings, "EMAIL_IDEMPOTENCY_CACHE", 'default'), ttl)
+        factory = CacheLedger
+    elif name == 'db':
+        key = (name, getattr(settings, "EMAIL_IDEMPOTENCY_DATABASE", 'default'), ttl)
+        factory = DatabaseLedger
+    else:
+        raise ImproperlyConfigured('Unknown EMAIL_IDEMPOTENCY_STORE: %r' % (name,))
+    with _ledgers_lock:
+        ledger = _ledgers.get(key)
+        if ledger is None:
+            ledger = _ledgers[key] = factory(key[1], ttl)
+    return ledger
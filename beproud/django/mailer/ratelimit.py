@@ -0,0 +1,342 @@
+#:coding=utf-8:
+"""
+Token bucket rate limiting for outbound mail.
+
+Limits are configured with the EMAIL_RATE_LIMITS and EMAIL_HOST_RATE_LIMITS
+settings, in the same "count/period" format as Celery's rate_limit::
+
+    EMAIL_RATE_LIMITS = {'messages': '10/s', 'recipients': '600/m'}
+    EMAIL_HOST_RATE_LIMITS = {
+        'smtp.example.com': {'messages': '5/s'},
+    }
+
+Each limit is a token bucket holding up to ``count`` tokens and refilled at
+``count / period`` tokens per second. The bucket state lives in a store
+shared by every thread of the process ('local'), by every process on the
+host through a locked file ('file'), or by every process using the same
+Django cache ('cache'), as chosen by EMAIL_RATE_LIMIT_STORE.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+__all__ = (
+    'RateLimitExceeded',
+    'parse_rate',
+    'LocalStore',
+    'FileStore',
+    'CacheStore',
+    'get_store',
+    'TokenBucket',
+    'RateLimiter',
+    'get_rate_limiter',
+)
+
+PERIODS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 60 * 60 * 24,
+}
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised instead of blocking when sending now would exceed a rate limit.
+    ``retry_after`` is the number of seconds to wait before trying again.
+    """
+    def __init__(self, retry_after):
+        super(RateLimitExceeded, self).__init__(
+            'Rate limit exceeded, retry after %.2f seconds' % retry_after)
+        self.retry_after = retry_after
+
+
+def parse_rate(rate):
+    """
+    Parses a rate such as '10/s', '600/m' or 10 (per second) and returns a
+    (count, period in seconds) two tuple.
+    """
+    if isinstance(rate, (int, float)):
+        return rate, 1
+    if isinstance(rate, (tuple, list)):
+        return rate[0], rate[1]
+    count, _, period = str(rate).partition('/')
+    try:
+        return float(count), PERIODS[(period or 's')[0]]
+    except (KeyError, ValueError):
+        raise ImproperlyConfigured('Invalid rate limit: %r' % (rate,))
+
+
+class BaseStore(object):
+    """
+    Holds the state of token buckets as {key: [tokens, timestamp]}.
+    Subclasses implement _transaction() to give exclusive access to it, or
+    to yield None if it could not be locked in time.
+    """
+    # Seconds to wait before trying again when the state is locked.
+    lock_wait = 0.1
+
+    @contextmanager
+    def _transaction(self, keys):
+        raise NotImplementedError
+
+    def consume(self, requests, now=None):
+        """
+        Takes tokens from several buckets at once. ``requests`` is a list of
+        (key, rate, capacity, tokens) tuples. The tokens are taken from every
+        bucket only if all of them have enough; returns 0 in that case, or
+        the number of seconds until they will otherwise.
+        """
+        now = time.time() if now is None else now
+        with self._transaction([r[0] for r in requests]) as state:
+            if state is None:
+                return self.lock_wait
+            wait = 0
+            levels = {}
+            for key, rate, capacity, tokens in requests:
+                level, timestamp = state.get(key) or (capacity, now)
+                level = min(capacity, level + max(0, now - timestamp) * rate)
+                levels[key] = level
+                # A request larger than the bucket waits for a full bucket.
+                needed = min(tokens, capacity)
+                if level < needed:
+                    wait = max(wait, (needed - level) / rate)
+            if wait:
+                return wait
+            for key, rate, capacity, tokens in requests:
+                state[key] = [levels[key] - min(tokens, capacity), now]
+        return 0
+
+
+class LocalStore(BaseStore):
+    """Bucket state shared by the threads of one process."""
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _transaction(self, keys):
+        with self._lock:
+            yield self._state
+
+    def clear(self):
+        with self._lock:
+            self._state.clear()
+
+
+class FileStore(BaseStore):
+    """Bucket state shared by the processes of one host through a locked file."""
+    def __init__(self, path):
+        if fcntl is None:
+            raise ImproperlyConfigured('The file rate limit store requires fcntl.')
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _transaction(self, keys):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), 'r+') as f:
+                    try:
+                        state = json.loads(f.read() or '{}')
+                    except ValueError:
+                        state = {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+            finally:
+                os.close(fd)
+
+
+class CacheStore(BaseStore):
+    """Bucket state shared through a Django cache."""
+    lock_timeout = 5
+
+    def __init__(self, alias='default', prefix='bpmailer:ratelimit:', timeout=3600):
+        self.alias = alias
+        self.prefix = prefix
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    @contextmanager
+    def _transaction(self, keys):
+        cache = self.cache
+        lock_key = self.prefix + 'lock'
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_timeout
+        # cache.add() only succeeds for one client at a time. The lock
+        # expires by itself, so a client that died holding it can't stall
+        # the others for longer than lock_timeout.
+        while not cache.add(lock_key, token, self.lock_timeout):
+            if time.monotonic() > deadline:
+                # Leave the state alone rather than race the lock holder.
+                yield None
+                return
+            time.sleep(0.005)
+        try:
+            cache_keys = dict((self.prefix + key, key) for key in keys)
+            state = dict((cache_keys[k], v) for k, v in cache.get_many(list(cache_keys)).items())
+            yield state
+            if cache.get(lock_key) == token:
+                cache.set_many(dict((self.prefix + k, v) for k, v in state.items()),
+                               self.timeout)
+        finally:
+            # The lock may have expired and been taken by another client.
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+
+_local_store = LocalStore()
+_file_stores = {}
+_file_stores_lock = threading.Lock()
+
+
+def get_store():
+    """Returns the store named by the EMAIL_RATE_LIMIT_STORE setting."""
+    name = getattr(settings, "EMAIL_RATE_LIMIT_STORE", 'local')
+    if name == 'local':
+        return _local_store
+    if name == 'file':
+        path = getattr(settings, "EMAIL_RATE_LIMIT_FILE",
+                       os.path.join(tempfile.gettempdir(), 'bpmailer-ratelimit.json'))
+        with _file_stores_lock:
+            store = _file_stores.get(path)
+            if store is None:
+                store = _file_stores[path] = FileStore(path)
+        return store
+    if name == 'cache':
+        return CacheStore(getattr(settings, "EMAIL_RATE_LIMIT_CACHE", 'default'))
+    raise ImproperlyConfigured('Unknown EMAIL_RATE_LIMIT_STORE: %r' % (name,))
+
+
+def _wait(try_acquire, block, max_wait):
+    """
+    Calls try_acquire() until it succeeds, sleeping in between, or raises
+    RateLimitExceeded if not blocking or the wait would exceed max_wait.
+    Returns the number of seconds waited.
+    """
+    waited = 0
+    while True:
+        wait = try_acquire()
+        if not wait:
+            return waited
+        if not block or (max_wait is not None and waited + wait > max_wait):
+            raise RateLimitExceeded(wait)
+        time.sleep(wait)
+        waited += wait
+
+
+class TokenBucket(object):
+    """A single token bucket refilled at ``rate`` ('count/period')."""
+    def __init__(self, key, rate, capacity=None, store=None):
+        count, period = parse_rate(rate)
+        self.key = key
+        self.rate = float(count) / period
+        self.capacity = capacity if capacity is not None else count
+        self.store = store or _local_store
+
+    def try_consume(self, tokens=1):
+        """
+        Takes tokens without waiting. Returns 0 if they were taken, otherwise
+        the number of seconds until they will be available.
+        """
+        return self.store.consume([(self.key, self.rate, self.capacity, tokens)])
+
+    def consume(self, tokens=1, block=True, max_wait=None):
+        """
+        Takes tokens, waiting for them if block is True, and returns the number
+        of seconds waited. Raises RateLimitExceeded otherwise.
+        """
+        return _wait(lambda: self.try_consume(tokens), block, max_wait)
+
+
+class RateLimiter(object):
+    """
+    Applies the global and per-host message and recipient limits to
+    outgoing messages.
+
+    * limits        -- A dictionary with 'messages' and/or 'recipients' rates
+                       applied to every message.
+    * host_limits   -- A dictionary mapping SMTP host names to the same kind
+                       of dictionary, applied to messages sent to that host.
+    * store         -- The bucket store. Defaults to the process local store.
+    * block         -- Whether acquire() waits for tokens (True) or raises
+                       RateLimitExceeded (False).
+    * max_wait      -- When blocking, the longest acquire() waits before
+                       raising RateLimitExceeded instead.
+    """
+    def __init__(self, limits=None, host_limits=None, store=None, block=True, max_wait=None):
+        self.limits = limits or {}
+        self.host_limits = host_limits or {}
+        self.store = store or _local_store
+        self.block = block
+        self.max_wait = max_wait
+
+    def _requests(self, host, recipients):
+        requests = []
+        scopes = [('global', self.limits)]
+        if host is not None and host in self.host_limits:
+            scopes.append(('host:%s' % host, self.host_limits[host]))
+        for scope, limits in scopes:
+            for kind, tokens in (('messages', 1), ('recipients', recipients)):
+                if limits.get(kind) is None:
+                    continue
+                count, period = parse_rate(limits[kind])
+                requests.append(('%s:%s' % (scope, kind), float(count) / period, count, tokens))
+        return requests
+
+    def try_acquire(self, host=None, recipients=1):
+        """
+        Takes the tokens for one message to ``recipients`` recipients sent
+        through ``host`` without waiting. Returns 0 if they were taken,
+        otherwise the number of seconds until they will be available.
+        """
+        requests = self._requests(host, recipients)
+        if not requests:
+            return 0
+        return self.store.consume(requests)
+
+    def acquire(self, host=None, recipients=1, block=None):
+        """
+        Takes the tokens for one message, waiting for them or raising
+        RateLimitExceeded, and returns the number of seconds waited.
+        """
+        block = self.block if block is None else block
+        return _wait(lambda: self.try_acquire(host, recipients), block, self.max_wait)
+
+
+def get_rate_limiter():
+    """
+    Returns a RateLimiter configured from the settings, or None if no
+    limits are set.
+    """
+    limits = getattr(settings, "EMAIL_RATE_LIMITS", None)
+    host_limits = getattr(settings, "EMAIL_HOST_RATE_LIMITS", None)
+    if not limits and not host_limits:
+        return None
+    return RateLimiter(
+        limits=limits,
+        host_limits=host_limits,
+        store=get_store(),
+        block=getattr(settings, "EMAIL_RATE_LIMIT_BLOCK", True),
+        max_wait=getattr(settings, "EMAIL_RATE_LIMIT_MAX_WAIT", None),
+    )
@@ -0,0 +1,446 @@
+#:coding=utf-8:
+"""
+Rendering of mail templates.
+
+Templates are looked up and compiled once per name and kept in a
+process-wide cache, so sending many messages from the same template only
+renders it. The cache is on unless DEBUG is True, and can be turned on or
+off with the EMAIL_TEMPLATE_CACHE setting.
+
+Rendered text can also be memoized, keyed by the template name and the
+context, when the EMAIL_RENDER_CACHE setting names a store: 'local' for
+an LRU cache in each process or 'cache' for the Django cache shared by
+every node. Only contexts made of plain JSON-like values (str, int, float,
+bool, None, lists, tuples and dicts with str keys) are memoized; any other
+context, such as one holding model instances, is always rendered.
+"""
+import hashlib
+import json
+import re
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template import defaultfilters
+from django.template.base import FilterExpression, Node, NodeList, Variable, VariableNode
+from django.template.defaulttags import FilterNode, SpacelessNode
+from django.template.loader import get_template, select_template
+from django.template.loader_tags import ExtendsNode, IncludeNode
+from django.template.smartif import TokenBase
+from django.utils import timezone, translation
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+
+from beproud.django.mailer.cache import LRUCache
+from beproud.django.mailer.templatetags.mailer_tags import replace_newlines
+
+__all__ = (
+    'TemplateCache',
+    'get_template_cache',
+    'get_mail_template',
+    'render_template',
+    'split_message',
+    'context_key',
+    'LocalRenderStore',
+    'CacheRenderStore',
+    'get_render_store',
+    'MergeTemplate',
+)
+
+
+class TemplateCache(object):
+    """
+    Compiled templates by name, with hit and miss counters.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get(self, template_name):
+        key = _cache_key(template_name)
+        template = self._templates.get(key)
+        if template is not None:
+            self.hits += 1
+            return template
+        template = _load_template(template_name)
+        with self._lock:
+            self.misses += 1
+            self._templates[key] = template
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __contains__(self, template_name):
+        return _cache_key(template_name) in self._templates
+
+    def __len__(self):
+        return len(self._templates)
+
+    def __repr__(self):
+        return '<TemplateCache templates=%s hits=%s misses=%s>' % (
+            len(self), self.hits, self.misses)
+
+
+def _cache_key(template_name):
+    if isinstance(template_name, (list, tuple)):
+        return tuple(template_name)
+    return template_name
+
+
+def _load_template(template_name):
+    # Like render_to_string(), a list of names loads the first that exists.
+    if isinstance(template_name, (list, tuple)):
+        return select_template(template_name)
+    return get_template(template_name)
+
+
+_template_cache = TemplateCache()
+
+_newline_re = re.compile(r'\r\n|\r|\n')
+
+
+def get_template_cache():
+    """Returns the process-wide TemplateCache."""
+    return _template_cache
+
+
+@receiver(setting_changed)
+def _clear_template_cache(setting, **kwargs):
+    if setting in ('TEMPLATES', 'INSTALLED_APPS'):
+        _template_cache.clear()
+        for store in _render_stores.values():
+            if isinstance(store, LocalRenderStore):
+                store.clear()
+
+
+def get_mail_template(template_name):
+    """
+    Returns the compiled template, from the cache if it is enabled.
+    template_name may be a list of names, of which the first that exists
+    is used.
+    """
+    if getattr(settings, "EMAIL_TEMPLATE_CACHE", not settings.DEBUG):
+        return _template_cache.get(template_name)
+    return _load_template(template_name)
+
+
+_plain_types = (str, int, float, bool, type(None))
+
+
+def _is_plain(value):
+    # Exact types only: str subclasses such as SafeString render differently
+    # from str, and arbitrary objects may change between renders.
+    if type(value) in _plain_types:
+        return True
+    if type(value) in (list, tuple):
+        return all(_is_plain(v) for v in value)
+    if type(value) is dict:
+        return all(type(k) is str and _is_plain(v) for k, v in value.items())
+    return False
+
+
+def context_key(template_name, context):
+    """
+    Returns a stable key for rendering the template with the context in the
+    active language and time zone, or None if the context can't be hashed
+    reliably.
+    """
+    if not _is_plain(context):
+        return None
+    tzname = timezone.get_current_timezone_name() if settings.USE_TZ else None
+    data = json.dumps([template_name, context, translation.get_language(), tzname],
+                      sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class LocalRenderStore(object):
+    """Rendered text in a size-bounded LRU cache in this process."""
+    def __init__(self, max_entries=1000, ttl=300):
+        self.cache = LRUCache(max_entries=max_entries, ttl=ttl)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, text):
+        self.cache.set(key, text)
+
+    def clear(self):
+        self.cache.clear()
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+
+class CacheRenderStore(object):
+    """Rendered text in a Django cache, shared by every process using it."""
+    def __init__(self, alias='default', ttl=300, prefix='bpmailer:render:'):
+        self.alias = alias
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def get(self, key):
+        text = self.cache.get(self.prefix + key)
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+    def set(self, key, text):
+        self.cache.set(self.prefix + key, text, self.ttl)
+
+
+_render_stores = {}
+_render_stores_lock = threading.Lock()
+
+
+def get_render_store():
+    """
+    Returns the store named by the EMAIL_RENDER_CACHE setting, or None if
+    rendered text is not memoized.
+    """
+    name = getattr(settings, "EMAIL_RENDER_CACHE", None)
+    if not name:
+        return None
+    ttl = getattr(settings, "EMAIL_RENDER_CACHE_TTL", 300)
+    if name == 'local':
+        key = (name, getattr(settings, "EMAIL_RENDER_CACHE_SIZE", 1000), ttl)
+        factory = LocalRenderStore
+    elif name == 'cache':
+        key = (name, getattr(settings, "EMAIL_RENDER_CACHE_ALIAS", 'default'), ttl)
+        factory = CacheRenderStore
+    else:
+        raise ImproperlyConfigured('Unknown EMAIL_RENDER_CACHE: %r' % (name,))
+    with _render_stores_lock:
+        store = _render_stores.get(key)
+        if store is None:
+            store = _render_stores[key] = factory(key[1], ttl)
+    return store
+
+
+def render_template(template_name, context):
+    """
+    Renders the named template with the context dictionary, reusing the
+    text rendered earlier for an equal context if EMAIL_RENDER_CACHE is set.
+    """
+    store = get_render_store()
+    key = context_key(template_name, context) if store is not None else None
+    if key is not None:
+        text = store.get(key)
+        if text is not None:
+            return text
+    text = get_mail_template(template_name).render(context)
+    if key is not None:
+        store.set(key, text)
+    return text
+
+
+def split_message(text):
+    """
+    Splits rendered mail text into the subject, the first line, and the body,
+    the rest of the text, with line endings normalized to \\n.
+    """
+    # Only the subject line is scanned for the first line break, and the
+    # body is copied once.
+    match = _newline_re.search(text)
+    if match is None:
+        return text, ''
+    body = text[match.end():]
+    if '\r' in body:
+        body = body.replace('\r\n', '\n').replace('\r', '\n')
+    return text[:match.start()], body
+
+
+class MergeField(object):
+    """
+    Stands in for a merge field while a MergeTemplate is rendered. It
+    renders as a marker and records any other use, such as attribute
+    lookups or truth tests, which the skeleton can't reproduce.
+    """
+    def __init__(self, merge_template, index):
+        self._merge_template = merge_template
+        self._index = index
+
+    def __str__(self):
+        self._merge_template.outputs += 1
+        return '\x00%s&%d\x00' % (self._merge_template.token, self._index)
+
+    def _misused(self, *args, **kwargs):
+        self._merge_template.misused = True
+        raise TypeError('Merge fields can only be output as they are.')
+
+    def __getattr__(self, name):
+        if not name.startswith('__'):
+            self._merge_template.misused = True
+        raise AttributeError(name)
+
+    __bool__ = __len__ = __iter__ = __getitem__ = __contains__ = _misused
+    __eq__ = __ne__ = __lt__ = __le__ = __gt__ = __ge__ = _misused
+    __int__ = __float__ = _misused
+    __hash__ = object.__hash__
+
+
+# Filters that leave a merge field as it is, apart from escaping it.
+_merge_filters = (defaultfilters.escape_filter, defaultfilters.force_escape,
+                  defaultfilters.safe)
+# Filters of a {% filter %} block that leave merge field values, which have
+# no line breaks, as they are.
+_merge_block_filters = _merge_filters + (replace_newlines,)
+
+
+def _plain_fields(template, fields):
+    """
+    Whether the compiled template only outputs the fields as they are, as
+    in {{ field }}, optionally with |escape or |safe, and uses them nowhere
+    else.
+    """
+    nodelist = getattr(getattr(template, 'template', None), 'nodelist', None)
+    if nodelist is None:
+        return False
+    return _check_fields(nodelist, set(fields), False, set())
+
+
+def _refers_to(var, fields):
+    return isinstance(var, Variable) and bool(var.lookups) and var.lookups[0] in fields
+
+
+def _attributes(obj):
+    values = list(getattr(obj, '__dict__', {}).values())
+    for cls in type(obj).__mro__:
+        slots = cls.__dict__.get('__slots__', ())
+        for name in ((slots,) if isinstance(slots, str) else slots):
+            if name != '__dict__' and hasattr(obj, name):
+                values.append(getattr(obj, name))
+    return values
+
+
+def _check_fields(obj, fields, filtered, seen):
+    # filtered is True inside a block whose output is changed as a whole.
+    if id(obj) in seen:
+        return True
+    seen.add(id(obj))
+    if isinstance(obj, VariableNode) and _refers_to(obj.filter_expression.var, fields):
+        expression = obj.filter_expression
+        return (not filtered and len(expression.var.lookups) == 1
+                and all(func in _merge_filters and not args
+                        for func, args in expression.filters))
+    if isinstance(obj, Variable):
+        return not _refers_to(obj, fields)
+    if isinstance(obj, IncludeNode):
+        # The included template can't be checked before it is rendered.
+        return False
+    if isinstance(obj, ExtendsNode):
+        parent = obj.parent_name
+        if not isinstance(parent.var, str) or parent.filters:
+            return False
+        if not _check_fields(get_template(parent.var).template.nodelist, fields, filtered, seen):
+            return False
+    if isinstance(obj, FilterNode):
+        filtered = filtered or not all(func in _merge_block_filters
+                                       for func, args in obj.filter_expr.filters)
+    elif isinstance(obj, SpacelessNode):
+        filtered = True
+    if isinstance(obj, (list, tuple)):
+        children = obj
+    elif isinstance(obj, dict):
+        children = obj.values()
+    elif isinstance(obj, (Node, NodeList, FilterExpression, TokenBase)):
+        children = _attributes(obj)
+    else:
+        return True
+    return all(_check_fields(child, fields, filtered, seen) for child in children)
+
+
+class MergeTemplate(object):
+    """
+    A template rendered once with the shared context into a skeleton in
+    which the merge fields are filled in for each recipient by fill().
+
+    Each place a field is output is recorded as escaped or not, so fill()
+    escapes values only where the template would have. If the template
+    uses a field in any other way, for example in an {% if %} tag or with a
+    filter other than |escape or |safe, ``valid`` is False and the template
+    must be rendered in full instead.
+    """
+    def __init__(self, template, context, fields):
+        self.fields = list(fields)
+        if not _plain_fields(template, self.fields):
+            self.valid = False
+            self.parts = []
+            return
+        # Mixed case, so that case changing filters always alter a marker.
+        self.token = 'mM' + uuid.uuid4().hex[:12]
+        self.outputs = 0
+        self.misused = False
+        full_context = dict(context)
+        for index, name in enumerate(self.fields):
+            full_context[name] = MergeField(self, index)
+        try:
+            text = template.render(full_context)
+        except TypeError:
+            if not self.misused:
+                raise
+            text = ''
+        marker_re = re.compile('\x00%s(&|&amp;)(\\d+)\x00' % self.token)
+        pieces = marker_re.split(text)
+        # Every output must have come through as a marker, in case a
+        # custom tag changed one; that leaves a different count or a stray
+        # NUL.
+        self.valid = (not self.misused and len(pieces) // 3 == self.outputs
+                      and not any('\x00' in piece for piece in pieces[::3]))
+        self.parts = []
+        if self.valid:
+            for i, piece in enumerate(pieces):
+                if i % 3 == 0:
+                    self.parts.append(piece)
+                elif i % 3 == 1:
+                    escaped = piece == '&amp;'
+                else:
+                    self.parts.append((int(piece), escaped))
+
+    def can_fill(self, context):
+        """
+        Whether fill() gives the same text as a full render for the
+        context: it must set exactly the merge fields, to strings without
+        line breaks or to integers.
+        """
+        if not self.valid or len(context) != len(self.fields):
+            return False
+        for name in self.fields:
+            value = context.get(name, None)
+            if isinstance(value, str):
+                if '\n' in value or '\r' in value:
+                    return False
+            elif type(value) is not int:
+                return False
+        return True
+
+    def fill(self, context):
+        values = [localize(context[name]) for name in self.fields]
+        return ''.join(
+            part if isinstance(part, str)
+            else conditional_escape(values[part[0]]) if part[1]
+            else str(values[part[0]])
+            for part in self.parts
+        )
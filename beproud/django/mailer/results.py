@@ -0,0 +1,106 @@
+#:coding=utf-8:
+"""
+Per-message delivery results returned by ``send_messages_report()`` and
+``send_mass_mail(report=True)``.
+"""
+import smtplib
+
+__all__ = (
+    'MessageResult',
+    'SendReport',
+)
+
+
+class MessageResult(object):
+    """
+    The outcome of sending a single message.
+
+    * message     -- The EmailMessage that was sent.
+    * message_id  -- The Message-ID of the message, if known.
+    * accepted    -- The recipients accepted by the server.
+    * refused     -- A dictionary of refused recipients mapped to the
+                     (code, response) the server answered with.
+    * code        -- The SMTP reply code for the message, if known.
+    * elapsed     -- The number of seconds spent sending the message.
+    * exception   -- The exception raised when sending failed, else None.
+    * duplicate   -- True if the message was not sent because the
+                     idempotency ledger shows it was already delivered.
+    """
+    def __init__(self, message, accepted=None, refused=None, code=None,
+                 elapsed=None, exception=None, duplicate=False):
+        self.message = message
+        self.message_id = getattr(message, 'message_id', None)
+        self.accepted = accepted or []
+        self.refused = refused or {}
+        self.code = code
+        self.elapsed = elapsed
+        self.exception = exception
+        self.duplicate = duplicate
+        if isinstance(exception, smtplib.SMTPRecipientsRefused):
+            self.refused = dict(exception.recipients)
+            codes = set(code for code, resp in self.refused.values())
+            if code is None and len(codes) == 1:
+                self.code = codes.pop()
+        if code is None and isinstance(exception, smtplib.SMTPResponseException):
+            self.code = exception.smtp_code
+        if message is not None:
+            # Lets callers that only hold the message, such as the Celery
+            # tasks, see how sending it went.
+            message.last_result = self
+
+    @property
+    def sent(self):
+        """Whether the message was accepted for at least one recipient."""
+        return self.exception is None and bool(self.accepted)
+
+    def __repr__(self):
+        return '<MessageResult %s sent=%s code=%s refused=%r>' % (
+            self.message_id, self.sent, self.code, sorted(self.refused))
+
+
+class SendReport(object):
+    """
+    A list of MessageResult objects, one per message, in sending order.
+    """
+    def __init__(self, results=None):
+        self.results = list(results or [])
+
+    def append(self, result):
+        self.results.append(result)
+
+    def extend(self, results):
+        self.results.extend(results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+    @property
+    def num_sent(self):
+        return sum(1 for result in self.results if result.sent)
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.sent]
+
+    @property
+    def failed(self):
+        """Results for messages that were not sent to anyone."""
+        return [result for result in self.results if not result.sent]
+
+    @property
+    def refused(self):
+        """Results for sent messages where some recipients were refused."""
+        return [result for result in self.results if result.sent and result.refused]
+
+    def failed_messages(self):
+        """Returns the messages that should be sent again."""
+        return [result.message for result in self.failed if result.message.recipients()]
+
+    def __repr__(self):
+        return '<SendReport sent=%s failed=%s>' % (self.num_sent, len(self.failed))
@@ -1,10 +1,33 @@
 #:coding=utf-8:
+import base64
+import inspect
+import math
+import random
+import smtplib
+import threading
+import time
+import weakref
+import zlib
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+
+from celery import chord, uuid
 try:
     from celery import shared_task
 except ImportError:
     from celery.task import task as shared_task
+from celery.result import GroupResult
+from celery.signals import worker_process_shutdown
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.template import TemplateDoesNotExist, TemplateSyntaxError
 
 from beproud.django.mailer import api as mailer_api
+from beproud.django.mailer.ledger import idempotency_scope
+from beproud.django.mailer.ratelimit import RateLimitExceeded
+from beproud.django.mailer.results import SendReport
+from beproud.django.mailer.signals import mail_pre_send
 
 __all__ = (
     'send_mail',
@@ -13,88 +36,644 @@ __all__ = (
     'mail_managers',
     'mail_managers_template',
     'mail_admins',
+    'send_mail_batched',
+    'send_raw_mail',
+    'send_template_mail_prerendered',
+    'message_payload',
+    'send_campaign',
+    'send_campaign_chunk',
+    'campaign_report',
+    'WorkerConnection',
+    'worker_connection',
+    'MailBatcher',
+    'mail_batcher',
 )
 
 
-@shared_task
-def send_mail(*args, **kwargs):
+class WorkerConnection(object):
+    """
+    A long-lived mail connection reused by the tasks run in a worker.
+
+    The connection is opened lazily by the first task that needs it and is
+    recycled after EMAIL_WORKER_CONNECTION_MAX_MESSAGES messages or
+    EMAIL_WORKER_CONNECTION_MAX_AGE seconds. Each worker thread gets its
+    own connection so that thread based pools don't share one SMTP session.
+    """
+    _instances = weakref.WeakSet()
+
+    def __init__(self):
+        self._local = threading.local()
+        self._instances.add(self)
+        self._all = []
+        self._all_lock = threading.Lock()
+
+    def get(self):
+        """Returns the open connection for this thread, (re)opening it if needed."""
+        local = self._local
+        connection = getattr(local, 'connection', None)
+        if connection is not None and (self._expired(local) or not self._alive(connection)):
+            self.close()
+            connection = None
+        if connection is None:
+            connection = mailer_api.get_connection()
+            connection.open()
+            local.connection = connection
+            local.opened = time.monotonic()
+            local.num_sent = 0
+            with self._all_lock:
+                self._all.append(connection)
+        return connection
+
+    def sent(self, num_sent):
+        """Records messages sent over this thread's connection."""
+        self._local.num_sent += num_sent or 0
+
+    def close(self):
+        """Closes this thread's connection."""
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            with self._all_lock:
+                if connection in self._all:
+                    self._all.remove(connection)
+            _close_quietly(connection)
+
+    def close_all(self):
+        """Closes the connections of every thread."""
+        with self._all_lock:
+            connections, self._all = self._all, []
+        self._local = threading.local()
+        for connection in connections:
+            _close_quietly(connection)
+
+    def _expired(self, local):
+        max_messages = getattr(settings, "EMAIL_WORKER_CONNECTION_MAX_MESSAGES", 100)
+        max_age = getattr(settings, "EMAIL_WORKER_CONNECTION_MAX_AGE", 300)
+        if max_messages is not None and local.num_sent >= max_messages:
+            return True
+        if max_age is not None and time.monotonic() - local.opened > max_age:
+            return True
+        return False
+
+    def _alive(self, connection):
+        # The relay may have dropped an SMTP session while the worker was
+        # idle, so check it before it is reused.
+        smtp = getattr(connection, 'connection', None)
+        if smtp is None or not hasattr(smtp, 'noop'):
+            return True
+        try:
+            return smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        mailer_api.logger.debug("Error closing worker mail connection", exc_info=True)
+
+
+worker_connection = WorkerConnection()
+
+
+class MailBatcher(object):
+    """
+    Collects the mails queued with the send_mail_batched task in a worker
+    process and sends them in batches over one connection.
+
+    A batch is sent when EMAIL_BATCH_MAX_SIZE mails have been collected, or
+    EMAIL_BATCH_MAX_WAIT seconds after its first mail arrived. Each mail of
+    a batch that can't be sent is retried on its own with the send_mail
+    task. Mails waiting in a batch are sent when the worker process shuts
+    down, but are lost if it is killed.
+    """
+    _instances = weakref.WeakSet()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._timer = None
+        self._instances.add(self)
+
+    def add(self, args, kwargs):
+        """Queues the send_mail() arguments, sending the batch if it is full."""
+        max_size = getattr(settings, "EMAIL_BATCH_MAX_SIZE", 100)
+        max_wait = getattr(settings, "EMAIL_BATCH_MAX_WAIT", 0.5)
+        with self._lock:
+            self._pending.append((args, kwargs))
+            if len(self._pending) < max_size:
+                if self._timer is None:
+                    self._timer = threading.Timer(max_wait, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            batch = self._take()
+        self._send(batch)
+
+    def flush(self):
+        """Sends the mails collected so far."""
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _send(self, batch):
+        # Mails for different SMTP credentials can't share a connection.
+        groups = {}
+        for args, kwargs in batch:
+            # The retry options are for the task, not for send_mail().
+            send_kwargs = dict((name, value) for name, value in kwargs.items()
+                               if name not in ('max_retries', 'retry_countdown'))
+            try:
+                arguments = inspect.signature(mailer_api.send_mail).bind(
+                    *args, **send_kwargs).arguments
+                options = dict((name, arguments.pop(name, None))
+                               for name in ('auth_user', 'auth_password', 'fail_silently'))
+                arguments.pop('connection', None)
+                message = mailer_api._build_mail(**arguments)
+            except Exception as e:
+                self._retry(args, kwargs, e)
+                continue
+            key = (options['auth_user'], options['auth_password'])
+            groups.setdefault(key, []).append((message, args, kwargs))
+
+        for (auth_user, auth_password), items in groups.items():
+            try:
+                connection = mailer_api.get_connection(username=auth_user, password=auth_password)
+                messages = [message for message, args, kwargs in items]
+                for message in messages:
+                    message.connection = connection
+                report = mailer_api._send_mass_mail_chunk(connection, messages, report=True)
+            except Exception as e:
+                mailer_api.log_exception("Mail Error")
+                for message, args, kwargs in items:
+                    self._retry(args, kwargs, e)
+                continue
+            for (message, args, kwargs), result in zip(items, report):
+                mailer_api.log_message(message, 1 if result.sent else 0)
+                if result.sent or isinstance(result.exception, smtplib.SMTPRecipientsRefused):
+                    if not kwargs.get('fail_silently'):
+                        _retry_refused(message, kwargs.get('max_retries', 3),
+                                       kwargs.get('retry_countdown', 10), 0)
+                else:
+                    self._retry(args, kwargs, result.exception)
+
+    def _retry(self, args, kwargs, exc):
+        max_retries = kwargs.get('max_retries', 3)
+        if kwargs.get('fail_silently') or not max_retries or _is_permanent(exc):
+            mailer_api.logger.error("Batched mail failed: %r", exc)
+            return
+        # The batch was the first attempt.
+        send_mail.apply_async(args, kwargs, retries=1,
+                              countdown=_countdown(exc, kwargs.get('retry_countdown', 10)))
+
+
+mail_batcher = MailBatcher()
+
+
+@worker_process_shutdown.connect
+def close_worker_connections(**kwargs):
+    for instance in list(MailBatcher._instances):
+        instance.flush()
+    for instance in list(WorkerConnection._instances):
+        instance.close_all()
+
+
+def _call(func, *args, **kwargs):
+    """
+    Calls the mailer API function, passing the worker's persistent
+    connection when EMAIL_WORKER_CONNECTION is enabled. Mails sent with
+    their own SMTP credentials get a connection of their own.
+    """
+    if not getattr(settings, "EMAIL_WORKER_CONNECTION", False) or 'connection' in kwargs:
+        return func(*args, **kwargs)
+    arguments = inspect.signature(func).bind_partial(*args, **kwargs).arguments
+    if arguments.get('auth_user') or arguments.get('auth_password'):
+        return func(*args, **kwargs)
+
+    connection = worker_connection.get()
+    # The connection outlives this call, so honour the caller's
+    # fail_silently on it rather than the one it was opened with.
+    connection.fail_silently = arguments.get('fail_silently', False)
+    try:
+        num_sent = func(*args, connection=connection, **kwargs)
+    except Exception:
+        # The connection may be in an unknown state; start afresh next time.
+        worker_connection.close()
+        raise
+    worker_connection.sent(len(num_sent) if isinstance(num_sent, SendReport) else num_sent)
+    return num_sent
+
+
+def _countdown(e, retry_countdown, retries=0):
+    """
+    Returns the countdown before the next retry: retry_countdown doubled for
+    each retry so far, up to EMAIL_RETRY_MAX_COUNTDOWN seconds, and then
+    randomly shortened by up to half so that tasks that failed together
+    don't all retry at once. When a rate limit was hit, waits at least as
+    long as the rate limiter asked for.
+    """
+    countdown = retry_countdown
+    if getattr(settings, "EMAIL_RETRY_BACKOFF", True):
+        countdown = retry_countdown * 2 ** retries
+    max_countdown = getattr(settings, "EMAIL_RETRY_MAX_COUNTDOWN", 600)
+    if max_countdown is not None:
+        countdown = min(countdown, max_countdown)
+    if getattr(settings, "EMAIL_RETRY_JITTER", True):
+        countdown = random.uniform(countdown / 2.0, countdown)
+    if isinstance(e, RateLimitExceeded):
+        countdown = max(countdown, e.retry_after)
+    return int(math.ceil(countdown))
+
+
+# Errors that sending the same mail again can't fix.
+_permanent_errors = (
+    TemplateDoesNotExist,
+    TemplateSyntaxError,
+    mailer_api.BadHeaderError,
+    UnicodeError,
+)
+
+
+def _is_permanent_code(code):
+    return code is not None and 500 <= code < 600
+
+
+def _is_permanent(e):
+    """
+    Whether the error is permanent: a 5xx SMTP reply, every recipient
+    refused with a 5xx reply, or an error building the message.
+    Connection errors, 4xx replies and unknown errors are transient.
+    """
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, response in e.recipients.values()]
+        return bool(codes) and all(_is_permanent_code(code) for code in codes)
+    if isinstance(e, smtplib.SMTPResponseException):
+        return _is_permanent_code(e.smtp_code)
+    return isinstance(e, _permanent_errors)
+
+
+_watching = threading.local()
+
+
+@contextmanager
+def _watch_messages():
+    """Collects the messages sent by this thread while active."""
+    previous = getattr(_watching, 'messages', None)
+    _watching.messages = messages = []
+    try:
+        yield messages
+    finally:
+        _watching.messages = previous
+
+
+@receiver(mail_pre_send)
+def _watch_message(sender, message, **kwargs):
+    messages = getattr(_watching, 'messages', None)
+    if messages is not None:
+        messages.append(message)
+
+
+def _retry_refused(message, max_retries, retry_countdown, retries):
+    """
+    Sends the message again, with the send_raw_mail task, to the recipients
+    that were refused with a transient (4xx) reply when it was last sent.
+    """
+    result = message.last_result
+    if result is None or not result.refused:
+        return
+    temporary = [r for r, (code, response) in result.refused.items()
+                 if not _is_permanent_code(code)]
+    permanent = [r for r in result.refused if r not in temporary]
+    if permanent:
+        mailer_api.logger.error("%s: Recipients refused permanently: %r",
+                                result.message_id, permanent)
+    if not temporary:
+        return
+    if retries >= max_retries:
+        mailer_api.logger.error("%s: Giving up on refused recipients: %r",
+                                result.message_id, temporary)
+        return
+    kwargs = message_payload(message)
+    kwargs.update(recipient_list=temporary, max_retries=max_retries,
+                  retry_countdown=retry_countdown)
+    send_raw_mail.apply_async(kwargs=kwargs, retries=retries + 1,
+                              countdown=_countdown(None, retry_countdown, retries))
+
+
+def _task_scope(task):
+    """
+    Returns an idempotency scope for the messages sent by the task. A task
+    function called directly has no id to tell its calls apart, so gets none.
+    """
+    if task.request.id is None:
+        return nullcontext()
+    return idempotency_scope('task:%s' % task.request.id)
+
+
+def _run(task, func, *args, **kwargs):
+    """
+    Runs the mailer API function for the task. Transient failures are
+    retried with backoff and permanent ones are logged and raised without
+    retrying, so that the task fails.
+    Recipients refused with a 4xx reply are retried on their own.
+    """
     max_retries = kwargs.pop('max_retries', 3)
     retry_countdown = kwargs.pop('retry_countdown', 10)
-    try:
-        mailer_api.send_mail(*args, **kwargs)
-    except Exception as e:
-        return send_mail.retry(
-            exc=e,
-            countdown=retry_countdown,
-            max_retries=max_retries,
-        )
+    retries = task.request.retries or 0
+    # Retries run in the same scope, so the idempotency ledger knows the
+    # messages an earlier attempt delivered.
+    with _watch_messages() as messages, _task_scope(task):
+        try:
+            _call(func, *args, **kwargs)
+        except Exception as e:
+            # When the only message was refused for every recipient, the
+            # refused recipients are retried below.
+            if not (len(messages) == 1 and isinstance(e, smtplib.SMTPRecipientsRefused)):
+                if _is_permanent(e):
+                    mailer_api.logger.error("Mail failed permanently, not retrying: %r", e)
+                    raise
+                return task.retry(
+                    exc=e,
+                    countdown=_countdown(e, retry_countdown, retries),
+                    max_retries=max_retries,
+                )
+
+    arguments = inspect.signature(func).bind_partial(*args, **kwargs).arguments
+    if arguments.get('fail_silently'):
+        return
+    for message in messages:
+        _retry_refused(message, max_retries, retry_countdown, retries)
+
+
+@shared_task
+def send_mail(*args, **kwargs):
+    return _run(send_mail, mailer_api.send_mail, *args, **kwargs)
 
 
 @shared_task
 def send_template_mail(*args, **kwargs):
-    max_retries = kwargs.pop('max_retries', 3)
-    retry_countdown = kwargs.pop('retry_countdown', 10)
-    try:
-        mailer_api.send_template_mail(*args, **kwargs)
-    except Exception as e:
-        return send_template_mail.retry(
-            exc=e,
-            countdown=retry_countdown,
-            max_retries=max_retries,
-        )
+    return _run(send_template_mail, mailer_api.send_template_mail, *args, **kwargs)
 
 
 @shared_task
 def send_mass_mail(*args, **kwargs):
-    max_retries = kwargs.pop('max_retries', 3)
-    retry_countdown = kwargs.pop('retry_countdown', 10)
-    try:
-        mailer_api.send_mass_mail(*args, **kwargs)
-    except Exception as e:
-        return send_mass_mail.retry(
-            exc=e,
-            countdown=retry_countdown,
-            max_retries=max_retries,
-        )
+    return _run(send_mass_mail, mailer_api.send_mass_mail, *args, **kwargs)
 
 
 @shared_task
 def mail_managers(*args, **kwargs):
-    max_retries = kwargs.pop('max_retries', 3)
-    retry_countdown = kwargs.pop('retry_countdown', 10)
-    try:
-        mailer_api.mail_managers(*args, **kwargs)
-    except Exception as e:
-        return mail_managers.retry(
-            exc=e,
-            countdown=retry_countdown,
-            max_retries=max_retries,
-        )
+    return _run(mail_managers, mailer_api.mail_managers, *args, **kwargs)
 
 
 @shared_task
 def mail_managers_template(*args, **kwargs):
-    max_retries = kwargs.pop('max_retries', 3)
-    retry_countdown = kwargs.pop('retry_countdown', 10)
-    try:
-        mailer_api.mail_managers_template(*args, **kwargs)
-    except Exception as e:
-        return mail_managers_template.retry(
-            exc=e,
-            countdown=retry_countdown,
-            max_retries=max_retries,
-        )
+    return _run(mail_managers_template, mailer_api.mail_managers_template, *args, **kwargs)
 
 
 @shared_task
 def mail_admins(*args, **kwargs):
+    return _run(mail_admins, mailer_api.mail_admins, *args, **kwargs)
+
+
+@shared_task
+def send_mail_batched(*args, **kwargs):
+    """
+    Takes the arguments of send_mail and sends the mail in a batch with the
+    other mails queued in this worker. See MailBatcher.
+    """
+    if send_mail_batched.request.id is not None:
+        kwargs.setdefault('idempotency_key', 'task:%s' % send_mail_batched.request.id)
+    mail_batcher.add(args, kwargs)
+
+
+def message_payload(message, compress=None):
+    """
+    Returns the arguments of the send_raw_mail task for the message: the
+    envelope and the serialized message, zlib compressed if compress (or
+    the EMAIL_TASK_COMPRESS setting) is True, and base64 encoded so that
+    any task serializer can carry it.
+    """
+    data = message.message_bytes()
+    if compress is None:
+        compress = getattr(settings, "EMAIL_TASK_COMPRESS", False)
+    if compress:
+        data = zlib.compress(data)
+    return {
+        'from_email': message.from_email,
+        'recipient_list': message.recipients(),
+        'data': base64.b64encode(data).decode('ascii'),
+        'compressed': bool(compress),
+    }
+
+
+def _decode_payload(data, compressed=False):
+    data = base64.b64decode(data)
+    if compressed:
+        data = zlib.decompress(data)
+    return data
+
+
+@shared_task
+def send_raw_mail(from_email, recipient_list, data, compressed=False, **kwargs):
+    """
+    Sends a message serialized by message_payload(). Retries send the same
+    bytes.
+    """
+    return _run(send_raw_mail, mailer_api.send_raw_mail, from_email, recipient_list,
+                _decode_payload(data, compressed), **kwargs)
+
+
+def send_template_mail_prerendered(template_name, from_email, recipient_list, extra_context={},
+                                   encoding=None, html_template_name=None, cc=None, bcc=None,
+                                   attachments=None, compress=None, **kwargs):
+    """
+    Renders and serializes the template mail in this process and queues the
+    bytes with the send_raw_mail task, so the worker only sends them.
+    Other keyword arguments, such as fail_silently or max_retries, are
+    passed to the task.
+    """
+    message = mailer_api._build_template_mail(
+        template_name, from_email, recipient_list, extra_context, encoding=encoding,
+        html_template_name=html_template_name, cc=cc, bcc=bcc, attachments=attachments)
+    kwargs.update(message_payload(message, compress))
+    return send_raw_mail.apply_async(kwargs=kwargs)
+
+
+def _campaign_rows(source, template_name=None, recipient_field='email'):
+    """
+    Yields the rows of a campaign from its source. With a template, a row is
+    a [recipient_list, context] pair; otherwise it is a send_mass_mail()
+    datatuple item.
+    """
+    if isinstance(source, str):
+        if template_name is None:
+            raise ValueError('A file of recipients needs a template_name.')
+        with open(source, encoding='utf-8') as f:
+            for line in f:
+                address = line.strip()
+                if address:
+                    yield [[address], {}]
+        return
+    if hasattr(source, 'values_list'):
+        if template_name is None:
+            raise ValueError('A QuerySet of recipients needs a template_name.')
+        # A QuerySet: only the addresses are read, in batches.
+        source = source.values_list(recipient_field, flat=True).iterator()
+    for item in source:
+        if template_name is None:
+            yield list(item)
+        elif isinstance(item, str):
+            yield [[item], {}]
+        else:
+            recipient_list, context = item
+            if isinstance(recipient_list, str):
+                recipient_list = [recipient_list]
+            yield [list(recipient_list), context or {}]
+
+
+def send_campaign(source, template_name=None, from_email=None, extra_context=None,
+                  html_template_name=None, merge_fields=None, chunk_size=None,
+                  recipient_field='email', report=False, **kwargs):
+    """
+    Sends a mass mailing as chunks of EMAIL_CAMPAIGN_CHUNK_SIZE messages,
+    each sent by a send_campaign_chunk task over its own connection, so
+    that the chunks are spread over the workers.
+
+    ``source`` is an iterable, a QuerySet whose ``recipient_field`` holds
+    the addresses, or the path of a file with one address per line. With
+    ``template_name`` the messages are rendered as by
+    send_template_mass_mail(), and the items of an iterable are addresses
+    or (recipient_list, context) pairs. Without it, the items are
+    send_mass_mail() datatuple items, and a QuerySet or file source raises
+    ValueError. Other keyword arguments, such as
+    fail_silently or max_retries, are passed to each chunk task.
+
+    By default each chunk is queued as soon as it is read from the source
+    and a GroupResult of the chunk tasks is returned, whose results can be
+    aggregated with campaign_report(). If report is True, the chunks are
+    run in a chord instead and the returned AsyncResult gives the
+    campaign_report(). A chord needs all of its tasks up front, so every
+    row of the source is held in memory while it is queued. Both need a
+    Celery result backend to collect the results.
+    """
+    if chunk_size is None:
+        chunk_size = getattr(settings, "EMAIL_CAMPAIGN_CHUNK_SIZE", 500)
+    if template_name is not None:
+        kwargs.update(template_name=template_name, from_email=from_email,
+                      extra_context=extra_context, html_template_name=html_template_name,
+                      merge_fields=merge_fields)
+    rows = _campaign_rows(source, template_name, recipient_field)
+
+    def _chunks():
+        index = 0
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            yield send_campaign_chunk.s(chunk, index=index, **kwargs)
+            index += 1
+
+    if report:
+        return chord(list(_chunks()))(campaign_report.s())
+    # Only the results are kept, so a chunk's rows can be freed once it is
+    # queued.
+    results = [chunk.apply_async() for chunk in _chunks()]
+    return GroupResult(uuid(), results, app=send_campaign_chunk.app)
+
+
+@shared_task
+def send_campaign_chunk(rows, index=0, template_name=None, from_email=None, extra_context=None,
+                        html_template_name=None, merge_fields=None, **kwargs):
+    """
+    Sends one chunk of a campaign and returns a summary of it: its index,
+    the numbers of messages sent, failed and skipped as duplicates, the
+    failed recipients and the seconds it took. The chunk is retried as a
+    whole only when every message in it failed with a transient error.
+    """
     max_retries = kwargs.pop('max_retries', 3)
     retry_countdown = kwargs.pop('retry_countdown', 10)
+    task = send_campaign_chunk
+    retries = task.request.retries or 0
+    started = time.time()
+    start = time.monotonic()
     try:
-        mailer_api.mail_admins(*args, **kwargs)
+        with _task_scope(task):
+            if template_name is not None:
+                result = _call(mailer_api.send_template_mass_mail, template_name, from_email,
+                               [tuple(row) for row in rows], extra_context=extra_context,
+                               html_template_name=html_template_name,
+                               merge_fields=merge_fields, report=True, **kwargs)
+            else:
+                result = _call(mailer_api.send_mass_mail, [tuple(row) for row in rows],
+                               report=True, **kwargs)
     except Exception as e:
-        return mail_admins.retry(
-            exc=e,
-            countdown=retry_countdown,
-            max_retries=max_retries,
-        )
+        if kwargs.get('fail_silently'):
+            mailer_api.logger.error("Campaign chunk %s failed: %r", index, e)
+            result = None
+        elif _is_permanent(e):
+            mailer_api.logger.error("Campaign chunk %s failed permanently, not retrying: %r",
+                                    index, e)
+            raise
+        else:
+            return task.retry(exc=e, countdown=_countdown(e, retry_countdown, retries),
+                              max_retries=max_retries)
+
+    if result is None:
+        # Rendering failed silently or permanently; nothing was sent.
+        result = SendReport()
+        failed = [recipient for row in rows
+                  for recipient in (row[0] if template_name is not None else row[3])]
+    else:
+        failed_results = result.failed
+        if (failed_results and len(failed_results) == len(result) and retries < max_retries
+                and not any(_is_permanent(r.exception) for r in failed_results)):
+            e = failed_results[0].exception
+            return task.retry(exc=e, countdown=_countdown(e, retry_countdown, retries),
+                              max_retries=max_retries)
+        failed = [recipient for r in failed_results for recipient in r.message.recipients()]
+        if not kwargs.get('fail_silently'):
+            for r in result.refused:
+                _retry_refused(r.message, max_retries, retry_countdown, retries)
+
+    return {
+        'index': index,
+        'sent': result.num_sent,
+        'failed': len(rows) - result.num_sent,
+        'duplicates': sum(1 for r in result if r.duplicate),
+        'failed_recipients': failed,
+        'started': started,
+        'finished': time.time(),
+        'elapsed': time.monotonic() - start,
+    }
+
+
+@shared_task
+def campaign_report(summaries):
+    """
+    Combines the summaries returned by the chunks of a campaign into one
+    report with the totals and the summary of each chunk. The chunks run in
+    parallel, so ``elapsed`` is the wall-clock time from the start of the
+    first chunk to the end of the last one.
+    """
+    chunks = sorted((s for s in summaries if s), key=lambda s: s['index'])
+    return {
+        'sent': sum(s['sent'] for s in chunks),
+        'failed': sum(s['failed'] for s in chunks),
+        'duplicates': sum(s['duplicates'] for s in chunks),
+        'failed_recipients': [r for s in chunks for r in s['failed_recipients']],
+        'elapsed': (max(s['finished'] for s in chunks) - min(s['started'] for s in chunks)
+                    if chunks else 0),
+        'chunks': chunks,
+    }
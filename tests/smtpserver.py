@@ -0,0 +1,154 @@
+"""
+A tiny asyncio based SMTP sink used by the SMTP backend tests.
+
+The sink runs its own event loop in a background thread and records every
+transaction it receives in ``SMTPSink.messages``.
+"""
+import asyncio
+import base64
+import threading
+
+
+class SMTPSink:
+    def __init__(self, extensions=('PIPELINING', '8BITMIME', 'AUTH PLAIN'),
+                 refuse=(), defer=(), delay=0):
+        self.extensions = list(extensions)
+        # Recipients refused with a permanent (550) or transient (450) error.
+        self.refuse = set(refuse)
+        self.defer = set(defer)
+        # Seconds to wait before answering DATA, to simulate a slow relay.
+        self.delay = delay
+        self.messages = []
+        self.commands = []
+        self.connections = 0
+        self.auth = []
+        self.host = '127.0.0.1'
+        self.port = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, 0))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+            pending = asyncio.all_tasks(self._loop)
+            for task in pending:
+                task.cancel()
+            self._loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True))
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+
+        def reply(line):
+            writer.write(line.encode('ascii') + b'\r\n')
+
+        reply('220 sink ESMTP')
+        mail_from, rcpt_tos, mail_options, chunks = None, [], [], []
+        while True:
+            await writer.drain()
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.rstrip(b'\r\n').decode('utf-8', 'surrogateescape')
+            verb, _, arg = line.partition(' ')
+            verb = verb.upper()
+            self.commands.append(' '.join(filter(None, [verb, arg])))
+            if verb == 'EHLO':
+                lines = ['sink'] + self.extensions
+                for ext in lines[:-1]:
+                    reply('250-' + ext)
+                reply('250 ' + lines[-1])
+            elif verb == 'HELO':
+                reply('250 sink')
+            elif verb == 'AUTH':
+                mechanism, _, initial = arg.partition(' ')
+                self.auth.append(base64.b64decode(initial).split(b'\0')[1:])
+                reply('235 Authentication successful')
+            elif verb == 'NOOP':
+                reply('250 OK')
+            elif verb == 'RSET':
+                mail_from, rcpt_tos, mail_options, chunks = None, [], [], []
+                reply('250 OK')
+            elif verb == 'MAIL':
+                address, _, options = arg[len('FROM:'):].lstrip().partition(' ')
+                mail_from = address.strip('<>')
+                mail_options = options.split()
+                reply('250 OK')
+            elif verb == 'RCPT':
+                address = arg[len('TO:'):].lstrip().split(' ')[0].strip('<>')
+                if address in self.refuse:
+                    reply('550 No such user')
+                elif address in self.defer:
+                    reply('450 Try again later')
+                else:
+                    rcpt_tos.append(address)
+                    reply('250 OK')
+            elif verb == 'DATA':
+                if not rcpt_tos:
+                    reply('503 No valid recipients')
+                    continue
+                reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    data_line = await reader.readline()
+                    if data_line == b'.\r\n':
+                        break
+                    if data_line.startswith(b'.'):
+                        data_line = data_line[1:]
+                    data.append(data_line)
+                await self._store(mail_from, rcpt_tos, mail_options, b''.join(data))
+                mail_from, rcpt_tos, mail_options = None, [], []
+                reply('250 OK queued')
+            elif verb == 'BDAT':
+                size, _, last = arg.partition(' ')
+                chunks.append(await reader.readexactly(int(size)))
+                if last.upper() == 'LAST':
+                    await self._store(mail_from, rcpt_tos, mail_options, b''.join(chunks))
+                    mail_from, rcpt_tos, mail_options, chunks = None, [], [], []
+                    reply('250 OK queued')
+                else:
+                    reply('250 OK chunk received')
+            elif verb == 'QUIT':
+                reply('221 Bye')
+                await writer.drain()
+                break
+            else:
+                reply('502 Command not implemented')
+        writer.close()
+
+    async def _store(self, mail_from, rcpt_tos, mail_options, data):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.messages.append({
+            'mail_from': mail_from,
+            'rcpt_tos': rcpt_tos,
+            'mail_options': mail_options,
+            'data': data,
+        })
@@ -0,0 +1,62 @@
+import time
+
+from django.test import TestCase as DjangoTestCase
+
+from beproud.django.mailer.cache import LRUCache
+
+__all__ = (
+    'LRUCacheTestCase',
+)
+
+
+class LRUCacheTestCase(DjangoTestCase):
+
+    def test_get_set(self):
+        cache = LRUCache()
+        cache.set('a', 'value')
+
+        self.assertEqual(cache.get('a'), 'value')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_max_entries(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_bytes=10)
+        cache.set('a', b'12345')
+        cache.set('b', b'12345')
+        cache.set('c', b'123')
+
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 8)
+
+        cache.set('d', b'12345678901')
+        self.assertNotIn('d', cache)
+        self.assertEqual(cache.size, 8)
+
+    def test_replace(self):
+        cache = LRUCache(max_bytes=10)
+        cache.set('a', b'12345')
+        cache.set('a', b'123')
+
+        self.assertEqual(cache.size, 3)
+        self.assertEqual(cache.get('a'), b'123')
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.05)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+        time.sleep(0.06)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
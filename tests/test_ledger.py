@@ -0,0 +1,228 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.core import mail as django_mail
+from django.test import TestCase as DjangoTestCase
+from django.test import override_settings
+
+from beproud.django.mailer import EmailMessage, send_mail, send_mass_mail
+from beproud.django.mailer import ledger
+from beproud.django.mailer import tasks as mailer_tasks
+from beproud.django.mailer.backends import asyncsmtp
+from beproud.django.mailer.ledger import (
+    CacheLedger,
+    DatabaseLedger,
+    SQLiteLedger,
+    idempotency_scope,
+    ledger_key,
+)
+from beproud.django.mailer.models import DeliveryRecord
+
+from tests.smtpserver import SMTPSink
+from tests.test_mail import MailTestCase
+
+__all__ = (
+    'LedgerStoreTestCase',
+    'LedgerBackendTestCase',
+    'AsyncLedgerTestCase',
+)
+
+
+class LedgerStoreTestCase(DjangoTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _stores(self, ttl=60):
+        return [
+            SQLiteLedger(os.path.join(self.tmpdir, 'ledger.sqlite3'), ttl),
+            CacheLedger('default', ttl),
+            DatabaseLedger('default', ttl),
+        ]
+
+    def test_contains(self):
+        for store in self._stores():
+            self.assertFalse(store.contains('a'))
+            store.add('a')
+            self.assertTrue(store.contains('a'))
+            self.assertFalse(store.contains('b'))
+
+    def test_expires(self):
+        store = SQLiteLedger(os.path.join(self.tmpdir, 'ledger.sqlite3'), 60)
+        store.add('a')
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertFalse(store.contains('a'))
+            store.purge()
+        self.assertFalse(store.contains('a'))
+
+    def test_expires_db(self):
+        store = DatabaseLedger('default', 60)
+        store.add('a')
+        expires = DeliveryRecord.objects.get(key='a').expires
+        with mock.patch('django.utils.timezone.now', return_value=expires):
+            self.assertFalse(store.contains('a'))
+            store.purge()
+        self.assertFalse(DeliveryRecord.objects.exists())
+
+    def test_sqlite_shared(self):
+        path = os.path.join(self.tmpdir, 'ledger.sqlite3')
+        SQLiteLedger(path).add('a')
+        self.assertTrue(SQLiteLedger(path).contains('a'))
+
+    def test_ledger_key(self):
+        message = EmailMessage('件名', '本文', 'from@example.net', ['to@example.net'])
+        key = ledger_key(message)
+
+        self.assertEqual(ledger_key(message), key)
+        message.idempotency_key = 'order-1'
+        self.assertNotEqual(ledger_key(message), key)
+        other = EmailMessage('件名', '本文', 'from@example.net', ['to@example.net'])
+        other.idempotency_key = 'order-1'
+        self.assertEqual(ledger_key(other), ledger_key(message))
+        other.to = ['other@example.net']
+        self.assertNotEqual(ledger_key(other), ledger_key(message))
+
+    def test_get_ledger(self):
+        self.assertIsNone(ledger.get_ledger())
+        with override_settings(EMAIL_IDEMPOTENCY_STORE='cache'):
+            self.assertIsInstance(ledger.get_ledger(), CacheLedger)
+            self.assertIs(ledger.get_ledger(), ledger.get_ledger())
+        with override_settings(EMAIL_IDEMPOTENCY_STORE='db'):
+            self.assertIsInstance(ledger.get_ledger(), DatabaseLedger)
+        with override_settings(EMAIL_IDEMPOTENCY_STORE='sqlite',
+                               EMAIL_IDEMPOTENCY_FILE=os.path.join(self.tmpdir, 'l.sqlite3')):
+            self.assertIsInstance(ledger.get_ledger(), SQLiteLedger)
+
+
+@override_settings(DEFAULT_CHARSET='utf8')
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.locmem.EmailBackend')
+@override_settings(EMAIL_IDEMPOTENCY_STORE='db')
+class LedgerBackendTestCase(MailTestCase, DjangoTestCase):
+
+    def test_idempotency_key(self):
+        for i in range(2):
+            num_sent = send_mail('件名', '本文', 'from@example.net', ['to@example.net'],
+                                 idempotency_key='order-1')
+            self.assertEqual(num_sent, 1)
+
+        self.assertEqual(len(django_mail.outbox), 1)
+        self.assertEqual(DeliveryRecord.objects.count(), 1)
+
+        send_mail('件名', '本文', 'from@example.net', ['other@example.net'],
+                  idempotency_key='order-1')
+        self.assertEqual(len(django_mail.outbox), 2)
+
+    def test_message_id(self):
+        message = EmailMessage('件名', '本文', 'from@example.net', ['to@example.net'])
+        message.send()
+        message.send()
+        EmailMessage('件名', '本文', 'from@example.net', ['to@example.net']).send()
+
+        self.assertEqual(len(django_mail.outbox), 2)
+
+    def test_report(self):
+        messages = [EmailMessage('件名', '本文', 'from@example.net', ['to%s@example.net' % i])
+                    for i in range(2)]
+        send_mass_mail(messages[:1])
+        report = send_mass_mail(messages, report=True)
+
+        self.assertEqual(len(django_mail.outbox), 2)
+        self.assertEqual([r.duplicate for r in report], [True, False])
+        self.assertEqual(report.num_sent, 2)
+
+    def test_not_recorded_on_failure(self):
+        with override_settings(EMAIL_BACKEND='tests.test_mail.ErrorEmailBackend'):
+            send_mail('件名', '本文', 'from@example.net', ['to@example.net'],
+                      fail_silently=True, idempotency_key='order-1')
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'],
+                  idempotency_key='order-1')
+
+        self.assertEqual(len(django_mail.outbox), 1)
+
+    def test_scope(self):
+        for i in range(2):
+            with idempotency_scope('task:1'):
+                send_mass_mail([
+                    ('件名', '本文', 'from@example.net', ['to@example.net']),
+                    ('件名', '本文', 'from@example.net', ['to@example.net']),
+                ])
+
+        # Two messages in the scope, each sent once.
+        self.assertEqual(len(django_mail.outbox), 2)
+        self.assertEqual([m.idempotency_key for m in django_mail.outbox],
+                         ['task:1:0', 'task:1:1'])
+
+    def test_task_retry(self):
+        # The relay accepts the message but the task fails afterwards.
+        def log_message(msg, sent):
+            if log_message.fail:
+                log_message.fail = False
+                raise EmailError()
+        log_message.fail = True
+
+        with mock.patch.object(mailer_tasks.mailer_api, 'log_message', log_message), \
+                mock.patch.object(mailer_tasks.send_mail, 'retry') as retry:
+            mailer_tasks.send_mail.apply(
+                ('件名', '本文', 'from@example.net', ['to@example.net']), task_id='1')
+            self.assertTrue(retry.called)
+            mailer_tasks.send_mail.apply(
+                ('件名', '本文', 'from@example.net', ['to@example.net']), task_id='1', retries=1)
+
+        self.assertEqual(len(django_mail.outbox), 1)
+
+    def test_task_called_directly(self):
+        # Without a task id, calls don't share an idempotency scope.
+        mailer_tasks.send_mail('件名1', '本文', 'from@example.net', ['to@example.net'])
+        mailer_tasks.send_mail('件名2', '本文', 'from@example.net', ['to@example.net'])
+        mailer_tasks.send_campaign_chunk([['件名3', '本文', 'from@example.net',
+                                           ['to@example.net']]])
+
+        self.assertEqual([m.subject for m in django_mail.outbox], ['件名1', '件名2', '件名3'])
+
+
+@override_settings(DEFAULT_CHARSET='utf8')
+@override_settings(EMAIL_IDEMPOTENCY_STORE='db')
+class AsyncLedgerTestCase(MailTestCase, DjangoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sink = SMTPSink().start()
+        self.settings_override = override_settings(
+            EMAIL_HOST=self.sink.host,
+            EMAIL_PORT=self.sink.port,
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.sink.stop()
+        super().tearDown()
+
+    def test_send_messages_report(self):
+        # The database ledger can't be used from inside the event loop.
+        message = EmailMessage('件名', '本文', 'from@example.net', ['to@example.net'])
+        first = asyncsmtp.EmailBackend().send_messages_report([message])
+        second = asyncsmtp.EmailBackend().send_messages_report([message])
+
+        self.assertEqual([r.duplicate for r in first], [False])
+        self.assertEqual([r.duplicate for r in second], [True])
+        self.assertEqual(len(self.sink.messages), 1)
+        self.assertEqual(DeliveryRecord.objects.count(), 1)
+
+    def test_send_messages(self):
+        message = EmailMessage('件名', '本文', 'from@example.net', ['to@example.net'])
+        backend = asyncsmtp.EmailBackend()
+
+        self.assertEqual(backend.send_messages([message]), 1)
+        self.assertEqual(backend.send_messages([message]), 1)
+        self.assertEqual(len(self.sink.messages), 1)
+
+
+class EmailError(Exception):
+    pass
@@ -1,5 +1,8 @@
 import logging
 import os
+import pickle
+import smtplib
+import tempfile
 import time
 import unittest
 from itertools import chain
@@ -8,12 +11,15 @@ from unittest import mock
 
 from django.conf import settings
 from django.core import mail as django_mail
+from django.core.files.base import ContentFile, File
 from django.test import TestCase as DjangoTestCase
 from django.test import override_settings
 
 from beproud.django.mailer import (
     EmailMessage,
     EmailMultiAlternatives,
+    FileAttachment,
+    RawEmailMessage,
     mail_admins,
     mail_managers,
     mail_managers_template,
@@ -46,8 +52,15 @@ __all__ = (
     'FailSilentlyTestCase',
     'AttachmentTestCase',
     'HtmlMailTestCase',
+    'MessageCacheTestCase',
+    'FastSerializerTestCase',
 
     'TaskTests',
+    'WorkerConnectionTests',
+    'BatchedTaskTests',
+    'PrerenderedTaskTests',
+    'RetryTests',
+    'CampaignTests',
 )
 
 
@@ -874,6 +887,169 @@ class MassMailTest(MailTestCase, DjangoTestCase):
             self.assertEqual(message.get_payload(decode=True), '本文'.encode())
 
 
+    def test_mass_mail_chunked(self):
+        events = []
+
+        def datatuple():
+            for i in range(10):
+                events.append('read %s' % i)
+                yield (
+                    '件名',
+                    '本文',
+                    '差出人 <example-from@example.net>',
+                    ['宛先 <example%s@example.net>' % i],
+                )
+
+        def pre_send_signal(sender, message, **kwargs):
+            events.append('pre_send %s' % message.to[0].split(' ')[1])
+        mail_pre_send.connect(pre_send_signal)
+        try:
+            num_sent = send_mass_mail(datatuple(), chunk_size=4)
+        finally:
+            mail_pre_send.disconnect(pre_send_signal)
+
+        self.assertEqual(num_sent, 10)
+        self.assertEqual(len(django_mail.outbox), 10)
+        self.assertEqual(events[:9], [
+            'read 0', 'read 1', 'read 2', 'read 3',
+            'pre_send <example0@example.net>',
+            'pre_send <example1@example.net>',
+            'pre_send <example2@example.net>',
+            'pre_send <example3@example.net>',
+            'read 4',
+        ])
+        for i in range(10):
+            message = django_mail.outbox[i].message()
+            self.assertEqual(str(message['To']),
+                             "=?utf-8?b?5a6b5YWI?= <example%s@example.net>" % i)
+
+    def test_mass_mail_chunked_one_connection(self):
+        connection = mailer_api.get_connection()
+        with mock.patch.object(connection, 'open', return_value=True) as open_, \
+                mock.patch.object(connection, 'close') as close, \
+                mock.patch.object(connection, 'send_messages',
+                                  side_effect=len) as send_messages:
+            num_sent = send_mass_mail(((
+                '件名',
+                '本文',
+                '差出人 <example-from@example.net>',
+                ['宛先 <example%s@example.net>' % i],
+            ) for i in range(10)), connection=connection, chunk_size=3)
+
+        self.assertEqual(num_sent, 10)
+        open_.assert_called_once_with()
+        close.assert_called_once_with()
+        self.assertEqual([len(c[0][0]) for c in send_messages.call_args_list], [3, 3, 3, 1])
+
+    @override_settings(EMAIL_MASS_MAIL_CHUNK_SIZE=3)
+    def test_mass_mail_chunk_size_setting(self):
+        connection = mailer_api.get_connection()
+        with mock.patch.object(connection, 'send_messages', side_effect=len) as send_messages:
+            send_mass_mail(((
+                '件名',
+                '本文',
+                '差出人 <example-from@example.net>',
+                ['宛先 <example%s@example.net>' % i],
+            ) for i in range(5)), connection=connection)
+
+        self.assertEqual([len(c[0][0]) for c in send_messages.call_args_list], [3, 2])
+
+    def test_mass_mail_report(self):
+        report = send_mass_mail(((
+            '件名',
+            '本文',
+            '差出人 <example-from@example.net>',
+            ['宛先 <example%s@example.net>' % i],
+        ) for i in range(5)), chunk_size=2, report=True)
+
+        self.assertEqual(len(report), 5)
+        self.assertEqual(report.num_sent, 5)
+        self.assertEqual(report.failed, [])
+        for i, result in enumerate(report):
+            self.assertIs(result.message, django_mail.outbox[i])
+            self.assertEqual(result.accepted, ['宛先 <example%s@example.net>' % i])
+            self.assertEqual(result.message_id, str(result.message.message()['Message-ID']))
+
+    def test_mass_mail_coalesce(self):
+        events = []
+
+        def post_send_signal(sender, message, **kwargs):
+            events.append(message.to[0])
+        mail_post_send.connect(post_send_signal)
+        try:
+            num_sent = send_mass_mail([(
+                '件名',
+                '本文',
+                '差出人 <example-from@example.net>',
+                ['example%s@example.net' % i],
+            ) for i in range(3)] + [(
+                '件名',
+                '別の本文',
+                '差出人 <example-from@example.net>',
+                ['example3@example.net'],
+            )], coalesce=True)
+        finally:
+            mail_post_send.disconnect(post_send_signal)
+
+        self.assertEqual(num_sent, 4)
+        self.assertEqual(events, ['example%s@example.net' % i for i in range(4)])
+        self.assertEqual(len(django_mail.outbox), 2)
+        merged = django_mail.outbox[0]
+        self.assertEqual(merged.recipients(), ['example%s@example.net' % i for i in range(3)])
+        self.assertEqual(merged.message()['To'], 'undisclosed-recipients:;')
+        self.assertEqual(django_mail.outbox[1].recipients(), ['example3@example.net'])
+        self.assertEqual(django_mail.outbox[1].message()['To'], 'example3@example.net')
+
+    @override_settings(EMAIL_COALESCE_MAX_RECIPIENTS=2)
+    def test_mass_mail_coalesce_max_recipients(self):
+        report = send_mass_mail(((
+            '件名',
+            '本文',
+            'example-from@example.net',
+            ['example%s@example.net' % i],
+        ) for i in range(5)), coalesce=True, report=True)
+
+        self.assertEqual([len(m.recipients()) for m in django_mail.outbox], [2, 2, 1])
+        self.assertEqual(report.num_sent, 5)
+        self.assertEqual([r.accepted for r in report],
+                         [['example%s@example.net' % i] for i in range(5)])
+        self.assertEqual(report[0].message_id, report[1].message_id)
+
+    @override_settings(EMAIL_COALESCE_TO_HEADER=None)
+    def test_mass_mail_coalesce_to_header(self):
+        send_mass_mail([EmailMessage(
+            '件名',
+            '本文',
+            'example-from@example.net',
+            ['example%s@example.net' % i],
+            headers={'To': 'Members <members@example.net>'},
+        ) for i in range(2)] + [(
+            '件名',
+            '本文',
+            'example-from@example.net',
+            ['example%s@example.net' % i],
+        ) for i in range(2, 4)], coalesce=True)
+
+        self.assertEqual([m.recipients() for m in django_mail.outbox], [
+            ['example0@example.net', 'example1@example.net'],
+            ['example2@example.net'],
+            ['example3@example.net'],
+        ])
+        self.assertEqual(django_mail.outbox[0].message()['To'], 'Members <members@example.net>')
+        self.assertEqual(django_mail.outbox[0].message().get_all('To'),
+                         ['Members <members@example.net>'])
+
+    def test_message_id_stable(self):
+        message = EmailMessage('件名', '本文', 'example-from@example.net',
+                               ['example@example.net'])
+        self.assertEqual(message.message()['Message-ID'], message.message()['Message-ID'])
+        self.assertEqual(message.message()['Message-ID'], message.message_id)
+
+        message = EmailMessage('件名', '本文', 'example-from@example.net',
+                               ['example@example.net'],
+                               headers={'Message-Id': '<id@example.net>'})
+        self.assertEqual(message.message_id, '<id@example.net>')
+
 @override_settings(ADMINS=(('Admin', 'admin@example.net'),))
 @override_settings(MANAGERS=(('Manager', 'manager@example.net'),))
 @override_settings(DEFAULT_CHARSET='utf-8')
@@ -1025,6 +1201,21 @@ class FailSilentlyTestCase(MailTestCase, DjangoTestCase):
         except EmailError:
             pass
 
+    def test_mass_mail_report(self):
+        report = send_mass_mail(((
+            '件名',
+            '本文',
+            '差出人 <example-from@example.net>',
+            ['宛先 <example%s@example.net>' % i],
+        ) for i in range(3)), report=True)
+
+        self.assertEqual(len(report), 3)
+        self.assertEqual(report.num_sent, 0)
+        self.assertEqual(len(report.failed), 3)
+        for result in report:
+            self.assertIsInstance(result.exception, EmailError)
+        self.assertEqual(report.failed_messages(), [r.message for r in report])
+
 
 @override_settings(ADMINS=(('Admin', 'admin@example.net'),))
 @override_settings(MANAGERS=(('Manager', 'manager@example.net'),))
@@ -1087,6 +1278,89 @@ class AttachmentTestCase(MailTestCase, DjangoTestCase):
         self.assertEqual(payloads[0]['Content-Disposition'], 'attachment; filename="test.txt"')
         self.assertEqual(payloads[0].get_payload(decode=True), 'データ'.encode())
 
+    def test_attachment_cache(self):
+        cache = mailer_api.get_attachment_cache()
+        cache.clear()
+        content = os.urandom(10000)
+
+        send_mass_mail([EmailMessage(
+            '件名', '本文', 'example-from@example.net', ['example%s@example.net' % i],
+            attachments=[('test.pdf', content, 'application/pdf')],
+        ) for i in range(3)])
+
+        payloads = [m.message().get_payload()[1] for m in django_mail.outbox]
+        self.assertEqual((cache.misses, cache.hits), (1, 2))
+        self.assertIs(payloads[1].get_payload(), payloads[0].get_payload())
+        for payload in payloads:
+            self.assertEqual(payload['Content-Transfer-Encoding'], 'base64')
+            self.assertEqual(payload['Content-Disposition'], 'attachment; filename="test.pdf"')
+            self.assertEqual(payload.get_payload(decode=True), content)
+
+    def test_attachment_cache_same_bytes(self):
+        content = os.urandom(1000)
+        attachments = [('test.pdf', content, 'application/pdf')]
+        with override_settings(EMAIL_ATTACHMENT_CACHE_SIZE=0):
+            uncached = EmailMessage(attachments=attachments).message().get_payload()[0]
+        for i in range(2):
+            cached = EmailMessage(attachments=attachments).message().get_payload()[0]
+            self.assertEqual(cached.as_bytes(), uncached.as_bytes())
+
+    def _write_file(self, content, suffix='.pdf'):
+        f = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+        self.addCleanup(os.unlink, f.name)
+        with f:
+            f.write(content)
+        return f.name
+
+    def test_file_attachment(self):
+        for content in [os.urandom(200000), b'line\n' * 30000, b'']:
+            path = self._write_file(content)
+            message = EmailMessage('件名', '本文', 'example-from@example.net',
+                                   ['example@example.net'])
+            message.attach(FileAttachment(path, filename='test.pdf'))
+            inline = EmailMessage('件名', '本文', 'example-from@example.net',
+                                  ['example@example.net'],
+                                  attachments=[('test.pdf', content, 'application/pdf')])
+            expected = inline.message().get_payload()[1].get_payload()
+
+            stream = message.message_stream()
+            data = stream.getvalue()
+            self.assertEqual(stream.size, len(data))
+            self.assertEqual(data, message.message().as_bytes(linesep='\r\n'))
+            self.assertIn(expected.replace('\n', '\r\n').encode(), data)
+            self.assertEqual(message.message().get_payload()[1].get_payload(), expected)
+            self.assertEqual(message.message().get_payload()[1].get_payload(decode=True), content)
+
+    def test_file_attachment_django_file(self):
+        content = os.urandom(100000)
+        path = self._write_file(content)
+        with open(path, 'rb') as f:
+            attachment = FileAttachment(File(f))
+            self.assertEqual(attachment.get_content_type(), 'application/pdf')
+            self.assertEqual(attachment.get_filename(), os.path.basename(path))
+            self.assertEqual(attachment.get_payload(decode=True), content)
+
+        # Files without a file descriptor are read in chunks.
+        attachment = FileAttachment(ContentFile(content, name='データ.bin'))
+        self.assertEqual(attachment.get_filename(), 'データ.bin')
+        self.assertEqual(attachment.get_content_type(), 'application/octet-stream')
+        self.assertIsNone(attachment.encoded_size())
+        self.assertEqual(attachment.get_payload(decode=True), content)
+
+    def test_send_mail_file_attachment(self):
+        path = self._write_file(b'%PDF-1.4')
+        send_mail(
+            '件名',
+            '本文',
+            'example-from@example.net',
+            ['example@example.net'],
+            attachments=[FileAttachment(path, filename='test.pdf')],
+        )
+
+        payload = django_mail.outbox[0].message().get_payload()[1]
+        self.assertEqual(payload['Content-Disposition'], 'attachment; filename="test.pdf"')
+        self.assertEqual(payload.get_payload(decode=True), b'%PDF-1.4')
+
 
 @override_settings(ADMINS=(('Admin', 'admin@example.net'),))
 @override_settings(MANAGERS=(('Manager', 'manager@example.net'),))
@@ -1165,6 +1439,128 @@ class HtmlMailTestCase(MailTestCase, DjangoTestCase):
         self.assertEqual(payloads[1].get_payload(decode=True), "<h1>本文</h1>\n".encode())
 
 
+@override_settings(DEFAULT_CHARSET='utf-8')
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.locmem.EmailBackend')
+class MessageCacheTestCase(MailTestCase, DjangoTestCase):
+
+    def _message(self):
+        return EmailMessage('件名', '本文', 'example-from@example.net', ['example@example.net'])
+
+    def test_cached(self):
+        message_obj = self._message()
+
+        self.assertIs(message_obj.message(), message_obj.message())
+        self.assertIs(message_obj.message_bytes(), message_obj.message_bytes())
+        self.assertEqual(message_obj.message_bytes(),
+                         message_obj.message().as_bytes(linesep='\r\n'))
+
+    def test_invalidated(self):
+        message_obj = self._message()
+        mutations = [
+            lambda m: setattr(m, 'subject', '別の件名'),
+            lambda m: setattr(m, 'body', '別の本文'),
+            lambda m: m.to.append('example2@example.net'),
+            lambda m: m.cc.append('cc@example.net'),
+            lambda m: m.attach('file.txt', 'テキスト', 'text/plain'),
+            lambda m: m.extra_headers.update({'X-Test': 'test'}),
+            lambda m: setattr(m, 'encoding', 'iso-2022-jp'),
+        ]
+        for mutate in mutations:
+            message = message_obj.message()
+            data = message_obj.message_bytes()
+            mutate(message_obj)
+            self.assertIsNot(message_obj.message(), message)
+            self.assertNotEqual(message_obj.message_bytes(), data)
+
+    def test_stable_identity(self):
+        message_obj = self._message()
+        message = message_obj.message()
+        message_obj.subject = '別の件名'
+
+        rebuilt = message_obj.message()
+        self.assertIsNot(rebuilt, message)
+        self.assertEqual(rebuilt['Date'], message['Date'])
+        self.assertEqual(rebuilt['Message-ID'], message['Message-ID'])
+
+    def test_pickle(self):
+        message_obj = self._message()
+        message = message_obj.message()
+
+        copied = pickle.loads(pickle.dumps(message_obj))
+        self.assertNotIn('_message_cache', copied.__dict__)
+        self.assertEqual(copied.message_bytes(), message_obj.message_bytes())
+        self.assertEqual(copied.message()['Message-ID'], message['Message-ID'])
+
+
+@override_settings(DEFAULT_CHARSET='utf-8')
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.locmem.EmailBackend')
+class FastSerializerTestCase(MailTestCase, DjangoTestCase):
+
+    def assertSameBytes(self, message_obj):
+        self.assertTrue(message_obj._can_serialize_fast())
+        self.assertEqual(message_obj._serialize_fast(),
+                         message_obj._build_message().as_bytes(linesep='\r\n'))
+
+    def test_same_bytes(self):
+        for encoding in ('utf-8', 'iso-2022-jp', 'cp932', None):
+            for subject, body in (
+                ('件名', '本文'),
+                ('Subject', 'Body\n.\nwith a dot\r\nand CRLF\n'),
+                ('とても長い件名' * 10, '長い本文' * 100),
+                ('A long ASCII subject that has to be folded over more than one line', ''),
+                ('', 'abc'),
+            ):
+                message_obj = EmailMessage(
+                    subject, body,
+                    '差出人 <example-from@example.net>',
+                    ['宛先 <example%s@example.net>' % i for i in range(5)],
+                    cc=['cc@example.net'],
+                    headers={'Reply-To': 'reply@example.net', 'X-Mailer': 'テスト'},
+                )
+                message_obj.encoding = encoding
+                self.assertSameBytes(message_obj)
+
+    def test_html(self):
+        message_obj = EmailMessage('件名', '<p>本文</p>', 'example-from@example.net',
+                                   ['example@example.net'])
+        message_obj.content_subtype = 'html'
+        self.assertSameBytes(message_obj)
+
+    def test_extra_headers(self):
+        message_obj = EmailMessage('件名', '本文', 'example-from@example.net',
+                                   ['example@example.net'],
+                                   headers={'From': 'other@example.net', 'To': 'list@example.net',
+                                            'Date': 'Tue, 01 Jan 2019 00:00:00 -0000',
+                                            'Message-ID': '<id@example.net>'})
+        self.assertSameBytes(message_obj)
+
+    def test_fallback(self):
+        message_obj = EmailMessage('件名', '本文', 'example-from@example.net',
+                                   ['example@example.net'])
+        message_obj.attach('file.txt', 'テキスト', 'text/plain')
+        self.assertFalse(message_obj._can_serialize_fast())
+
+        message_obj = EmailMultiAlternatives('件名', '本文', 'example-from@example.net',
+                                             ['example@example.net'])
+        self.assertTrue(message_obj._can_serialize_fast())
+        message_obj.attach_alternative('<p>本文</p>', 'text/html')
+        self.assertFalse(message_obj._can_serialize_fast())
+
+    def test_bad_header(self):
+        message_obj = EmailMessage('件名\n改行', '本文', 'example-from@example.net',
+                                   ['example@example.net'])
+        with self.assertRaises(mailer_api.BadHeaderError):
+            message_obj.message_bytes()
+
+    def test_message_after_bytes(self):
+        message_obj = EmailMessage('件名', '本文', 'example-from@example.net',
+                                   ['example@example.net'])
+        data = message_obj.message_bytes()
+
+        self.assertEqual(message_obj.message().as_bytes(linesep='\r\n'), data)
+        self.assertIs(message_obj.message_bytes(), data)
+
+
 @override_settings(ADMINS=(('Admin', 'admin@example.net'),))
 @override_settings(MANAGERS=(('Manager', 'manager@example.net'),))
 @override_settings(DEFAULT_CHARSET='utf8')
@@ -1280,3 +1676,540 @@ class TaskTests(MailTestCase, DjangoTestCase):
             '本文',
             fail_silently=True,
         )
+
+
+@override_settings(ADMINS=(('Admin', 'admin@example.net'),))
+@override_settings(MANAGERS=(('Manager', 'manager@example.net'),))
+@override_settings(DEFAULT_CHARSET='utf8')
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.locmem.EmailBackend')
+@override_settings(EMAIL_WORKER_CONNECTION=True)
+class WorkerConnectionTests(MailTestCase, DjangoTestCase):
+
+    def tearDown(self):
+        mailer_tasks.worker_connection.close_all()
+        super().tearDown()
+
+    def _connections(self):
+        return [m.connection for m in django_mail.outbox]
+
+    def test_connection_reused(self):
+        mailer_tasks.send_mail.delay('件名', '本文', 'from@example.net', ['to@example.net'])
+        mailer_tasks.send_template_mail.delay(
+            'mailer/mail.tpl',
+            'from@example.net',
+            ['to@example.net'],
+            extra_context={'subject': '件名', 'body': '本文'},
+        )
+        mailer_tasks.mail_admins.delay('件名', '本文')
+        mailer_tasks.mail_managers.delay('件名', '本文')
+        mailer_tasks.mail_managers_template.delay(
+            'mailer/mail.tpl',
+            extra_context={'subject': '件名', 'body': '本文'},
+        )
+
+        connections = self._connections()
+        self.assertEqual(len(connections), 5)
+        self.assertTrue(all(c is connections[0] for c in connections))
+
+    @override_settings(EMAIL_WORKER_CONNECTION_MAX_MESSAGES=2)
+    def test_max_messages(self):
+        for i in range(5):
+            mailer_tasks.send_mail.delay('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        connections = self._connections()
+        self.assertEqual(len(set(map(id, connections))), 3)
+        self.assertIs(connections[0], connections[1])
+        self.assertIsNot(connections[1], connections[2])
+
+    @override_settings(EMAIL_WORKER_CONNECTION_MAX_AGE=0)
+    def test_max_age(self):
+        for i in range(2):
+            mailer_tasks.send_mail.delay('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        connections = self._connections()
+        self.assertIsNot(connections[0], connections[1])
+
+    def test_fail_silently(self):
+        with override_settings(EMAIL_BACKEND='tests.test_mail.ErrorEmailBackend'):
+            mailer_tasks.send_mail.delay('件名', '本文', 'from@example.net', ['to@example.net'],
+                                         fail_silently=True)
+
+    def test_closed_on_error(self):
+        connection = mailer_tasks.worker_connection.get()
+        with mock.patch.object(mailer_api, 'send_mail', side_effect=EmailError):
+            with mock.patch.object(connection, 'close') as close:
+                with self.assertRaises(EmailError):
+                    mailer_tasks.send_mail.delay('件名', '本文', 'from@example.net',
+                                                 ['to@example.net'], max_retries=0)
+                close.assert_called_once_with()
+        self.assertIsNot(mailer_tasks.worker_connection.get(), connection)
+
+    def test_credentials(self):
+        with mock.patch.object(mailer_api, 'get_connection',
+                               wraps=mailer_api.get_connection) as get_connection:
+            mailer_tasks.send_mail.delay('件名', '本文', 'from@example.net', ['to@example.net'],
+                                         auth_user='user', auth_password='password')
+
+        get_connection.assert_called_once_with(username='user', password='password',
+                                               fail_silently=False)
+        self.assertIsNone(getattr(mailer_tasks.worker_connection._local, 'connection', None))
+
+    def test_dropped_connection(self):
+        connection = mailer_tasks.worker_connection.get()
+        connection.connection = mock.Mock(**{'noop.return_value': (250, b'OK')})
+        self.assertIs(mailer_tasks.worker_connection.get(), connection)
+
+        connection.connection.noop.side_effect = smtplib.SMTPServerDisconnected
+        with mock.patch.object(connection, 'close'):
+            mailer_tasks.send_mail.delay('件名', '本文', 'from@example.net', ['to@example.net'])
+        self.assertIsNot(self._connections()[0], connection)
+
+    def test_worker_process_shutdown(self):
+        from celery.signals import worker_process_shutdown
+
+        connection = mailer_tasks.worker_connection.get()
+        with mock.patch.object(connection, 'close') as close:
+            worker_process_shutdown.send(sender=None, pid=0, exitcode=0)
+            close.assert_called_once_with()
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def _send_message(self, email_message):
+        if 'fail@example.net' in email_message.to:
+            raise EmailError("ERROR")
+        django_mail.outbox.append(email_message)
+        return {}
+
+
+@override_settings(DEFAULT_CHARSET='utf8')
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.locmem.EmailBackend')
+@override_settings(EMAIL_BATCH_MAX_SIZE=3)
+@override_settings(EMAIL_BATCH_MAX_WAIT=60)
+class BatchedTaskTests(MailTestCase, DjangoTestCase):
+
+    def tearDown(self):
+        mailer_tasks.mail_batcher.flush()
+        super().tearDown()
+
+    def _send(self, to, **kwargs):
+        mailer_tasks.send_mail_batched.delay('件名', '本文', 'from@example.net', [to], **kwargs)
+
+    def test_batch_size(self):
+        for i in range(4):
+            self._send('to%s@example.net' % i)
+
+        self.assertEqual(len(django_mail.outbox), 3)
+        connections = [m.connection for m in django_mail.outbox]
+        self.assertTrue(all(c is connections[0] for c in connections))
+        self.assertEqual(len(mailer_tasks.mail_batcher), 1)
+
+        mailer_tasks.mail_batcher.flush()
+        self.assertEqual(len(django_mail.outbox), 4)
+        self.assertEqual(django_mail.outbox[3].to, ['to3@example.net'])
+
+    @override_settings(EMAIL_BATCH_MAX_WAIT=0.01)
+    def test_max_wait(self):
+        self._send('to@example.net')
+
+        for i in range(100):
+            if django_mail.outbox:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(django_mail.outbox), 1)
+        self.assertEqual(len(mailer_tasks.mail_batcher), 0)
+
+    @override_settings(EMAIL_BACKEND='tests.test_mail.FailingEmailBackend')
+    @override_settings(EMAIL_RETRY_JITTER=False)
+    def test_retry_individually(self):
+        with mock.patch.object(mailer_tasks.send_mail, 'apply_async') as apply_async:
+            self._send('to1@example.net')
+            self._send('fail@example.net', html_message='<p>本文</p>', retry_countdown=5)
+            self._send('to2@example.net')
+
+        self.assertEqual([m.to for m in django_mail.outbox],
+                         [['to1@example.net'], ['to2@example.net']])
+        apply_async.assert_called_once_with(
+            ('件名', '本文', 'from@example.net', ['fail@example.net']),
+            {'html_message': '<p>本文</p>', 'retry_countdown': 5, 'idempotency_key': mock.ANY},
+            retries=1,
+            countdown=5,
+        )
+
+    def test_retry_options(self):
+        with mock.patch.object(mailer_tasks.send_mail, 'apply_async') as apply_async:
+            self._send('to1@example.net', max_retries=5)
+            self._send('to2@example.net', retry_countdown=5)
+            mailer_tasks.mail_batcher.flush()
+
+        self.assertEqual([m.to for m in django_mail.outbox],
+                         [['to1@example.net'], ['to2@example.net']])
+        self.assertFalse(apply_async.called)
+
+    @override_settings(EMAIL_BACKEND='tests.test_mail.FailingEmailBackend')
+    def test_no_retry(self):
+        with mock.patch.object(mailer_tasks.send_mail, 'apply_async') as apply_async:
+            self._send('fail@example.net', max_retries=0)
+            self._send('fail@example.net', fail_silently=True)
+            mailer_tasks.mail_batcher.flush()
+
+        self.assertFalse(apply_async.called)
+
+    def test_worker_process_shutdown(self):
+        from celery.signals import worker_process_shutdown
+
+        self._send('to@example.net')
+        worker_process_shutdown.send(sender=None, pid=0, exitcode=0)
+        self.assertEqual(len(django_mail.outbox), 1)
+
+
+@override_settings(DEFAULT_CHARSET='utf8')
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.locmem.EmailBackend')
+class PrerenderedTaskTests(MailTestCase, DjangoTestCase):
+
+    def _message(self):
+        msg = EmailMultiAlternatives('件名', '本文', 'from@example.net', ['to@example.net'],
+                                     bcc=['bcc@example.net'])
+        msg.attach_alternative('<p>本文</p>', 'text/html')
+        return msg
+
+    def test_message_payload(self):
+        msg = self._message()
+        for compress in (False, True):
+            payload = mailer_tasks.message_payload(msg, compress=compress)
+            self.assertEqual(payload['from_email'], 'from@example.net')
+            self.assertEqual(payload['recipient_list'], ['to@example.net', 'bcc@example.net'])
+            self.assertEqual(payload['compressed'], compress)
+            self.assertEqual(mailer_tasks._decode_payload(payload['data'], compress),
+                             msg.message_bytes())
+
+    @override_settings(EMAIL_TASK_COMPRESS=True)
+    def test_compress_setting(self):
+        self.assertTrue(mailer_tasks.message_payload(self._message())['compressed'])
+
+    def test_raw_message(self):
+        data = self._message().message_bytes()
+        msg = RawEmailMessage(data, 'from@example.net', ['to@example.net', 'bcc@example.net'])
+
+        self.assertEqual(msg.subject, '件名')
+        self.assertEqual(msg.recipients(), ['to@example.net', 'bcc@example.net'])
+        self.assertEqual(msg.message_id, msg.message()['Message-ID'])
+        self.assertIs(msg.message_bytes(), data)
+        self.assertIs(msg.message_stream(eightbit=False), data)
+        self.assertEqual(pickle.loads(pickle.dumps(msg)).message_bytes(), data)
+
+    def test_raw_message_headers_only(self):
+        data = self._message().message_bytes()
+        with mock.patch.object(mailer_api, 'message_from_bytes') as message_from_bytes:
+            msg = RawEmailMessage(data, 'from@example.net', ['to@example.net'])
+            self.assertEqual(msg.subject, '件名')
+            self.assertTrue(msg.message_id)
+        self.assertFalse(message_from_bytes.called)
+
+    def test_send_template_mail_prerendered(self):
+        mailer_tasks.send_template_mail_prerendered(
+            'mailer/mail.tpl',
+            'from@example.net',
+            ['to@example.net'],
+            extra_context={'subject': '件名', 'body': '本文'},
+            html_template_name='mailer/html_mail.tpl',
+            compress=True,
+        )
+
+        self.assertEqual(len(django_mail.outbox), 1)
+        msg = django_mail.outbox[0]
+        self.assertIsInstance(msg, RawEmailMessage)
+        self.assertEqual(msg.subject, '件名')
+        self.assertEqual(msg.recipients(), ['to@example.net'])
+        self.assertEqual(msg.message().get_content_type(), 'multipart/alternative')
+
+    @override_settings(EMAIL_RETRY_JITTER=False)
+    def test_retry(self):
+        payload = mailer_tasks.message_payload(self._message(), compress=True)
+        with mock.patch.object(mailer_api, 'send_mail', side_effect=AssertionError), \
+                mock.patch.object(mailer_api, 'get_connection', side_effect=EmailError), \
+                mock.patch.object(mailer_tasks.send_raw_mail, 'retry') as retry:
+            mailer_tasks.send_raw_mail(max_retries=2, **payload)
+
+        retry.assert_called_once_with(exc=mock.ANY, countdown=10, max_retries=2)
+        self.assertIsInstance(retry.call_args[1]['exc'], EmailError)
+
+
+class RefusingEmailBackend(BaseEmailBackend):
+    refused = {
+        'temp@example.net': (450, b'Mailbox busy'),
+        'perm@example.net': (550, b'No such user'),
+    }
+
+    def _send_message(self, email_message):
+        refused = dict((r, self.refused[r]) for r in email_message.recipients()
+                       if r in self.refused)
+        if len(refused) == len(email_message.recipients()):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        django_mail.outbox.append(email_message)
+        return refused
+
+
+@override_settings(DEFAULT_CHARSET='utf8')
+@override_settings(EMAIL_BACKEND='tests.test_mail.RefusingEmailBackend')
+@override_settings(EMAIL_RETRY_JITTER=False)
+class RetryTests(MailTestCase, DjangoTestCase):
+
+    def test_countdown(self):
+        self.assertEqual([mailer_tasks._countdown(None, 10, i) for i in range(4)],
+                         [10, 20, 40, 80])
+        self.assertEqual(mailer_tasks._countdown(None, 10, 20), 600)
+        with override_settings(EMAIL_RETRY_MAX_COUNTDOWN=None):
+            self.assertEqual(mailer_tasks._countdown(None, 10, 10), 10240)
+        with override_settings(EMAIL_RETRY_BACKOFF=False):
+            self.assertEqual(mailer_tasks._countdown(None, 10, 3), 10)
+        with override_settings(EMAIL_RETRY_JITTER=True):
+            for i in range(20):
+                self.assertTrue(40 <= mailer_tasks._countdown(None, 10, 3) <= 80)
+
+    def test_is_permanent(self):
+        from django.template import TemplateDoesNotExist
+
+        self.assertTrue(mailer_tasks._is_permanent(smtplib.SMTPDataError(554, 'Rejected')))
+        self.assertTrue(mailer_tasks._is_permanent(smtplib.SMTPSenderRefused(553, 'No', 'a')))
+        self.assertTrue(mailer_tasks._is_permanent(TemplateDoesNotExist('mail.tpl')))
+        self.assertTrue(mailer_tasks._is_permanent(smtplib.SMTPRecipientsRefused(
+            {'a@example.net': (550, b'No'), 'b@example.net': (553, b'No')})))
+
+        self.assertFalse(mailer_tasks._is_permanent(smtplib.SMTPDataError(451, 'Try later')))
+        self.assertFalse(mailer_tasks._is_permanent(smtplib.SMTPServerDisconnected()))
+        self.assertFalse(mailer_tasks._is_permanent(OSError('Connection refused')))
+        self.assertFalse(mailer_tasks._is_permanent(EmailError()))
+        self.assertFalse(mailer_tasks._is_permanent(smtplib.SMTPRecipientsRefused(
+            {'a@example.net': (550, b'No'), 'b@example.net': (450, b'Busy')})))
+
+    def test_permanent_error(self):
+        with mock.patch.object(mailer_api, 'send_mail',
+                               side_effect=smtplib.SMTPDataError(554, 'Rejected')), \
+                mock.patch.object(mailer_tasks.send_mail, 'retry') as retry:
+            with self.assertRaises(smtplib.SMTPDataError):
+                mailer_tasks.send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        self.assertFalse(retry.called)
+
+    def test_permanent_error_task_state(self):
+        with mock.patch.object(mailer_api, 'send_mail',
+                               side_effect=smtplib.SMTPDataError(554, 'Rejected')):
+            result = mailer_tasks.send_mail.apply(
+                ('件名', '本文', 'from@example.net', ['to@example.net']), throw=False)
+
+        self.assertEqual(result.state, 'FAILURE')
+
+    def test_transient_error_backoff(self):
+        with mock.patch.object(mailer_api, 'send_mail',
+                               side_effect=smtplib.SMTPDataError(451, 'Try later')), \
+                mock.patch.object(mailer_tasks.send_mail, 'retry') as retry:
+            mailer_tasks.send_mail.apply(
+                ('件名', '本文', 'from@example.net', ['to@example.net']), retries=2)
+
+        retry.assert_called_once_with(exc=mock.ANY, countdown=40, max_retries=3)
+
+    def _raw_retries(self, *args, **kwargs):
+        with mock.patch.object(mailer_tasks.send_raw_mail, 'apply_async') as apply_async:
+            mailer_tasks.send_mail.delay('件名', '本文', 'from@example.net', *args, **kwargs)
+        return apply_async.call_args_list
+
+    def test_partially_refused(self):
+        calls = self._raw_retries(['to@example.net', 'temp@example.net', 'perm@example.net'])
+
+        self.assertEqual(len(django_mail.outbox), 1)
+        sent = django_mail.outbox[0]
+        self.assertEqual(len(calls), 1)
+        kwargs = calls[0][1]['kwargs']
+        self.assertEqual(kwargs['recipient_list'], ['temp@example.net'])
+        self.assertEqual(mailer_tasks._decode_payload(kwargs['data'], kwargs['compressed']),
+                         sent.message_bytes())
+        self.assertEqual(calls[0][1]['retries'], 1)
+        self.assertEqual(calls[0][1]['countdown'], 10)
+
+    def test_all_refused(self):
+        calls = self._raw_retries(['temp@example.net', 'perm@example.net'])
+
+        self.assertEqual(len(django_mail.outbox), 0)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][1]['kwargs']['recipient_list'], ['temp@example.net'])
+
+    def test_refused_permanently(self):
+        self.assertEqual(self._raw_retries(['perm@example.net']), [])
+        self.assertEqual(self._raw_retries(['to@example.net', 'perm@example.net']), [])
+
+    def test_refused_no_retries_left(self):
+        self.assertEqual(self._raw_retries(['to@example.net', 'temp@example.net'],
+                                           max_retries=0), [])
+
+    def test_refused_fail_silently(self):
+        self.assertEqual(self._raw_retries(['temp@example.net'], fail_silently=True), [])
+
+    def test_raw_retry_sent(self):
+        mailer_tasks.send_mail.delay('件名', '本文', 'from@example.net',
+                                     ['to@example.net', 'temp@example.net'], max_retries=1)
+
+        # The retry of temp@example.net is refused again and then given up.
+        self.assertEqual(len(django_mail.outbox), 1)
+        self.assertEqual(django_mail.outbox[0].to, ['to@example.net', 'temp@example.net'])
+
+
+@override_settings(DEFAULT_CHARSET='utf8')
+@override_settings(EMAIL_BACKEND='tests.test_mail.RefusingEmailBackend')
+class CampaignTests(MailTestCase, DjangoTestCase):
+
+    def _connections(self):
+        return [m.connection for m in django_mail.outbox]
+
+    def test_template(self):
+        recipients = ['to%s@example.net' % i for i in range(5)]
+        recipients[3] = ('perm@example.net', {'subject': '個別'})
+        result = mailer_tasks.send_campaign(
+            recipients,
+            template_name='mailer/mail.tpl',
+            from_email='from@example.net',
+            extra_context={'subject': '件名', 'body': '本文'},
+            chunk_size=2,
+            report=True,
+        )
+        report = result.get()
+
+        self.assertEqual(report['sent'], 4)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(report['failed_recipients'], ['perm@example.net'])
+        self.assertEqual([c['index'] for c in report['chunks']], [0, 1, 2])
+        self.assertEqual([c['sent'] + c['failed'] for c in report['chunks']], [2, 2, 1])
+        self.assertTrue(all(c['elapsed'] >= 0 for c in report['chunks']))
+        self.assertEqual(report['elapsed'], report['chunks'][-1]['finished'] -
+                         report['chunks'][0]['started'])
+
+        self.assertEqual([m.to for m in django_mail.outbox],
+                         [['to0@example.net'], ['to1@example.net'], ['to2@example.net'],
+                          ['to4@example.net']])
+        # One connection per chunk.
+        connections = self._connections()
+        self.assertIs(connections[0], connections[1])
+        self.assertIsNot(connections[1], connections[2])
+
+    def test_datatuple(self):
+        report = mailer_tasks.send_campaign((
+            ('件名%s' % i, '本文', 'from@example.net', ['to%s@example.net' % i])
+            for i in range(3)
+        ), chunk_size=2, report=True).get()
+
+        self.assertEqual(report['sent'], 3)
+        self.assertEqual(len(report['chunks']), 2)
+        self.assertEqual([m.subject for m in django_mail.outbox], ['件名0', '件名1', '件名2'])
+
+    def test_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False,
+                                         encoding='utf-8') as f:
+            f.write('to1@example.net\n\nto2@example.net\n')
+        try:
+            report = mailer_tasks.send_campaign(
+                f.name,
+                template_name='mailer/mail.tpl',
+                from_email='from@example.net',
+                extra_context={'subject': '件名', 'body': '本文'},
+                report=True,
+            ).get()
+        finally:
+            os.unlink(f.name)
+
+        self.assertEqual(report['sent'], 2)
+        self.assertEqual([m.to for m in django_mail.outbox],
+                         [['to1@example.net'], ['to2@example.net']])
+
+    def test_queryset(self):
+        from django.contrib.auth.models import User
+
+        for i in range(3):
+            User.objects.create(username='user%s' % i, email='user%s@example.net' % i)
+        report = mailer_tasks.send_campaign(
+            User.objects.order_by('pk'),
+            template_name='mailer/mail.tpl',
+            from_email='from@example.net',
+            extra_context={'subject': '件名', 'body': '本文'},
+            chunk_size=2,
+            report=True,
+        ).get()
+
+        self.assertEqual(report['sent'], 3)
+        self.assertEqual([m.to for m in django_mail.outbox],
+                         [['user%s@example.net' % i] for i in range(3)])
+
+    def test_queryset_without_template(self):
+        from django.contrib.auth.models import User
+
+        User.objects.create(username='user', email='user@example.net')
+        with self.assertRaises(ValueError):
+            mailer_tasks.send_campaign(User.objects.all())
+        self.assertEqual(django_mail.outbox, [])
+
+    def test_group(self):
+        result = mailer_tasks.send_campaign(
+            ['to%s@example.net' % i for i in range(3)],
+            template_name='mailer/mail.tpl',
+            from_email='from@example.net',
+            extra_context={'subject': '件名', 'body': '本文'},
+            chunk_size=2,
+        )
+
+        self.assertEqual([r['sent'] for r in result.get()], [2, 1])
+        self.assertEqual(mailer_tasks.campaign_report(result.get())['sent'], 3)
+
+    def test_group_lazy(self):
+        # Each chunk is queued before the next one is read.
+        sent = []
+
+        def rows():
+            for i in range(4):
+                sent.append(len(django_mail.outbox))
+                yield 'to%s@example.net' % i
+
+        mailer_tasks.send_campaign(
+            rows(),
+            template_name='mailer/mail.tpl',
+            from_email='from@example.net',
+            extra_context={'subject': '件名', 'body': '本文'},
+            chunk_size=2,
+        )
+
+        self.assertEqual(sent, [0, 0, 2, 2])
+        self.assertEqual(len(django_mail.outbox), 4)
+
+    @override_settings(EMAIL_BACKEND='tests.test_mail.ErrorEmailBackend')
+    def test_chunk_retry(self):
+        with mock.patch.object(mailer_tasks.send_campaign_chunk, 'retry') as retry:
+            mailer_tasks.send_campaign_chunk([['件名', '本文', 'from@example.net',
+                                               ['to@example.net']]])
+
+        self.assertTrue(retry.called)
+        self.assertIsInstance(retry.call_args[1]['exc'], EmailError)
+
+    def test_chunk_permanent_error(self):
+        rows = [['件名', '本文', 'from@example.net', ['to@example.net']]]
+        with mock.patch.object(mailer_api, 'send_mass_mail',
+                               side_effect=smtplib.SMTPDataError(554, 'Rejected')), \
+                mock.patch.object(mailer_tasks.send_campaign_chunk, 'retry') as retry:
+            with self.assertRaises(smtplib.SMTPDataError):
+                mailer_tasks.send_campaign_chunk(rows)
+            summary = mailer_tasks.send_campaign_chunk(rows, fail_silently=True)
+
+        self.assertFalse(retry.called)
+        self.assertEqual(summary['failed_recipients'], ['to@example.net'])
+
+    def test_campaign_report(self):
+        report = mailer_tasks.campaign_report([
+            {'index': 1, 'sent': 1, 'failed': 1, 'duplicates': 0,
+             'failed_recipients': ['b@example.net'],
+             'started': 100.5, 'finished': 102.5, 'elapsed': 2.0},
+            {'index': 0, 'sent': 2, 'failed': 0, 'duplicates': 1,
+             'failed_recipients': [], 'started': 100.0, 'finished': 101.0, 'elapsed': 1.0},
+        ])
+
+        self.assertEqual(report['sent'], 3)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(report['duplicates'], 1)
+        # The chunks overlapped, so this is less than the sum of their times.
+        self.assertEqual(report['elapsed'], 2.5)
+        self.assertEqual([c['index'] for c in report['chunks']], [0, 1])
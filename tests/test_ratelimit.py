@@ -0,0 +1,219 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import TestCase as DjangoTestCase
+from django.test import override_settings
+
+from beproud.django.mailer import send_mail, send_mass_mail
+from beproud.django.mailer import ratelimit
+from beproud.django.mailer import tasks as mailer_tasks
+from beproud.django.mailer.ratelimit import (
+    CacheStore,
+    FileStore,
+    LocalStore,
+    RateLimiter,
+    RateLimitExceeded,
+    TokenBucket,
+)
+
+from tests.smtpserver import SMTPSink
+from tests.test_mail import MailTestCase
+
+__all__ = (
+    'TokenBucketTestCase',
+    'RateLimiterTestCase',
+    'RateLimitStoreTestCase',
+    'RateLimitBackendTestCase',
+)
+
+
+class TokenBucketTestCase(DjangoTestCase):
+
+    def test_parse_rate(self):
+        self.assertEqual(ratelimit.parse_rate('10/s'), (10, 1))
+        self.assertEqual(ratelimit.parse_rate('600/m'), (600, 60))
+        self.assertEqual(ratelimit.parse_rate('5/h'), (5, 3600))
+        self.assertEqual(ratelimit.parse_rate(3), (3, 1))
+
+    def test_consume(self):
+        store = LocalStore()
+        requests = [('key', 2.0, 2, 1)]
+
+        self.assertEqual(store.consume(requests, now=100), 0)
+        self.assertEqual(store.consume(requests, now=100), 0)
+        self.assertEqual(store.consume(requests, now=100), 0.5)
+        self.assertEqual(store.consume(requests, now=100.5), 0)
+
+    def test_all_or_nothing(self):
+        store = LocalStore()
+        store.consume([('a', 1.0, 1, 1)], now=100)
+
+        self.assertEqual(store.consume([('a', 1.0, 1, 1), ('b', 1.0, 1, 1)], now=100), 1)
+        # Nothing was taken from b.
+        self.assertEqual(store.consume([('b', 1.0, 1, 1)], now=100), 0)
+
+    def test_larger_than_capacity(self):
+        store = LocalStore()
+
+        self.assertEqual(store.consume([('key', 1.0, 5, 10)], now=100), 0)
+        self.assertEqual(store.consume([('key', 1.0, 5, 10)], now=100), 5)
+
+    def test_block(self):
+        bucket = TokenBucket('key', '20/s', capacity=1, store=LocalStore())
+        start = time.monotonic()
+        for i in range(3):
+            bucket.consume()
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_no_block(self):
+        bucket = TokenBucket('key', '1/m', store=LocalStore())
+        bucket.consume()
+
+        with self.assertRaises(RateLimitExceeded) as cm:
+            bucket.consume(block=False)
+        self.assertAlmostEqual(cm.exception.retry_after, 60, delta=1)
+
+
+class RateLimiterTestCase(DjangoTestCase):
+
+    def test_recipients(self):
+        limiter = RateLimiter({'recipients': '10/m'}, store=LocalStore(), block=False)
+        limiter.acquire(recipients=6)
+
+        self.assertEqual(limiter.try_acquire(recipients=4), 0)
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire(recipients=1)
+
+    def test_host(self):
+        limiter = RateLimiter({'messages': '10/s'}, {'slow.example.net': {'messages': '1/m'}},
+                              store=LocalStore(), block=False)
+        limiter.acquire('slow.example.net')
+
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire('slow.example.net')
+        limiter.acquire('fast.example.net')
+
+    def test_max_wait(self):
+        limiter = RateLimiter({'messages': '1/m'}, store=LocalStore(), max_wait=1)
+        limiter.acquire()
+
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire()
+
+    def test_get_rate_limiter(self):
+        self.assertIsNone(ratelimit.get_rate_limiter())
+        with override_settings(EMAIL_RATE_LIMITS={'messages': '1/s'},
+                               EMAIL_RATE_LIMIT_BLOCK=False):
+            limiter = ratelimit.get_rate_limiter()
+        self.assertFalse(limiter.block)
+        self.assertIs(limiter.store, ratelimit.get_store())
+
+
+class RateLimitStoreTestCase(DjangoTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_file_store(self):
+        path = os.path.join(self.tmpdir, 'ratelimit.json')
+        requests = [('key', 1.0, 1, 1)]
+
+        self.assertEqual(FileStore(path).consume(requests, now=100), 0)
+        # A second store on the same file, as in another process, shares the state.
+        self.assertEqual(FileStore(path).consume(requests, now=100), 1)
+
+    @override_settings(EMAIL_RATE_LIMIT_STORE='file')
+    def test_get_file_store(self):
+        path = os.path.join(self.tmpdir, 'ratelimit.json')
+        with override_settings(EMAIL_RATE_LIMIT_FILE=path):
+            store = ratelimit.get_store()
+        self.assertIsInstance(store, FileStore)
+        self.assertEqual(store.path, path)
+
+    def test_cache_store(self):
+        caches['default'].clear()
+        requests = [('key', 1.0, 1, 1)]
+
+        self.assertEqual(CacheStore().consume(requests, now=100), 0)
+        self.assertEqual(CacheStore().consume(requests, now=100), 1)
+        self.assertIsNone(caches['default'].get('bpmailer:ratelimit:lock'))
+
+    def test_cache_store_locked(self):
+        cache = caches['default']
+        cache.clear()
+        cache.set('bpmailer:ratelimit:lock', 'other', 60)
+        store = CacheStore()
+        store.lock_timeout = 0.01
+
+        self.assertEqual(store.consume([('key', 1.0, 1, 1)], now=100), store.lock_wait)
+        # Neither the state nor the other client's lock was touched.
+        self.assertIsNone(cache.get('bpmailer:ratelimit:key'))
+        self.assertEqual(cache.get('bpmailer:ratelimit:lock'), 'other')
+
+
+@override_settings(DEFAULT_CHARSET='utf-8')
+class RateLimitBackendTestCase(MailTestCase, DjangoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sink = SMTPSink().start()
+        self.settings_override = override_settings(
+            EMAIL_BACKEND='beproud.django.mailer.backends.smtp.EmailBackend',
+            EMAIL_HOST=self.sink.host,
+            EMAIL_PORT=self.sink.port,
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.sink.stop()
+        ratelimit.get_store().clear()
+        super().tearDown()
+
+    @override_settings(EMAIL_RATE_LIMITS={'messages': '1/m'}, EMAIL_RATE_LIMIT_BLOCK=False)
+    def test_no_block(self):
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        with self.assertRaises(RateLimitExceeded):
+            send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+        report = send_mass_mail([('件名', '本文', 'from@example.net', ['to@example.net'])],
+                                report=True)
+        self.assertIsInstance(report[0].exception, RateLimitExceeded)
+        self.assertEqual(len(self.sink.messages), 1)
+
+    @override_settings(EMAIL_RATE_LIMITS={'recipients': '20/s'})
+    def test_block(self):
+        start = time.monotonic()
+        send_mass_mail([
+            ('件名', '本文', 'from@example.net', ['to%s@example.net' % i for i in range(10)])
+            for j in range(3)
+        ])
+
+        # The bucket starts full with 20 tokens, the third message waits for 10 more.
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        self.assertEqual(len(self.sink.messages), 3)
+
+    @override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.asyncsmtp.EmailBackend',
+                       EMAIL_RATE_LIMITS={'messages': '1/m'}, EMAIL_RATE_LIMIT_BLOCK=False)
+    def test_async_backend(self):
+        num_sent = send_mass_mail([
+            ('件名', '本文', 'from@example.net', ['to%s@example.net' % i]) for i in range(3)
+        ], fail_silently=True)
+
+        self.assertEqual(num_sent, 1)
+
+    def test_task_countdown(self):
+        with mock.patch.object(mailer_tasks.mailer_api, 'send_mail',
+                               side_effect=RateLimitExceeded(42.5)), \
+                mock.patch.object(mailer_tasks.send_mail, 'retry') as retry:
+            mailer_tasks.send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        self.assertEqual(retry.call_args[1]['countdown'], 43)
@@ -0,0 +1,363 @@
+import time
+from unittest import mock
+
+from django.core import mail as django_mail
+from django.template import engines
+from django.template.backends.django import Template as DjangoTemplate
+from django.test import TestCase as DjangoTestCase
+from django.test import override_settings
+from django.utils import timezone, translation
+from django.utils.safestring import mark_safe
+
+from beproud.django.mailer import (
+    EmailMultiAlternatives,
+    mail_managers_template,
+    render_message,
+    render_messages,
+    send_template_mail,
+    send_template_mass_mail,
+)
+from beproud.django.mailer import rendering
+
+__all__ = (
+    'TemplateCacheTestCase',
+    'RenderMessagesTestCase',
+    'RenderCacheTestCase',
+    'MergeTemplateTestCase',
+    'SplitMessageTestCase',
+)
+
+
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.locmem.EmailBackend')
+@override_settings(EMAIL_TEMPLATE_CACHE=True)
+class TemplateCacheTestCase(DjangoTestCase):
+
+    def setUp(self):
+        self.cache = rendering.get_template_cache()
+        self.cache.clear()
+        django_mail.outbox = []
+
+    def test_hits(self):
+        context = {'subject': '件名', 'body': '本文'}
+        send_template_mail('mailer/mail.tpl', 'from@example.net', ['to@example.net'], context)
+        with override_settings(MANAGERS=(('Manager', 'manager@example.net'),)):
+            mail_managers_template('mailer/mail.tpl', context)
+
+        self.assertEqual((self.cache.misses, self.cache.hits), (1, 1))
+        self.assertIn('mailer/mail.tpl', self.cache)
+        self.assertEqual([m.subject for m in django_mail.outbox], ['件名', '件名'])
+        self.assertEqual(django_mail.outbox[1].body, django_mail.outbox[0].body)
+
+    @override_settings(EMAIL_TEMPLATE_CACHE=False)
+    def test_disabled(self):
+        render_message('mailer/mail.tpl', {'subject': '件名', 'body': '本文'})
+
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual((self.cache.misses, self.cache.hits), (0, 0))
+
+    def test_template_list(self):
+        names = ['mailer/missing.tpl', 'mailer/mail.tpl']
+        context = {'subject': '件名', 'body': '本文'}
+        for i in range(2):
+            self.assertEqual(render_message(names, context), ('件名', '本文\n'))
+        with override_settings(EMAIL_TEMPLATE_CACHE=False):
+            self.assertEqual(render_message(tuple(names), context), ('件名', '本文\n'))
+
+        self.assertEqual((self.cache.misses, self.cache.hits), (1, 1))
+        self.assertIn(tuple(names), self.cache)
+
+        send_template_mail(names, 'from@example.net', ['to@example.net'], context,
+                           html_template_name=['mailer/missing.tpl', 'mailer/html_mail.tpl'])
+        self.assertEqual(django_mail.outbox[0].subject, '件名')
+        self.assertEqual(list(render_messages(names, [context])), [('件名', '本文\n', None)])
+
+    def test_cleared_on_templates_change(self):
+        render_message('mailer/mail.tpl', {})
+        with override_settings(TEMPLATES=[]):
+            self.assertEqual(len(self.cache), 0)
+
+
+class BrokenValue(object):
+    def __str__(self):
+        raise ValueError('broken')
+
+
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.locmem.EmailBackend')
+@override_settings(EMAIL_TEMPLATE_CACHE=False)
+@override_settings(EMAIL_DEFAULT_CONTEXT={'subject': '既定の件名', 'body': '既定の本文'})
+class RenderMessagesTestCase(DjangoTestCase):
+
+    def setUp(self):
+        django_mail.outbox = []
+
+    def test_render_messages(self):
+        contexts = [{'subject': '件名%s' % i, 'html': '<p>%s</p>' % i} for i in range(3)]
+        contexts.append({})
+        with mock.patch('beproud.django.mailer.rendering.get_template',
+                        wraps=rendering.get_template) as get_template:
+            messages = list(render_messages('mailer/mail.tpl', contexts,
+                                            html_template_name='mailer/html_mail.tpl',
+                                            extra_context={'body': '本文'}))
+
+        self.assertEqual(get_template.call_count, 2)
+        self.assertEqual(messages, [
+            ('件名0', '本文\n', '<p>0</p>\n'),
+            ('件名1', '本文\n', '<p>1</p>\n'),
+            ('件名2', '本文\n', '<p>2</p>\n'),
+            ('既定の件名', '本文\n', '\n'),
+        ])
+        self.assertEqual(messages[0][:2], render_message(
+            'mailer/mail.tpl', {'subject': '件名0', 'body': '本文'}))
+
+    def test_send_template_mass_mail(self):
+        datatuple = (
+            (['to%s@example.net' % i], {'subject': '件名%s' % i, 'html': '<p>%s</p>' % i})
+            for i in range(5)
+        )
+
+        num_sent = send_template_mass_mail('mailer/mail.tpl', 'from@example.net', datatuple,
+                                           html_template_name='mailer/html_mail.tpl',
+                                           chunk_size=2)
+
+        self.assertEqual(num_sent, 5)
+        self.assertEqual([m.to for m in django_mail.outbox],
+                         [['to%s@example.net' % i] for i in range(5)])
+        message = django_mail.outbox[3]
+        self.assertIsInstance(message, EmailMultiAlternatives)
+        self.assertEqual((message.subject, message.body), ('件名3', '既定の本文\n'))
+        self.assertEqual(message.alternatives, [('<p>3</p>\n', 'text/html')])
+
+    def test_send_template_mass_mail_report(self):
+        report = send_template_mass_mail('mailer/mail.tpl', 'from@example.net', [
+            ('to1@example.net', {}),
+            ('to2@example.net', {'subject': '件名'}),
+        ], report=True)
+
+        self.assertEqual(report.num_sent, 2)
+        self.assertEqual([r.message.to for r in report], [['to1@example.net'], ['to2@example.net']])
+        self.assertFalse(isinstance(report[0].message, EmailMultiAlternatives))
+
+    def test_render_error(self):
+        datatuple = [
+            ('to1@example.net', {}),
+            ('to2@example.net', {'subject': BrokenValue()}),
+            ('to3@example.net', {}),
+        ]
+
+        with self.assertRaises(ValueError):
+            send_template_mass_mail('mailer/mail.tpl', 'from@example.net', datatuple)
+
+        num_sent = send_template_mass_mail('mailer/mail.tpl', 'from@example.net', datatuple,
+                                           fail_silently=True)
+        self.assertEqual(num_sent, 2)
+        self.assertEqual(django_mail.outbox[-1].to, ['to3@example.net'])
+
+    def test_missing_template(self):
+        self.assertIsNone(send_template_mass_mail(
+            'mailer/missing.tpl', 'from@example.net', [('to@example.net', {})],
+            fail_silently=True))
+
+
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.locmem.EmailBackend')
+@override_settings(MANAGERS=(('Manager', 'manager@example.net'),))
+@override_settings(EMAIL_RENDER_CACHE='local')
+class RenderCacheTestCase(DjangoTestCase):
+
+    def setUp(self):
+        self.store = rendering.get_render_store()
+        self.store.clear()
+        django_mail.outbox = []
+
+    def _render(self, context, template_name='mailer/mail.tpl'):
+        with mock.patch('beproud.django.mailer.rendering.get_mail_template',
+                        wraps=rendering.get_mail_template) as get_mail_template:
+            result = render_message(template_name, context)
+        return result, get_mail_template.called
+
+    def test_memoized(self):
+        context = {'subject': '件名', 'body': '本文', 'items': [1, 2.5, None, True]}
+        first, rendered = self._render(context)
+        self.assertTrue(rendered)
+        second, rendered = self._render(dict(reversed(list(context.items()))))
+        self.assertFalse(rendered)
+        self.assertEqual(first, second)
+
+        changed, rendered = self._render(dict(context, body='別の本文'))
+        self.assertTrue(rendered)
+        self.assertEqual(changed, ('件名', '別の本文\n'))
+        self.assertEqual((self.store.hits, self.store.misses), (1, 2))
+
+    def test_mail_managers_template(self):
+        for i in range(3):
+            mail_managers_template('mailer/mail.tpl', {'subject': '件名', 'body': '本文'})
+
+        self.assertEqual((self.store.hits, self.store.misses), (2, 1))
+        self.assertEqual(len(django_mail.outbox), 3)
+
+    def test_unhashable_context(self):
+        for context in [{'subject': object()}, {'subject': mark_safe('<b>')}, {1: 'a'}]:
+            self.assertIsNone(rendering.context_key('mailer/mail.tpl', context))
+            self.assertTrue(self._render(context)[1])
+            self.assertTrue(self._render(context)[1])
+        self.assertEqual(len(self.store.cache), 0)
+
+    def test_language(self):
+        template = engines['django'].from_string(
+            '{% load i18n %}{% get_current_language as lang %}{{ subject }}\n{{ lang }}')
+        results = []
+        with mock.patch('beproud.django.mailer.rendering.get_mail_template',
+                        return_value=template):
+            for lang in ['ja', 'en', 'ja']:
+                with translation.override(lang):
+                    results.append(render_message('mailer/i18n.tpl', {'subject': '件名'}))
+
+        self.assertEqual(results, [('件名', 'ja'), ('件名', 'en'), ('件名', 'ja')])
+        self.assertEqual((self.store.hits, self.store.misses), (1, 2))
+
+    @override_settings(USE_TZ=True)
+    def test_timezone(self):
+        context = {'subject': '件名'}
+        with timezone.override('Asia/Tokyo'):
+            key = rendering.context_key('mailer/mail.tpl', context)
+        with timezone.override('UTC'):
+            self.assertNotEqual(rendering.context_key('mailer/mail.tpl', context), key)
+
+    @override_settings(EMAIL_RENDER_CACHE_SIZE=2)
+    def test_size(self):
+        store = rendering.get_render_store()
+        for i in range(3):
+            self._render({'subject': '件名%s' % i})
+
+        self.assertEqual(len(store.cache), 2)
+        self.assertTrue(self._render({'subject': '件名0'})[1])
+        self.assertFalse(self._render({'subject': '件名2'})[1])
+
+    @override_settings(EMAIL_RENDER_CACHE_TTL=0.05)
+    def test_ttl(self):
+        self._render({'subject': '件名'})
+        self.assertFalse(self._render({'subject': '件名'})[1])
+        time.sleep(0.1)
+        self.assertTrue(self._render({'subject': '件名'})[1])
+
+    @override_settings(EMAIL_RENDER_CACHE='cache')
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'bpmailer-render-tests',
+    }})
+    def test_django_cache(self):
+        store = rendering.get_render_store()
+        self.assertIsInstance(store, rendering.CacheRenderStore)
+        store.cache.clear()
+
+        first, rendered = self._render({'subject': '件名'})
+        self.assertTrue(rendered)
+        second, rendered = self._render({'subject': '件名'})
+        self.assertFalse(rendered)
+        self.assertEqual(first, second)
+
+    @override_settings(EMAIL_RENDER_CACHE=None)
+    def test_disabled(self):
+        self.assertIsNone(rendering.get_render_store())
+        self._render({'subject': '件名'})
+        self.assertTrue(self._render({'subject': '件名'})[1])
+
+
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.locmem.EmailBackend')
+@override_settings(EMAIL_TEMPLATE_CACHE=False)
+class MergeTemplateTestCase(DjangoTestCase):
+
+    def _template(self, source):
+        return engines['django'].from_string(source)
+
+    def _merge(self, source, context, fields=('name', 'url')):
+        template = self._template(source)
+        return template, rendering.MergeTemplate(template, {'shared': '<共通>'}, fields)
+
+    def test_fill(self):
+        source = ('{{ shared }} {{ name }} <a href="{{ url }}">{{ name|safe }}</a>'
+                  '{% autoescape off %}{{ name }}{% endautoescape %}{{ name|escape }}')
+        template, merge = self._merge(source, {})
+        self.assertTrue(merge.valid)
+
+        for context in [{'name': '<b>&"\'', 'url': 'http://example.net/?a=1&b=2'},
+                        {'name': mark_safe('<i>'), 'url': 100000}]:
+            self.assertTrue(merge.can_fill(context))
+            self.assertEqual(merge.fill(context),
+                             template.render(dict(context, shared='<共通>')))
+
+    def test_invalid(self):
+        for source in ['{% if name %}{{ name }}{% endif %}', '{{ name|upper }}', '{{ name|lower }}',
+                       '{{ name.first }}', '{{ name|length }}', '{{ name|urlencode }}',
+                       '{% for c in name %}{{ c }}{% endfor %}', '{{ name|truncatechars:3 }}',
+                       '{% if name == "a" %}a{% endif %}', '{{ name|capfirst }}',
+                       '{{ name|truncatewords:1 }}', '{{ name|truncatechars:100 }}',
+                       '{{ name|ljust:40 }}', '{{ name|rjust:40 }}', '{{ name|center:40 }}',
+                       '{{ name|cut:"a" }}', '{% with other=name %}{{ other }}{% endwith %}',
+                       '{{ url|default:name }}', '{% filter upper %}{{ name }}{% endfilter %}',
+                       '{% spaceless %}{{ name }}{% endspaceless %}',
+                       '{% include "mailer/mail.tpl" %}']:
+            template, merge = self._merge(source, {})
+            self.assertFalse(merge.valid, source)
+            self.assertFalse(merge.can_fill({'name': 'a', 'url': 'b'}))
+
+    def test_can_fill(self):
+        template, merge = self._merge('{{ name }}{{ url }}', {})
+
+        self.assertTrue(merge.can_fill({'name': 'a', 'url': 1}))
+        self.assertFalse(merge.can_fill({'name': 'a\nb', 'url': 'b'}))
+        self.assertFalse(merge.can_fill({'name': 'a'}))
+        self.assertFalse(merge.can_fill({'name': 'a', 'url': 'b', 'other': 'c'}))
+        self.assertFalse(merge.can_fill({'name': 'a', 'url': None}))
+        self.assertFalse(merge.can_fill({'name': 'a', 'url': 1.5}))
+
+    def test_render_messages(self):
+        contexts = [
+            {'subject': '件名%s' % i, 'html': '<a href="/c/%s?a&b">クーポン</a>' % i}
+            for i in range(5)
+        ]
+        # Contexts the skeleton can't be used for are rendered in full.
+        contexts.append({'subject': '改行\nあり', 'html': 'a'})
+        contexts.append({'subject': '件名', 'html': 'a', 'body': '本文'})
+
+        expected = list(render_messages('mailer/mail.tpl', contexts,
+                                        html_template_name='mailer/html_mail.tpl',
+                                        extra_context={'body': '<本文>'}))
+        with mock.patch.object(DjangoTemplate, 'render', autospec=True,
+                               side_effect=DjangoTemplate.render) as render:
+            merged = list(render_messages('mailer/mail.tpl', contexts,
+                                          html_template_name='mailer/html_mail.tpl',
+                                          extra_context={'body': '<本文>'},
+                                          merge_fields=['subject', 'html']))
+
+        self.assertEqual(merged, expected)
+        # Two skeletons plus the two fallback messages, two templates each.
+        self.assertEqual(render.call_count, 6)
+
+    def test_send_template_mass_mail(self):
+        send_template_mass_mail('mailer/mail.tpl', 'from@example.net', [
+            ('to%s@example.net' % i, {'subject': '件名%s' % i}) for i in range(3)
+        ], extra_context={'body': '本文'}, merge_fields=['subject'])
+
+        self.assertEqual([(m.subject, m.body) for m in django_mail.outbox],
+                         [('件名%s' % i, '本文\n') for i in range(3)])
+
+
+class SplitMessageTestCase(DjangoTestCase):
+
+    def test_split(self):
+        self.assertEqual(rendering.split_message('件名\n本文\n2行目'), ('件名', '本文\n2行目'))
+
+    def test_newlines(self):
+        for text in ['件名\r\n本文\r\n2行目\r\n', '件名\r本文\r2行目\r', '件名\n本文\r\n2行目\r']:
+            self.assertEqual(rendering.split_message(text), ('件名', '本文\n2行目\n'))
+
+    def test_subject_only(self):
+        self.assertEqual(rendering.split_message('件名'), ('件名', ''))
+        self.assertEqual(rendering.split_message('件名\n'), ('件名', ''))
+        self.assertEqual(rendering.split_message(''), ('', ''))
+
+    def test_same_as_split_lines(self):
+        text = '\r\n件名\n\n本文\r\r\n\n'
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+
+        self.assertEqual(rendering.split_message(text), (lines[0], '\n'.join(lines[1:])))
@@ -0,0 +1,753 @@
+import asyncio
+import email
+import os
+import smtplib
+import tempfile
+from email.charset import BASE64
+import time
+from unittest import mock
+
+from django.test import TestCase as DjangoTestCase
+from django.test import override_settings
+
+from beproud.django.mailer import (
+    EmailMessage,
+    FileAttachment,
+    send_mail,
+    send_mass_mail,
+    send_template_mail,
+)
+from beproud.django.mailer.backends import asyncsmtp, multirelay, sharded
+from beproud.django.mailer.backends import pool as smtp_pool
+from beproud.django.mailer.backends.smtp import ChunkWriter
+from beproud.django.mailer.backends.smtp import EmailBackend as SMTPEmailBackend
+
+from tests.smtpserver import SMTPSink
+from tests.test_mail import MailTestCase
+
+__all__ = (
+    'SMTPConnectionPoolTestCase',
+    'SMTPPipeliningTestCase',
+    'SMTPTransferModeTestCase',
+    'AsyncSMTPBackendTestCase',
+    'MultiRelayBackendTestCase',
+    'ShardedBackendTestCase',
+)
+
+
+class SMTPTestCase(MailTestCase):
+    sink_options = {}
+    backend = 'beproud.django.mailer.backends.smtp.EmailBackend'
+
+    def setUp(self):
+        super().setUp()
+        self.sink = SMTPSink(**self.sink_options).start()
+        self.settings_override = override_settings(
+            EMAIL_BACKEND=self.backend,
+            EMAIL_HOST=self.sink.host,
+            EMAIL_PORT=self.sink.port,
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        smtp_pool.close_pools()
+        self.sink.stop()
+        super().tearDown()
+
+
+@override_settings(DEFAULT_CHARSET='utf-8')
+@override_settings(EMAIL_CHARSET='iso-2022-jp')
+@override_settings(EMAIL_SMTP_POOL_SIZE=2)
+class SMTPConnectionPoolTestCase(SMTPTestCase, DjangoTestCase):
+
+    def test_connection_reused(self):
+        for i in range(5):
+            send_mail('件名', '本文', 'from@example.net', ['to%s@example.net' % i])
+
+        self.assertEqual(len(self.sink.messages), 5)
+        self.assertEqual(self.sink.connections, 1)
+        self.assertEqual(self.sink.messages[4]['rcpt_tos'], ['to4@example.net'])
+
+    def test_noop_on_checkout(self):
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        self.assertEqual(self.sink.commands.count('NOOP'), 1)
+
+    @override_settings(EMAIL_SMTP_POOL_MAX_MESSAGES=2)
+    def test_max_messages(self):
+        for i in range(5):
+            send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        self.assertEqual(len(self.sink.messages), 5)
+        self.assertEqual(self.sink.connections, 3)
+
+    @override_settings(EMAIL_SMTP_POOL_MAX_AGE=0)
+    def test_max_age(self):
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        self.assertEqual(self.sink.connections, 2)
+
+    @override_settings(EMAIL_SMTP_POOL_IDLE_TIMEOUT=0)
+    def test_idle_reaping(self):
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        pool = SMTPEmailBackend()._get_pool()
+        self.assertEqual(pool._idle, [])
+        self.assertEqual(pool._num_open, 0)
+
+    def test_broken_connection_replaced(self):
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+        pool = SMTPEmailBackend()._get_pool()
+        pool._idle[0].connection.close()
+
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        self.assertEqual(len(self.sink.messages), 2)
+        self.assertEqual(self.sink.connections, 2)
+
+    def test_pool_size(self):
+        backends = [SMTPEmailBackend() for i in range(2)]
+        for backend in backends:
+            backend.open()
+        pool = backends[0]._get_pool()
+        pool.timeout = 0
+
+        with self.assertRaises(smtp_pool.PoolTimeout):
+            SMTPEmailBackend().open()
+
+        backends[0].close()
+        backend = SMTPEmailBackend()
+        self.assertTrue(backend.open())
+        backend.close()
+        backends[1].close()
+        self.assertEqual(self.sink.connections, 2)
+
+    def test_mass_mail(self):
+        send_mass_mail((
+            '件名',
+            '本文',
+            'from@example.net',
+            ['to%s@example.net' % i],
+        ) for i in range(10))
+        send_mass_mail((
+            '件名',
+            '本文',
+            'from@example.net',
+            ['to%s@example.net' % i],
+        ) for i in range(10))
+
+        self.assertEqual(len(self.sink.messages), 20)
+        self.assertEqual(self.sink.connections, 1)
+
+    @override_settings(EMAIL_SMTP_POOL_SIZE=0)
+    def test_pool_disabled(self):
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        self.assertEqual(self.sink.connections, 2)
+        self.assertEqual(self.sink.commands.count('QUIT'), 2)
+
+    def test_refused_keeps_connection(self):
+        self.sink.refuse.add('bad@example.net')
+        message = EmailMessage('件名', '本文', 'from@example.net', ['bad@example.net'])
+        backend = SMTPEmailBackend()
+        with mock.patch.object(smtp_pool.SMTPConnectionPool, '_discard') as discard:
+            with self.assertRaises(Exception):
+                backend.send_messages([message])
+            self.assertFalse(discard.called)
+
+        # The connection was checked back in.
+        pool = backend._get_pool()
+        self.assertEqual(len(pool._idle), 1)
+        self.assertEqual(pool._num_open, 1)
+        self.assertIsNone(backend.connection)
+
+    @override_settings(EMAIL_SMTP_POOL_SIZE=2)
+    def test_refused_releases_slot(self):
+        self.sink.refuse.add('bad@example.net')
+        for i in range(3):
+            with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                send_mail('件名', '本文', 'from@example.net', ['bad@example.net'])
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        self.assertEqual(len(self.sink.messages), 1)
+
+
+@override_settings(DEFAULT_CHARSET='utf-8')
+class SMTPPipeliningTestCase(SMTPTestCase, DjangoTestCase):
+
+    def _send(self, *recipients, **kwargs):
+        message = EmailMessage('件名', kwargs.get('body', '本文'), 'from@example.net',
+                               list(recipients))
+        return SMTPEmailBackend().send_messages([message])
+
+    def test_envelope_in_one_write(self):
+        send = smtplib.SMTP.send
+        writes = []
+
+        def record_send(connection, data):
+            writes.append(data)
+            return send(connection, data)
+
+        with mock.patch.object(smtplib.SMTP, 'send', autospec=True, side_effect=record_send):
+            self._send('to1@example.net', 'to2@example.net', 'to3@example.net')
+
+        self.assertEqual(
+            writes[1],
+            'mail FROM:<from@example.net> BODY=8BITMIME\r\n'
+            'rcpt TO:<to1@example.net>\r\n'
+            'rcpt TO:<to2@example.net>\r\n'
+            'rcpt TO:<to3@example.net>\r\n'
+            'data\r\n'
+        )
+        self.assertEqual(self.sink.messages[0]['rcpt_tos'],
+                         ['to1@example.net', 'to2@example.net', 'to3@example.net'])
+
+    def test_utf8_body(self):
+        self.assertEqual(self._send('to@example.net'), 1)
+
+        data = self.sink.messages[0]['data']
+        self.assertIn(b'Content-Transfer-Encoding: 8bit', data)
+        self.assertTrue(data.endswith('本文\r\n'.encode()))
+
+    def test_dot_stuffing(self):
+        self._send('to@example.net', body='本文\n.\n..テスト\n.')
+
+        self.assertTrue(self.sink.messages[0]['data'].endswith(
+            '本文\r\n.\r\n..テスト\r\n.\r\n'.encode()))
+
+    def test_refused_recipients(self):
+        self.sink.refuse.add('bad@example.net')
+        backend = SMTPEmailBackend()
+        backend.open()
+        message = EmailMessage('件名', '本文', 'from@example.net',
+                               ['to@example.net', 'bad@example.net'])
+
+        refused = backend._send_message(message)
+        backend.close()
+
+        self.assertEqual(refused, {'bad@example.net': (550, b'No such user')})
+        self.assertEqual(self.sink.messages[0]['rcpt_tos'], ['to@example.net'])
+
+    def test_all_recipients_refused(self):
+        self.sink.refuse.update(['bad1@example.net', 'bad2@example.net'])
+
+        with self.assertRaises(smtplib.SMTPRecipientsRefused) as cm:
+            self._send('bad1@example.net', 'bad2@example.net')
+
+        self.assertEqual(set(cm.exception.recipients), {'bad1@example.net', 'bad2@example.net'})
+        self.assertEqual(self.sink.messages, [])
+        self.assertIn('RSET', self.sink.commands)
+
+    def test_without_pipelining(self):
+        self.sink.extensions.remove('PIPELINING')
+        self.sink.refuse.add('bad@example.net')
+
+        with mock.patch.object(smtplib.SMTP, 'sendmail', autospec=True,
+                               side_effect=smtplib.SMTP.sendmail) as sendmail:
+            self._send('to@example.net', 'bad@example.net')
+
+        self.assertTrue(sendmail.called)
+        self.assertEqual(self.sink.messages[0]['rcpt_tos'], ['to@example.net'])
+
+    @override_settings(EMAIL_USE_PIPELINING=False)
+    def test_pipelining_disabled(self):
+        with mock.patch.object(smtplib.SMTP, 'sendmail', autospec=True,
+                               side_effect=smtplib.SMTP.sendmail) as sendmail:
+            self._send('to@example.net')
+
+        self.assertTrue(sendmail.called)
+
+    def test_report(self):
+        self.sink.refuse.update(['bad1@example.net', 'bad2@example.net'])
+
+        report = send_mass_mail((
+            ('件名', '本文', 'from@example.net', ['to@example.net', 'bad1@example.net']),
+            ('件名', '本文', 'from@example.net', ['bad2@example.net']),
+            ('件名', '本文', 'from@example.net', ['to@example.net']),
+        ), report=True)
+
+        self.assertEqual(report.num_sent, 2)
+        self.assertEqual([r.code for r in report], [250, 550, 250])
+        self.assertEqual(report[0].accepted, ['to@example.net'])
+        self.assertEqual(report[0].refused, {'bad1@example.net': (550, b'No such user')})
+        self.assertEqual(report.refused, [report[0]])
+        self.assertEqual(report.failed, [report[1]])
+        self.assertIsInstance(report[1].exception, smtplib.SMTPRecipientsRefused)
+        self.assertEqual(len(self.sink.messages), 2)
+        self.assertIn(report[0].message_id.encode(), self.sink.messages[0]['data'])
+
+    def test_coalesce(self):
+        self.sink.refuse.add('bad@example.net')
+
+        report = send_mass_mail([
+            ('件名', '本文', 'from@example.net', [address])
+            for address in ['to1@example.net', 'bad@example.net', 'to2@example.net']
+        ], coalesce=True, report=True)
+
+        self.assertEqual(len(self.sink.messages), 1)
+        self.assertEqual(self.sink.messages[0]['rcpt_tos'], ['to1@example.net', 'to2@example.net'])
+        self.assertEqual([r.sent for r in report], [True, False, True])
+        self.assertEqual(report[1].refused, {'bad@example.net': (550, b'No such user')})
+        self.assertEqual(report.failed_messages(), [report[1].message])
+
+    def _file_message(self, content):
+        f = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+        self.addCleanup(os.unlink, f.name)
+        with f:
+            f.write(content)
+        message = EmailMessage('件名', '本文', 'from@example.net', ['to@example.net'])
+        message.attach(FileAttachment(f.name, mimetype='application/octet-stream'))
+        return message
+
+    def test_file_attachment(self):
+        self.sink.extensions.append('SIZE')
+        message = self._file_message(os.urandom(300000))
+        expected = message.message().as_bytes(linesep='\r\n')
+
+        with mock.patch.object(message, 'message_bytes') as message_bytes:
+            self.assertEqual(SMTPEmailBackend().send_messages([message]), 1)
+
+        self.assertFalse(message_bytes.called)
+        self.assertEqual(self.sink.messages[0]['data'], expected)
+        self.assertEqual(self.sink.messages[0]['mail_options'],
+                         ['size=%d' % len(expected), 'BODY=8BITMIME'])
+
+    def test_file_attachment_without_pipelining(self):
+        self.sink.extensions.remove('PIPELINING')
+        self.sink.refuse.add('bad@example.net')
+        message = self._file_message(b'data')
+        message.to.append('bad@example.net')
+
+        refused = SMTPEmailBackend().send_messages_report([message])[0].refused
+
+        self.assertEqual(refused, {'bad@example.net': (550, b'No such user')})
+        self.assertEqual(self.sink.messages[0]['rcpt_tos'], ['to@example.net'])
+        self.assertEqual(self.sink.messages[0]['data'],
+                         message.message().as_bytes(linesep='\r\n'))
+
+    @override_settings(EMAIL_STREAM_THRESHOLD=1000)
+    def test_generated_stream(self):
+        self.sink.extensions.append('SIZE')
+        small = EmailMessage('件名', '本文', 'from@example.net', ['to@example.net'])
+        large = EmailMessage('件名', '本文\n.\n' * 1000, 'from@example.net', ['to@example.net'],
+                             attachments=[('test.bin', os.urandom(200000), None)])
+        expected = large.message().as_bytes(linesep='\r\n')
+
+        with mock.patch.object(large, 'message_bytes') as message_bytes:
+            self.assertEqual(SMTPEmailBackend().send_messages([small, large]), 2)
+
+        self.assertFalse(message_bytes.called)
+        self.assertEqual(self.sink.messages[1]['data'], expected)
+        # The size of a generated message isn't known before it is sent.
+        self.assertEqual(self.sink.messages[0]['mail_options'],
+                         ['size=%d' % len(small.message_bytes()), 'BODY=8BITMIME'])
+        self.assertEqual(self.sink.messages[1]['mail_options'], ['BODY=8BITMIME'])
+
+    def test_stream_dot_stuffing(self):
+        from beproud.django.mailer.backends.smtp import DataWriter, quote_data
+        data = b'.a\r\n.b\r\nc.\r\n..d\r\n.'
+        for size in range(1, 6):
+            connection = mock.Mock()
+            writer = DataWriter(connection)
+            writer.buffer_size = 3
+            for i in range(0, len(data), size):
+                writer.write(data[i:i + size])
+            writer.close()
+            written = b''.join(c[0][0] for c in connection.send.call_args_list)
+            self.assertEqual(written, quote_data(data))
+
+    def test_report_connection_error(self):
+        self.sink.stop()
+
+        report = send_mass_mail((
+            ('件名', '本文', 'from@example.net', ['to%s@example.net' % i]) for i in range(2)
+        ), fail_silently=True, report=True)
+
+        self.assertEqual(len(report.failed), 2)
+        self.assertIsInstance(report[0].exception, OSError)
+        self.sink.start()
+
+
+@override_settings(DEFAULT_CHARSET='utf-8')
+@override_settings(EMAIL_CHARSET='utf-8')
+class SMTPTransferModeTestCase(SMTPTestCase, DjangoTestCase):
+
+    def _send(self, *recipients, **kwargs):
+        message = EmailMessage('件名', kwargs.get('body', '本文\n.\n'), 'from@example.net',
+                               list(recipients) or ['to@example.net'])
+        for attachment in kwargs.get('attachments', []):
+            message.attach(attachment)
+        self.assertEqual(SMTPEmailBackend().send_messages([message]), 1)
+        return message
+
+    def _transfer_encodings(self, i=0):
+        msg = email.message_from_bytes(self.sink.messages[i]['data'])
+        return [part['Content-Transfer-Encoding'] for part in msg.walk()
+                if not part.is_multipart()]
+
+    @override_settings(EMAIL_USE_8BITMIME=True)
+    def test_8bitmime(self):
+        with mock.patch('beproud.django.mailer.api.utf8_charset.body_encoding', BASE64):
+            message = self._send()
+            # The message built for other backends keeps the configured encoding.
+            self.assertEqual(message.message()['Content-Transfer-Encoding'], 'base64')
+
+        self.assertEqual(self._transfer_encodings(), ['8bit'])
+        self.assertEqual(self.sink.messages[0]['mail_options'], ['BODY=8BITMIME'])
+        self.assertTrue(self.sink.messages[0]['data'].endswith('本文\r\n.\r\n'.encode()))
+
+    @override_settings(EMAIL_USE_8BITMIME=True)
+    def test_8bitmime_long_lines(self):
+        with mock.patch('beproud.django.mailer.api.utf8_charset.body_encoding', BASE64):
+            self._send(body='あ' * 400)
+
+        self.assertEqual(self._transfer_encodings(), ['base64'])
+
+    def test_without_8bitmime(self):
+        self.sink.extensions.remove('8BITMIME')
+        self._send()
+
+        self.assertEqual(self._transfer_encodings(), ['base64'])
+        self.assertEqual(self.sink.messages[0]['mail_options'], [])
+
+    def test_chunking(self):
+        self.sink.extensions.append('CHUNKING')
+        message = self._send()
+
+        data = self.sink.messages[0]['data']
+        self.assertEqual(data, message.message_bytes())
+        self.assertIn('BDAT %d LAST' % len(data), self.sink.commands)
+        self.assertNotIn('DATA', self.sink.commands)
+
+    @mock.patch.object(ChunkWriter, 'buffer_size', 10000)
+    def test_chunking_stream(self):
+        self.sink.extensions.append('CHUNKING')
+        f = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.unlink, f.name)
+        with f:
+            f.write(os.urandom(300000))
+        message = self._send(attachments=[FileAttachment(f.name)])
+
+        self.assertEqual(self.sink.messages[0]['data'], message.message_stream().getvalue())
+        bdat = [c for c in self.sink.commands if c.startswith('BDAT')]
+        self.assertGreater(len(bdat), 3)
+        self.assertTrue(bdat[-1].endswith(' LAST'))
+
+    def test_chunking_without_pipelining(self):
+        self.sink.extensions.remove('PIPELINING')
+        self.sink.extensions.append('CHUNKING')
+        self.sink.refuse.add('bad@example.net')
+        message = self._send('to@example.net', 'bad@example.net')
+
+        self.assertEqual(self.sink.messages[0]['rcpt_tos'], ['to@example.net'])
+        self.assertEqual(self.sink.messages[0]['data'], message.message_bytes())
+
+    def test_smtputf8(self):
+        self.sink.extensions.append('SMTPUTF8')
+        self._send('ユーザー@example.net')
+
+        self.assertEqual(self.sink.messages[0]['rcpt_tos'], ['ユーザー@example.net'])
+        self.assertIn('SMTPUTF8', self.sink.messages[0]['mail_options'])
+
+
+@override_settings(DEFAULT_CHARSET='utf-8')
+@override_settings(EMAIL_ASYNC_SMTP_CONCURRENCY=4)
+class AsyncSMTPBackendTestCase(SMTPTestCase, DjangoTestCase):
+    backend = 'beproud.django.mailer.backends.asyncsmtp.EmailBackend'
+
+    def _received(self, i=0):
+        return email.message_from_bytes(self.sink.messages[i]['data'])
+
+    def test_send_mail(self):
+        send_mail('件名', '本文', '差出人 <from@example.net>', ['宛先 <to@example.net>'],
+                  cc=['cc@example.net'], bcc=['bcc@example.net'])
+
+        self.assertEqual(len(self.sink.messages), 1)
+        self.assertEqual(self.sink.messages[0]['mail_from'], 'from@example.net')
+        self.assertEqual(self.sink.messages[0]['rcpt_tos'],
+                         ['to@example.net', 'cc@example.net', 'bcc@example.net'])
+        message = self._received()
+        self.assertEqual(message['Subject'], '=?utf-8?b?5Lu25ZCN?=')
+        self.assertEqual(message['To'], '=?utf-8?b?5a6b5YWI?= <to@example.net>')
+        self.assertEqual(message['Cc'], 'cc@example.net')
+        self.assertEqual(message['Bcc'], None)
+        self.assertEqual(message.get_payload(decode=True), '本文\r\n'.encode())
+
+    def test_send_template_mail(self):
+        send_template_mail(
+            'mailer/mail.tpl',
+            'from@example.net',
+            ['to@example.net'],
+            extra_context={
+                'subject': '件名',
+                'body': '本文',
+                'html': '<h1>本文</h1>',
+            },
+            html_template_name='mailer/html_mail.tpl',
+            attachments=[('test.binary', 'データ'.encode(), None)],
+        )
+
+        message = self._received()
+        self.assertEqual(message['Subject'], '=?utf-8?b?5Lu25ZCN?=')
+        alternatives, attachment = message.get_payload()
+        self.assertEqual(alternatives.get_payload()[1].get_payload(decode=True),
+                         '<h1>本文</h1>\r\n'.encode())
+        self.assertEqual(attachment.get_payload(decode=True), 'データ'.encode())
+
+    def test_mass_mail_concurrent(self):
+        self.sink.delay = 0.05
+        start = time.monotonic()
+        num_sent = send_mass_mail((
+            '件名',
+            '本文',
+            'from@example.net',
+            ['to%s@example.net' % i],
+        ) for i in range(20))
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(num_sent, 20)
+        self.assertEqual(sorted(m['rcpt_tos'][0] for m in self.sink.messages),
+                         sorted('to%s@example.net' % i for i in range(20)))
+        self.assertEqual(self.sink.connections, 4)
+        # Serially this takes at least 20 * 0.05 seconds.
+        self.assertLess(elapsed, 0.5)
+
+    def test_asend_messages(self):
+        backend = asyncsmtp.EmailBackend()
+        messages = [EmailMessage('件名', '本文', 'from@example.net', ['to@example.net'])
+                    for i in range(3)]
+
+        self.assertEqual(asyncio.run(backend.asend_messages(messages)), 3)
+        self.assertEqual(len(self.sink.messages), 3)
+
+    def test_send_messages_in_running_loop(self):
+        backend = asyncsmtp.EmailBackend()
+        messages = [EmailMessage('件名', '本文', 'from@example.net', ['to@example.net'])]
+
+        async def send():
+            return backend.send_messages(messages)
+
+        self.assertEqual(asyncio.run(send()), 1)
+
+    def test_fail_loud(self):
+        self.sink.refuse.add('bad@example.net')
+
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            send_mail('件名', '本文', 'from@example.net', ['bad@example.net'])
+
+    def test_fail_silently(self):
+        self.sink.refuse.add('bad@example.net')
+
+        num_sent = send_mass_mail((
+            ('件名', '本文', 'from@example.net', ['bad@example.net']),
+            ('件名', '本文', 'from@example.net', ['to@example.net']),
+        ), fail_silently=True)
+
+        self.assertEqual(num_sent, 1)
+        self.assertEqual(self.sink.messages[0]['rcpt_tos'], ['to@example.net'])
+
+    def test_partially_refused(self):
+        self.sink.refuse.add('bad@example.net')
+
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net', 'bad@example.net'])
+
+        self.assertEqual(self.sink.messages[0]['rcpt_tos'], ['to@example.net'])
+
+    @override_settings(EMAIL_HOST_USER='user', EMAIL_HOST_PASSWORD='secret')
+    def test_login(self):
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        self.assertEqual(self.sink.auth, [[b'user', b'secret']])
+
+    def test_report(self):
+        self.sink.refuse.add('bad@example.net')
+
+        report = send_mass_mail(
+            [('件名', '本文', 'from@example.net', ['bad@example.net'])]
+            + [('件名', '本文', 'from@example.net', ['to%s@example.net' % i]) for i in range(5)],
+            report=True)
+
+        self.assertEqual(len(report), 6)
+        self.assertEqual(report.num_sent, 5)
+        self.assertEqual(report[0].code, 550)
+        self.assertEqual([r.accepted for r in report[1:]],
+                         [['to%s@example.net' % i] for i in range(5)])
+
+
+@override_settings(DEFAULT_CHARSET='utf-8')
+@override_settings(EMAIL_BACKEND='beproud.django.mailer.backends.multirelay.EmailBackend')
+@override_settings(EMAIL_RELAY_MAX_FAILURES=2)
+class MultiRelayBackendTestCase(MailTestCase, DjangoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sinks = [SMTPSink().start() for i in range(3)]
+        self.relays = [{'host': sink.host, 'port': sink.port, 'weight': 1}
+                       for sink in self.sinks]
+        self.settings_override = override_settings(EMAIL_RELAYS=self.relays)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        multirelay.reset_relay_states()
+        for sink in self.sinks:
+            if sink.port is not None:
+                sink.stop()
+        super().tearDown()
+
+    def _send_mass_mail(self, count, **kwargs):
+        return send_mass_mail(((
+            '件名',
+            '本文',
+            'from@example.net',
+            ['to%s@example.net' % i],
+        ) for i in range(count)), **kwargs)
+
+    def _stop(self, sink):
+        sink.stop()
+        sink.port = None
+
+    def test_spread_over_relays(self):
+        self.assertEqual(self._send_mass_mail(60), 60)
+
+        counts = [len(sink.messages) for sink in self.sinks]
+        self.assertEqual(sum(counts), 60)
+        self.assertTrue(all(counts), counts)
+
+    def test_weights(self):
+        self.relays[0]['weight'] = 100
+        self.relays[1]['weight'] = 0
+        self.relays[2]['weight'] = 0
+
+        self._send_mass_mail(10)
+
+        self.assertEqual(len(self.sinks[0].messages), 10)
+
+    def test_failover_on_connection_error(self):
+        port = self.sinks[0].port
+        self._stop(self.sinks[0])
+        self.relays[0]['port'] = port
+        self.relays[0]['weight'] = 100
+
+        self.assertEqual(self._send_mass_mail(10), 10)
+
+        self.assertEqual(len(self.sinks[1].messages) + len(self.sinks[2].messages), 10)
+        state = multirelay.get_relay_state(('127.0.0.1', port, None))
+        self.assertFalse(state.is_up())
+
+    def test_failover_on_transient_error(self):
+        self.sinks[0].defer.add('to@example.net')
+        self.relays[0]['weight'] = 100
+
+        send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+
+        self.assertEqual(self.sinks[0].messages, [])
+        self.assertEqual(len(self.sinks[1].messages) + len(self.sinks[2].messages), 1)
+
+    def test_permanent_error(self):
+        for sink in self.sinks:
+            sink.refuse.add('bad@example.net')
+
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            send_mail('件名', '本文', 'from@example.net', ['bad@example.net'])
+
+        self.assertEqual(sum(sink.commands.count('RCPT TO:<bad@example.net>')
+                             for sink in self.sinks), 1)
+
+    def test_all_relays_down(self):
+        for sink in self.sinks:
+            self._stop(sink)
+
+        with self.assertRaises(OSError):
+            send_mail('件名', '本文', 'from@example.net', ['to@example.net'])
+        self.assertEqual(send_mail('件名', '本文', 'from@example.net', ['to@example.net'],
+                                   fail_silently=True), 0)
+
+    def test_latency(self):
+        self._send_mass_mail(30)
+
+        for relay in self.relays:
+            state = multirelay.get_relay_state((relay['host'], relay['port'], None))
+            self.assertIsNotNone(state.latency)
+            self.assertEqual(state.in_flight, 0)
+
+    def test_report(self):
+        report = self._send_mass_mail(10, report=True)
+
+        self.assertEqual(report.num_sent, 10)
+        self.assertEqual({r.code for r in report}, {250})
+
+
+@override_settings(DEFAULT_CHARSET='utf-8')
+@override_settings(EMAIL_DOMAIN_DEFAULT_LIMITS={'concurrency': 2})
+class ShardedBackendTestCase(SMTPTestCase, DjangoTestCase):
+    backend = 'beproud.django.mailer.backends.sharded.EmailBackend'
+
+    def test_split_by_domain(self):
+        num_sent = send_mail('件名', '本文', 'from@example.net',
+                             ['a1@example.net', 'b1@example.com', 'a2@example.net'])
+
+        self.assertEqual(num_sent, 1)
+        self.assertEqual(sorted(m['rcpt_tos'] for m in self.sink.messages), [
+            ['a1@example.net', 'a2@example.net'],
+            ['b1@example.com'],
+        ])
+
+    @override_settings(EMAIL_DOMAIN_LIMITS={'example.net': {'concurrency': 1}})
+    def test_concurrency(self):
+        num_sent = send_mass_mail([
+            ('件名', '本文', 'from@example.net', ['to%s@%s' % (i, domain)])
+            for domain in ('example.net', 'example.com') for i in range(6)
+        ])
+
+        self.assertEqual(num_sent, 12)
+        self.assertEqual(len(self.sink.messages), 12)
+        self.assertEqual(self.sink.connections, 3)
+
+    @override_settings(EMAIL_DOMAIN_LIMITS={'example.net': {'rate': 5}})
+    def test_slow_domain(self):
+        start = time.monotonic()
+        send_mass_mail([
+            ('件名', '本文', 'from@example.net', ['to%s@%s' % (i, domain)])
+            for domain in ('example.net', 'example.com') for i in range(3)
+        ])
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+        domains = [m['rcpt_tos'][0].split('@')[1] for m in self.sink.messages]
+        # The unthrottled domain is not held up by the throttled one.
+        self.assertEqual(domains[-2:], ['example.net', 'example.net'])
+
+    def test_domain_limits(self):
+        with override_settings(EMAIL_DOMAIN_LIMITS={'ezweb.ne.jp': {'concurrency': 1}}):
+            self.assertEqual(sharded.get_domain_limits('sub.ezweb.ne.jp'),
+                             {'concurrency': 1, 'rate': None})
+            self.assertEqual(sharded.get_domain_limits('example.net'),
+                             {'concurrency': 2, 'rate': None})
+        self.assertEqual(sharded.get_domain('宛先 <To@Example.NET>'), 'example.net')
+
+    def test_fail_loud(self):
+        self.sink.refuse.add('bad@example.com')
+
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            send_mass_mail([
+                ('件名', '本文', 'from@example.net', ['bad@example.com']),
+                ('件名', '本文', 'from@example.net', ['to@example.net']),
+            ])
+
+    def test_report(self):
+        self.sink.refuse.add('bad@example.com')
+
+        report = send_mass_mail([
+            ('件名', '本文', 'from@example.net', ['bad@example.com', 'to@example.net']),
+            ('件名', '本文', 'from@example.net', ['bad@example.com']),
+            ('件名', '本文', 'from@example.net', ['to@example.com']),
+        ], report=True)
+
+        self.assertEqual([r.sent for r in report], [True, False, True])
+        self.assertEqual(report[0].accepted, ['to@example.net'])
+        self.assertEqual(report[0].refused, {'bad@example.com': (550, b'No such user')})
+        self.assertEqual(report[1].code, 550)